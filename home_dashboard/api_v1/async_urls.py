@@ -0,0 +1,22 @@
+"""
+Maps the URLs of the REST interface to the async views for the ASGI application. The urls that
+have no async view use the views of api_v1.urls. The ids of the detail urls are numeric, so the
+extra actions (e.g. reading/export/) fall through to api_v1.urls.
+"""
+from django.urls import path, re_path
+
+from . import async_views, urls
+
+app_name = 'api_v1'
+
+urlpatterns = [
+    path('monthly_usage/', async_views.monthly_usage, name='monthly_usage'),
+    path('events/', async_views.events, name='events'),
+    re_path(r'^usage/$', async_views.usage_list, name='usage-list'),
+    re_path(r'^usage/(?P<pk>[0-9]+)/$', async_views.usage_detail, name='usage-detail'),
+    re_path(r'^daily_usage/$', async_views.daily_usage_list, name='dailyusage-list'),
+    re_path(r'^daily_usage/(?P<pk>[0-9]+)/$', async_views.daily_usage_detail,
+            name='dailyusage-detail'),
+    re_path(r'^reading/$', async_views.reading_list, name='reading-list'),
+    re_path(r'^reading/(?P<pk>[0-9]+)/$', async_views.reading_detail, name='reading-detail'),
+] + urls.urlpatterns
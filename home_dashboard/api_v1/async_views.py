@@ -0,0 +1,77 @@
+"""
+Provides async versions of the read-only views of the REST interface for the ASGI application
+(see home_dashboard.asgi).
+
+The views themselves (and the ORM) are synchronous: they run in a thread pool of
+settings.ASYNC_DB_THREADS threads. Waiting for slow clients and queueing many parallel chart
+requests then happens in the event loop, without holding a worker thread.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import views
+
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=settings.ASYNC_DB_THREADS,
+                                  thread_name_prefix='async-db')
+
+
+def db_sync_to_async(function):
+    """
+    Make an async function of a synchronous function, that runs in the database thread pool.
+
+    The database connection of the pool thread is handled like at the start and the end of a
+    request (see settings.CONN_MAX_AGE).
+    """
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False, executor=_DB_EXECUTOR)
+
+
+def _run_view(view, request, *args, **kwargs):
+    """
+    Run a synchronous view and render its response.
+    """
+    response = view(request, *args, **kwargs)
+    if not getattr(response, 'is_rendered', True):
+        response.render()
+    return response
+
+
+def async_view(view):
+    """
+    Make an async view of a synchronous view, that runs in the database thread pool.
+
+    :param view: the synchronous view function
+    :return: the async view function
+    """
+    run_view = db_sync_to_async(_run_view)
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        return await run_view(view, request, *args, **kwargs)
+    return wrapper
+
+
+monthly_usage = async_view(views.monthly_usage) # pylint: disable=invalid-name
+events = async_view(views.events) # pylint: disable=invalid-name
+usage_list = async_view(views.UsageViewSet.as_view({'get': 'list'})) # pylint: disable=invalid-name
+usage_detail = async_view( # pylint: disable=invalid-name
+    views.UsageViewSet.as_view({'get': 'retrieve'}))
+daily_usage_list = async_view( # pylint: disable=invalid-name
+    views.DailyUsageViewSet.as_view({'get': 'list'}))
+daily_usage_detail = async_view( # pylint: disable=invalid-name
+    views.DailyUsageViewSet.as_view({'get': 'retrieve'}))
+# the readings can also be changed at the same urls, so those methods are mapped as well
+reading_list = async_view( # pylint: disable=invalid-name
+    views.ReadingViewSet.as_view({'get': 'list', 'post': 'create'}))
+reading_detail = async_view( # pylint: disable=invalid-name
+    views.ReadingViewSet.as_view({'get': 'retrieve', 'put': 'update',
+                                  'patch': 'partial_update', 'delete': 'destroy'}))
@@ -0,0 +1,110 @@
+"""
+Provides the Server-Sent Events stream of the recalculated usages.
+
+The events are read from the UsageEvent log in the database, so every process sees the events of
+all the other processes (and the usage worker) without a message broker.
+"""
+import asyncio
+import json
+import time
+
+from django.conf import settings
+from django.db.models import Max, Min
+from django.http import StreamingHttpResponse
+
+from utilities.logic import period_to_year_month
+from utilities.models import UsageEvent
+
+
+def get_last_event_id():
+    """
+    Get the id of the last logged event (0 when there are no events).
+    """
+    return UsageEvent.objects.aggregate(last=Max('id'))['last'] or 0
+
+
+def get_events(last_event_id, check_missed=False):
+    """
+    Get the events after an event, formatted for the event stream.
+
+    :param last_event_id: the id of the last event the client has seen
+    :param check_missed: add a reset event when the client missed events that are removed from
+                         the log, so it knows it has to reload everything
+    :return: tuple with the formatted events and the id of the last event
+    """
+    chunks = []
+    if check_missed:
+        first_event_id = UsageEvent.objects.aggregate(first=Min('id'))['first']
+        if first_event_id is not None and last_event_id < first_event_id - 1:
+            chunks.append('event: reset\ndata: {}\n\n')
+    for event in UsageEvent.objects.filter(id__gt=last_event_id).order_by('id'):
+        data = {'meter': event.meter_id,
+                'first': '{:04d}-{:02d}'.format(*period_to_year_month(event.first_period)),
+                'last': '{:04d}-{:02d}'.format(*period_to_year_month(event.last_period))}
+        chunks.append('id: {i}\nevent: usage\ndata: {d}\n\n'.format(
+            i=event.id, d=json.dumps(data, separators=(',', ':'))))
+        last_event_id = event.id
+    return chunks, last_event_id
+
+
+class EventStreamResponse(StreamingHttpResponse):
+    """
+    Send the events as they are logged. The browser (EventSource) reconnects with the id of the
+    last event it got when the response ends.
+
+    The WSGI server iterates the response, which polls the event log once, so a client never holds
+    a worker thread. The ASGI application (see home_dashboard.asgi) uses astream, which keeps the
+    stream open for settings.EVENTS_STREAM_TIMEOUT seconds without blocking a thread.
+    """
+
+    def __init__(self, last_event_id, check_missed=False):
+        """
+        :param last_event_id: the id of the last event the client has seen
+        :param check_missed: check if the client missed events (see get_events)
+        """
+        self.last_event_id = last_event_id
+        self.check_missed = check_missed
+        super().__init__(self._stream(), content_type='text/event-stream')
+        self['Cache-Control'] = 'no-cache'
+        # do not let NGINX buffer the events
+        self['X-Accel-Buffering'] = 'no'
+
+    @staticmethod
+    def _start():
+        """
+        The first chunk: how long the browser waits before it reconnects (in ms).
+        """
+        return 'retry: {r}\n\n'.format(r=int(settings.EVENTS_POLL_INTERVAL * 1000))
+
+    def _stream(self):
+        """
+        Poll the event log once, the browser polls again after the retry time.
+        """
+        yield self._start()
+        (chunks, self.last_event_id) = get_events(self.last_event_id, self.check_missed)
+        yield ''.join(chunks) or ':\n\n'
+
+    async def astream(self, disconnected=None):
+        """
+        Poll the event log until the timeout, without blocking the event loop.
+
+        :param disconnected: optional asyncio.Event that is set when the client disconnects, the
+                             stream then stops at once
+        """
+        from .async_views import db_sync_to_async # pylint: disable=import-outside-toplevel
+        get_events_async = db_sync_to_async(get_events)
+        disconnected = disconnected or asyncio.Event()
+        yield self.make_bytes(self._start())
+        deadline = time.monotonic() + settings.EVENTS_STREAM_TIMEOUT
+        check_missed = self.check_missed
+        while not disconnected.is_set():
+            (chunks, self.last_event_id) = await get_events_async(self.last_event_id,
+                                                                  check_missed)
+            check_missed = False
+            yield self.make_bytes(''.join(chunks) or ':\n\n')
+            if time.monotonic() >= deadline:
+                return
+            try:
+                await asyncio.wait_for(disconnected.wait(), settings.EVENTS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
@@ -4,7 +4,7 @@ Prepares the filters for the REST backend.
 
 from django_filters import rest_framework as filters
 
-from utilities.models import Meter, Reading, Usage
+from utilities.models import DailyUsage, Meter, Reading, Usage
 
 class MeterFilter(filters.FilterSet):
     """
@@ -31,3 +31,13 @@ class UsageFilter(filters.FilterSet):
     class Meta:
         model = Usage
         fields = ['month', 'year', 'meter']
+
+
+class DailyUsageFilter(filters.FilterSet):
+    """
+    Provides filter functionality for the DailyUsage model, including date ranges.
+    """
+    class Meta:
+        model = DailyUsage
+        fields = {'meter': ['exact'],
+                  'date': ['exact', 'gte', 'lte']}
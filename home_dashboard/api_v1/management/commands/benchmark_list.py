@@ -0,0 +1,70 @@
+"""
+Benchmark the serializers against the fast list path.
+"""
+from datetime import date, timedelta
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_databases, teardown_databases
+
+from utilities.models import Meter, Reading
+from utilities.serializers import ReadingSerializer, compile_values_formatter
+
+
+class Command(BaseCommand):
+    """
+    Compare the time to list readings with the ReadingSerializer and with the fast list path
+    (values() and a compiled formatter, see api_v1.views.FastListMixin).
+
+    The readings are created in a test database (like ./manage.py test does), so the real data is
+    neither read nor locked. There is no request, so both paths give relative meter urls.
+    """
+    help = 'Benchmark listing readings with the serializer and with the fast list path.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000],
+                            help='The numbers of readings to list (default: 1000 10000).')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Take the best of this many runs (default: 3).')
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            meter = Meter.objects.create(meter_name='benchmark meter', meter_unit='m3')
+            start = date(1900, 1, 1)
+            Reading.objects.bulk_create([Reading(meter=meter, date=start + timedelta(days=i),
+                                                 reading=i * 1.25, remark='benchmark')
+                                         for i in range(max(options['rows']))])
+            for rows in options['rows']:
+                queryset = Reading.objects.filter(meter=meter).order_by('date')[:rows]
+                serializer_time = self._best(options['repeat'], lambda: ReadingSerializer(
+                    queryset.select_related('meter'), many=True, context={'request': None}
+                ).data)
+                fast_time = self._best(options['repeat'], lambda: self._fast_list(queryset))
+                self.stdout.write('{r:>7} rows: serializer {s:.3f} s, fast list {f:.3f} s, '
+                                  '{x:.1f}x faster'.format(r=rows, s=serializer_time,
+                                                           f=fast_time,
+                                                           x=serializer_time / fast_time))
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    @staticmethod
+    def _fast_list(queryset):
+        """
+        List the readings like the FastListMixin does.
+        """
+        (fields, format_row) = compile_values_formatter(ReadingSerializer(context={'request':
+                                                                                   None}))
+        return [format_row(row) for row in queryset.values(*fields)]
+
+    @staticmethod
+    def _best(repeat, function):
+        """
+        Get the shortest time of a number of runs of the function.
+        """
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
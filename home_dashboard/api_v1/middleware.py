@@ -0,0 +1,77 @@
+"""
+Provides the middleware for the REST interface.
+"""
+import re
+
+from django.conf import settings
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # pylint: disable=invalid-name
+
+RE_ACCEPTS_BROTLI = re.compile(r'\bbr\b')
+
+
+def _compress_brotli_sequence(sequence):
+    """
+    Compress the (streamed) content with brotli, chunk by chunk.
+    """
+    compressor = brotli.Compressor()
+    for item in sequence:
+        data = compressor.process(item)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class APICompressionMiddleware(GZipMiddleware):
+    """
+    Compress the responses of the REST interface with brotli (when the brotli package is installed)
+    or gzip, depending on the Accept-Encoding of the client.
+
+    Only the responses of the api_v1 views that are at least settings.API_COMPRESSION_MIN_SIZE
+    bytes (or are streamed, like the exports) are compressed. The html pages are left alone.
+    """
+
+    def process_response(self, request, response):
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is None or resolver_match.app_name != 'api_v1':
+            return response
+        if not response.streaming and len(response.content) < settings.API_COMPRESSION_MIN_SIZE:
+            return response
+        if response.has_header('Content-Encoding'):
+            return response
+        if response.get('Content-Type', '').startswith('text/event-stream'):
+            # compressing would hold back the events until the compressor flushes
+            return response
+
+        if brotli is not None and RE_ACCEPTS_BROTLI.search(request.META.get('HTTP_ACCEPT_ENCODING',
+                                                                             '')):
+            return self._compress_brotli(response)
+        return super().process_response(request, response)
+
+    @staticmethod
+    def _compress_brotli(response):
+        """
+        Compress the response with brotli, the same way the GZipMiddleware uses gzip.
+        """
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if response.streaming:
+            response.streaming_content = _compress_brotli_sequence(response.streaming_content)
+            del response['Content-Length']
+        else:
+            compressed_content = brotli.compress(response.content)
+            if len(compressed_content) >= len(response.content):
+                return response
+            response.content = compressed_content
+            response['Content-Length'] = str(len(response.content))
+
+        # compressed content needs a weak ETag, conditional requests still match on it
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = 'br'
+        return response
@@ -0,0 +1,90 @@
+"""
+Provides the pagination for the REST interface.
+"""
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from utilities.list_query import decode_cursor, encode_cursor, keyset_filter
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginate on the (unique) ordering of the view (view.keyset_ordering), e.g. meter and date.
+
+    The next page starts after the last object of the current page, so every page is an index range
+    scan: there is no COUNT and no OFFSET, and deep pages are as cheap as the first page. The page
+    size can be set with ?page_size= up to settings.API_MAX_PAGE_SIZE.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self):
+        self.request = None
+        self.next_position = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        ordering = view.keyset_ordering
+        fields = [queryset.model._meta.get_field(name) for name in ordering]
+        page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*ordering)
+        position = self.decode_cursor(request, fields)
+        if position is not None:
+            queryset = queryset.filter(keyset_filter(ordering, position))
+
+        results = list(queryset[:page_size + 1])
+        self.next_position = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            last = results[-1]
+            if isinstance(last, dict):
+                # rows of a values() queryset, see api_v1.views.FastListMixin
+                self.next_position = [last[field.name] for field in fields]
+            else:
+                self.next_position = [getattr(last, field.attname) for field in fields]
+        return results
+
+    def get_page_size(self, request):
+        """
+        Get the requested page size, limited to settings.API_MAX_PAGE_SIZE.
+        """
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.REST_FRAMEWORK['PAGE_SIZE']
+        return max(1, min(page_size, settings.API_MAX_PAGE_SIZE))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([('next', self.get_next_link()),
+                                     ('results', data)]))
+
+    def get_next_link(self):
+        """
+        Get the url of the next page or None on the last page.
+        """
+        if self.next_position is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param,
+                                   encode_cursor(self.next_position))
+
+    def decode_cursor(self, request, fields):
+        """
+        Get the position of the cursor in the request.
+
+        :return: list with the values of the ordering fields or None for the first page
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            return decode_cursor(encoded, fields)
+        except ValueError as error:
+            raise NotFound(self.invalid_cursor_message) from error
@@ -0,0 +1,23 @@
+"""
+Provides additional parsers for the REST interface.
+"""
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # pylint: disable=invalid-name
+
+
+class MessagePackParser(BaseParser):
+    """
+    Parse MessagePack request content (see api_v1.renderers.MessagePackRenderer).
+    """
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as error:
+            raise ParseError('MessagePack parse error - {e}'.format(e=error)) from error
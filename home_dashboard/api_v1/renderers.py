@@ -0,0 +1,41 @@
+"""
+Provides additional renderers for the REST interface.
+"""
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # pylint: disable=invalid-name
+
+
+class ColumnarRenderer(JSONRenderer):
+    """
+    Render a time series as parallel arrays instead of a list of objects.
+
+    Selected with ?format=columnar (or the media type in the Accept header). The views that support
+    it (see api_v1.views.ColumnarMixin) supply the columns; the JSON encoding is the same as the
+    JSONRenderer.
+    """
+    media_type = 'application/vnd.home-dashboard.columnar+json'
+    format = 'columnar'
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Render the data as MessagePack, a compact binary alternative to JSON.
+
+    Selected with ?format=msgpack or the application/msgpack media type. Needs the msgpack package.
+    The values that are not native to MessagePack (dates, decimals, ...) are converted the same
+    way as in the JSON output.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=JSONEncoder().default, use_bin_type=True)
@@ -1,13 +1,30 @@
 """
 Testing the API V1 REST interface.
 """
-import json
+import asyncio
 from datetime import datetime
+from decimal import Decimal
+import gzip
+import json
+from unittest import mock, skipIf
+
+from django.conf import settings
 from django.contrib.auth.models import User, Permission
-from django.test import Client, TestCase
-from django.urls import reverse
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.test import AsyncClient, Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+
+from home_dashboard.asgi import application
+from utilities.meter_registry import get_meters
+from utilities.models import DailyUsage, Meter, Reading, Usage, UsageEvent
+from utilities.serializers import ReadingSerializer, compile_values_formatter
 
-from utilities.models import Meter, Reading, Usage
+from .events import EventStreamResponse, get_events
+from .middleware import brotli
+from .renderers import msgpack
+from .views import ReadingViewSet, UsageViewSet
 
 XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>'
 
@@ -149,6 +166,22 @@ class RestMeterTests(TestCase):
         self.assertIn('testmeter_altered', str(response.content))
         self.assertIn('Y', str(response.content))
 
+    def test_fields_do_not_limit_changes(self):
+        """
+        The fields parameter only applies to reading the data.
+        """
+        Meter.objects.create(meter_name='testmeter', meter_unit='X')
+        self.user.user_permissions.add(Permission.objects.get(name='Can change meter'))
+        self.client.login(username='testuser', password='q2w3E$R%')
+        url = reverse('api_v1:meter-detail', kwargs={'pk': 1}) + '?fields=meter_name'
+        response = self.client.patch(url,
+                                     json.dumps({'meter_unit': 'Y'}),
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['meter_unit'], 'Y')
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content), {'meter_name': 'testmeter'})
+
     def test_cannot_change_metername_to_existing_(self):
         """
         Changing a name of a meter to a name already in the database should not be ok.
@@ -172,6 +205,43 @@ class RestMeterTests(TestCase):
         self.assertIn('already exists', str(response.content))
 
 
+    def test_usage_between_dates(self):
+        """
+        The usage of several date ranges is calculated with one query for the readings.
+        """
+        meter = Meter.objects.create(meter_name='testmeter', meter_unit='X')
+        for (day, value) in (('2018-01-01', 0), ('2018-02-01', 310), ('2018-03-01', 590)):
+            Reading.objects.create(meter=meter, reading=value,
+                                   date=datetime.strptime(day, '%Y-%m-%d').date())
+        self.client.login(username='testuser', password='q2w3E$R%')
+        url = reverse('api_v1:meter-usage-between', args=[meter.id])
+        # session, user, meter and the readings
+        with self.assertNumQueries(4):
+            response = self.client.get(url + '?start=2018-01-01&end=2018-01-31'
+                                             '&start=2018-01-22&end=2018-02-10'
+                                             '&start=2017-12-01&end=2018-01-01')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['unit'], 'X')
+        self.assertEqual([(u['start'], u['end']) for u in data['usages']],
+                         [('2018-01-01', '2018-01-31'),
+                          ('2018-01-22', '2018-02-10'),
+                          ('2017-12-01', '2018-01-01')])
+        self.assertEqual([u['usage'] for u in data['usages']], [310, 200, None])
+
+    def test_usage_between_needs_valid_ranges(self):
+        """
+        Missing, malformed or reversed ranges are rejected.
+        """
+        meter = Meter.objects.create(meter_name='testmeter', meter_unit='X')
+        self.client.login(username='testuser', password='q2w3E$R%')
+        url = reverse('api_v1:meter-usage-between', args=[meter.id])
+        for query in ('?start=2018-01-01', '?start=2018-01-01&end=yesterday',
+                      '?start=2018-02-01&end=2018-01-01', '?start=2018-02-31&end=2018-03-01'):
+            response = self.client.get(url + query)
+            self.assertEqual(response.status_code, 400)
+
+
 class RestReadingTests(TestCase):
     """
     Provides test cases for the Readings rest interface.
@@ -213,6 +283,154 @@ class RestReadingTests(TestCase):
         self.assertContains(response, 'meter_url')
         self.assertContains(response, 'http://testserver/api/v1/meter/1')
 
+    def test_readinglist_uses_constant_number_of_queries(self):
+        """
+        The meter url and unit should not cost a query per reading.
+        """
+        meter_2 = Meter.objects.create(meter_name='testmeter2', meter_unit='Y')
+        for day in range(2, 10):
+            Reading.objects.create(meter=self.meter if day % 2 else meter_2,
+                                   reading=100 + day,
+                                   date=datetime(2001, 1, day).date())
+        self.client.login(username='testuser', password='q2w3E$R%')
+        # the meter units come from the meter registry, loaded once per process
+        get_meters()
+        # session, user and readings (the keyset pagination does not count)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('api_v1:reading-list'))
+        data = json.loads(response.content)
+        self.assertEqual(len(data['results']), 9)
+        meter_response = self.client.get(reverse('api_v1:meter-detail', args=[meter_2.id]))
+        result = [r for r in data['results'] if r['meter'] == meter_2.id][0]
+        self.assertEqual(result['meter_url'], json.loads(meter_response.content)['url'])
+        self.assertEqual(result['meter_unit'], 'Y')
+
+    def test_export_readings_as_csv(self):
+        """
+        The readings can be exported as CSV, using the normal filters.
+        """
+        meter_2 = Meter.objects.create(meter_name='testmeter2', meter_unit='Y')
+        Reading.objects.create(meter=meter_2, reading=5, date=datetime(2001, 1, 2).date())
+        self.client.login(username='testuser', password='q2w3E$R%')
+        response = self.client.get(reverse('api_v1:reading-export'), {'meter': self.meter.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content.splitlines(),
+                         ['id,date,reading,meter,remark',
+                          '1,2001-01-01,100.00,{m},test reading'.format(m=self.meter.id)])
+
+    def test_export_readings_as_ndjson(self):
+        """
+        The readings can be exported as newline delimited JSON.
+        """
+        self.client.login(username='testuser', password='q2w3E$R%')
+        response = self.client.get(reverse('api_v1:reading-export'), {'export_format': 'ndjson'})
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(json.loads(lines[0]), {'id': 1,
+                                                'date': '2001-01-01',
+                                                'reading': '100.00',
+                                                'meter': self.meter.id,
+                                                'remark': 'test reading'})
+
+    def test_columnar_readings(self):
+        """
+        The readings can be fetched as parallel arrays per meter.
+        """
+        Reading.objects.create(meter=self.meter, reading=131, date=datetime(2001, 2, 1).date())
+        Reading.objects.create(meter=self.meter, reading=159, date=datetime(2001, 3, 1).date())
+        self.client.login(username='testuser', password='q2w3E$R%')
+        response = self.client.get(reverse('api_v1:reading-list'), {'format': 'columnar'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content),
+                         [{'meter': self.meter.id,
+                           'unit': 'X',
+                           'dates': ['2001-01-01', '2001-02-01', '2001-03-01'],
+                           'values': [100.0, 131.0, 159.0]}])
+
+        response = self.client.get(reverse('api_v1:reading-list'),
+                                   {'format': 'columnar', 'delta': 1, 'meter': self.meter.id})
+        self.assertEqual(json.loads(response.content),
+                         [{'meter': self.meter.id,
+                           'unit': 'X',
+                           'start': '2001-01-01',
+                           'deltas': [0, 31, 28],
+                           'values': [100.0, 131.0, 159.0]}])
+
+    @override_settings(API_MAX_PAGE_SIZE=4)
+    def test_keyset_pagination_of_readings(self):
+        """
+        The readings are paginated on meter and date by following the next links.
+        """
+        meter_2 = Meter.objects.create(meter_name='testmeter2', meter_unit='Y')
+        for day in range(2, 12):
+            Reading.objects.create(meter=self.meter if day % 3 else meter_2,
+                                   reading=100 + day,
+                                   date=datetime(2001, 1, day).date())
+        self.client.login(username='testuser', password='q2w3E$R%')
+        url = reverse('api_v1:reading-list') + '?page_size=100'
+        keys = []
+        pages = 0
+        while url:
+            data = json.loads(self.client.get(url).content)
+            self.assertNotIn('count', data)
+            self.assertLessEqual(len(data['results']), 4)
+            keys += [(r['meter'], r['date']) for r in data['results']]
+            url = data['next']
+            pages += 1
+        self.assertEqual(pages, 3)
+        expected = Reading.objects.order_by('meter', 'date').values_list('meter', 'date')
+        self.assertEqual(keys, [(m, d.isoformat()) for (m, d) in expected])
+
+    def test_invalid_cursor(self):
+        """
+        An invalid cursor gives a 404.
+        """
+        self.client.login(username='testuser', password='q2w3E$R%')
+        response = self.client.get(reverse('api_v1:reading-list'), {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_sparse_fieldsets_of_readings(self):
+        """
+        Only the requested fields are serialized and loaded.
+        """
+        self.client.login(username='testuser', password='q2w3E$R%')
+        url = reverse('api_v1:reading-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'fields': 'date,reading'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(json.loads(response.content)['results'][0]), {'date', 'reading'})
+        readings_query = queries.captured_queries[-1]['sql']
+        self.assertNotIn('remark', readings_query)
+        self.assertNotIn('utilities_meter', readings_query)
+
+        response = self.client.get(url, {'omit': 'meter_url,remark'})
+        self.assertEqual(set(json.loads(response.content)['results'][0]),
+                         {'id', 'date', 'reading', 'meter', 'meter_unit'})
+        self.assertEqual(json.loads(response.content)['results'][0]['meter_unit'], 'X')
+
+        response = self.client.get(url, {'fields': 'date,colour'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_fast_list_matches_the_serializer(self):
+        """
+        The fast list gives exactly the same output as the serializer.
+        """
+        meter2 = Meter.objects.create(meter_name='testmeter2', meter_unit='Y')
+        Reading.objects.bulk_create([Reading(meter=meter2, reading=Decimal('12.5') * i,
+                                             date=datetime(2018, 1, i + 1).date(),
+                                             remark='' if i % 2 else 'remark {i}'.format(i=i))
+                                     for i in range(20)])
+        self.assertIsNotNone(compile_values_formatter(ReadingSerializer()))
+        self.client.login(username='testuser', password='q2w3E$R%')
+        for query in ({'page_size': 8}, {'omit': 'meter_url'}, {'format': 'xml'}):
+            fast = self.client.get(reverse('api_v1:reading-list'), query)
+            with mock.patch.object(ReadingViewSet, 'fast_list', False):
+                slow = self.client.get(reverse('api_v1:reading-list'), query)
+            self.assertEqual(fast.status_code, 200)
+            self.assertEqual(fast.content, slow.content)
+
     def test_login_cannot_add_new_reading(self):
         """
         Not everyone can add a meter.
@@ -399,6 +617,170 @@ class RestUsageTests(TestCase):
         self.assertContains(response, 'meter_url')
         self.assertContains(response, 'http://testserver/api/v1/meter/1')
 
+    def test_export_usages(self):
+        """
+        The usages can be exported as CSV.
+        """
+        self.client.login(username='testuser', password='q2w3E$R%')
+        response = self.client.get(reverse('api_v1:usage-export'))
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content.splitlines(),
+                         ['id,year,month,meter,usage',
+                          '1,2018,1,{m},1234.00'.format(m=self.meter.id)])
+
+    def test_columnar_usages(self):
+        """
+        The usages can be fetched as parallel arrays per meter.
+        """
+        Usage.objects.create(month=3, year=2018, meter=self.meter, usage=10)
+        self.client.login(username='testuser', password='q2w3E$R%')
+        response = self.client.get(reverse('api_v1:usage-list'),
+                                   {'format': 'columnar', 'delta': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content),
+                         [{'meter': self.meter.id,
+                           'unit': 'X',
+                           'start': '2018-01',
+                           'deltas': [0, 2],
+                           'values': [1234.0, 10.0]}])
+
+    def test_renderers_follow_the_settings(self):
+        """
+        The renderers of the usage list are resolved per request: a renderer that is removed from
+        the settings is no longer offered, the columnar format stays.
+        """
+        self.client.login(username='testuser', password='q2w3E$R%')
+        rest_framework = dict(settings.REST_FRAMEWORK,
+                              DEFAULT_RENDERER_CLASSES=['rest_framework.renderers.JSONRenderer'])
+        with override_settings(REST_FRAMEWORK=rest_framework):
+            response = self.client.get(reverse('api_v1:usage-list'), HTTP_ACCEPT='application/xml')
+            self.assertEqual(response.status_code, 406)
+            response = self.client.get(reverse('api_v1:usage-list'), {'format': 'columnar'})
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('api_v1:usage-list'), HTTP_ACCEPT='application/xml')
+        self.assertEqual(response.status_code, 200)
+
+    def test_sparse_fieldsets_of_usages(self):
+        """
+        The usages can leave out fields.
+        """
+        self.client.login(username='testuser', password='q2w3E$R%')
+        response = self.client.get(reverse('api_v1:usage-list'), {'omit': 'id,meter_url'})
+        self.assertEqual(json.loads(response.content)['results'],
+                         [{'month': 1, 'year': 2018, 'meter': self.meter.id, 'usage': '1234.00'}])
+
+    def test_conditional_get_of_usages(self):
+        """
+        A repeated request with the ETag gets a 304 until the usages are recalculated.
+        """
+        self.client.login(username='testuser', password='q2w3E$R%')
+        url = reverse('api_v1:usage-list')
+        response = self.client.get(url, {'meter': self.meter.id})
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        # session, user and the meter version, the usages are not queried
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'meter': self.meter.id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # another query or format is another representation
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        Reading.objects.create(meter=self.meter, reading=200,
+                               date=datetime.strptime('2001-03-01', '%Y-%m-%d').date())
+        response = self.client.get(url, {'meter': self.meter.id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_conditional_get_of_monthly_usage(self):
+        """
+        The monthly usage supports If-None-Match and If-Modified-Since.
+        """
+        self.client.login(username='testuser', password='q2w3E$R%')
+        url = reverse('api_v1:monthly_usage')
+        data = {'meter': self.meter.id, 'year': 2018}
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, data, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, data, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_monthly_usage_is_cached(self):
+        """
+        The second request gets the usages from the cache.
+        """
+        self.client.login(username='testuser', password='q2w3E$R%')
+        url = reverse('api_v1:monthly_usage')
+        data = {'meter': self.meter.id, 'year': 2018}
+        first = self.client.get(url, data)
+        # session, user, data version (ETag) and data version (cache key)
+        with self.assertNumQueries(4):
+            second = self.client.get(url, data)
+        self.assertEqual(first.content, second.content)
+
+    def test_monthly_usage_rejects_invalid_parameters(self):
+        """
+        Parameters that are not integers, a reversed range and too many years are a bad request.
+        """
+        self.client.login(username='testuser', password='q2w3E$R%')
+        url = reverse('api_v1:monthly_usage')
+        for data in ({'meter': self.meter.id, 'year': 'x'},
+                     {'meters': 'a,b', 'years': 2018},
+                     {'meters': self.meter.id, 'year_from': 'x'},
+                     {'meters': self.meter.id, 'year_from': 2018, 'year_to': 2017},
+                     {'meters': self.meter.id, 'year_from': 1, 'year_to': 10 ** 9},
+                     {'meters': self.meter.id,
+                      'years': ','.join(str(year) for year in range(1900, 2000))}):
+            response = self.client.get(url, data)
+            self.assertEqual(response.status_code, 400, data)
+        with override_settings(MONTHLY_USAGE_MAX_YEARS=2):
+            response = self.client.get(url, {'meters': self.meter.id, 'year_from': 2017,
+                                             'year_to': 2018})
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(url, {'meters': self.meter.id, 'year_from': 2016,
+                                             'year_to': 2018})
+            self.assertEqual(response.status_code, 400)
+
+    def test_monthly_usage_of_several_meters_and_years(self):
+        """
+        All the series are fetched at once, with one query for the usages.
+        """
+        meter2 = Meter.objects.create(meter_name='testmeter2', meter_unit='X')
+        Usage.objects.create(month=2, year=2017, meter=meter2, usage=56)
+        self.client.login(username='testuser', password='q2w3E$R%')
+        # session, user, data version (ETag), data version (cache key) and the usages
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('api_v1:monthly_usage'),
+                                       {'meters': '{m1},{m2}'.format(m1=self.meter.id,
+                                                                     m2=meter2.id),
+                                        'year_from': 2017,
+                                        'year_to': 2018})
+        self.assertEqual(response.status_code, 200)
+        series = json.loads(response.content)['series']
+        self.assertEqual([(s['meter'], s['label']) for s in series],
+                         [(self.meter.id, 2017), (self.meter.id, 2018),
+                          (meter2.id, 2017), (meter2.id, 2018)])
+        self.assertEqual(series[0]['data'], [None] * 12)
+        self.assertEqual(series[1]['data'][0], '39.80645161290322580645161290')
+        self.assertEqual(series[2]['data'][1], '2.00')
+        self.assertEqual(series[3]['data'], [None] * 12)
+
+    def test_fast_list_of_usages_matches_the_serializer(self):
+        """
+        The fast list gives exactly the same output as the serializer.
+        """
+        Usage.objects.create(month=2, year=2018, meter=self.meter, usage=Decimal('0.5'))
+        self.client.login(username='testuser', password='q2w3E$R%')
+        fast = self.client.get(reverse('api_v1:usage-list'), {'format': 'json'})
+        with mock.patch.object(UsageViewSet, 'fast_list', False):
+            slow = self.client.get(reverse('api_v1:usage-list'), {'format': 'json', 'slow': 1})
+        self.assertEqual(fast.content, slow.content.replace(b'&slow=1', b''))
+
     def test_cannot_add_usage(self):
         """
         The usage cannot be added via the rest interface.
@@ -440,3 +822,360 @@ class RestUsageTests(TestCase):
                                       follow=True)
         self.assertEqual(response.status_code, 405)
         self.assertIn('not allowed', str(response.content))
+
+
+class RestDailyUsageTests(TestCase):
+    """
+    Run all tests for the DailyUsage class rest interface.
+    """
+
+    # pylint: disable=invalid-name
+
+    def setUp(self):
+        """
+        Setup a test user and a meter with readings.
+        """
+        self.client = Client()
+        self.user = User.objects.create_user('testuser', 'test@user.com', 'q2w3E$R%')
+        self.meter = Meter.objects.create(meter_name='testmeter', meter_unit='X')
+        Reading.objects.create(meter=self.meter, reading=0,
+                               date=datetime.strptime('2018-01-01', '%Y-%m-%d').date())
+        Reading.objects.create(meter=self.meter, reading=310,
+                               date=datetime.strptime('2018-02-01', '%Y-%m-%d').date())
+
+    def test_need_login_to_see_daily_usage(self):
+        """
+        The rest-interface should *not* be accessible for everyone.
+        """
+        response = self.client.get(reverse('api_v1:dailyusage-list'), follow=True)
+        self.assertEqual(response.status_code, 403)
+
+    def test_filter_daily_usage_on_date_range(self):
+        """
+        The daily usages can be filtered on a date range.
+        """
+        self.assertEqual(DailyUsage.objects.count(), 31)
+        self.client.login(username='testuser', password='q2w3E$R%')
+        response = self.client.get(reverse('api_v1:dailyusage-list'),
+                                   {'meter': self.meter.id,
+                                    'date__gte': '2018-01-10',
+                                    'date__lte': '2018-01-16'})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['count'], 7)
+        self.assertEqual(data['results'][0]['date'], '2018-01-10')
+        self.assertEqual(data['results'][0]['usage'], '10.0000')
+
+
+class RestCompressionTests(TestCase):
+    """
+    Test the compression and the MessagePack format of the API responses.
+    """
+
+    # pylint: disable=invalid-name
+
+    def setUp(self):
+        """
+        Setup a test user and a list of usages that is large enough to compress.
+        """
+        self.client = Client()
+        self.user = User.objects.create_user('testuser', 'test@user.com', 'q2w3E$R%')
+        self.meter = Meter.objects.create(meter_name='testmeter', meter_unit='X')
+        Usage.objects.bulk_create([Usage(meter=self.meter, year=2000 + i // 12, month=i % 12 + 1,
+                                         usage=i) for i in range(50)])
+        self.client.login(username='testuser', password='q2w3E$R%')
+
+    def test_gzip_compression(self):
+        """
+        Large API responses are compressed when the client accepts gzip.
+        """
+        url = reverse('api_v1:usage-list') + '?format=json&page_size=50'
+        plain = self.client.get(url)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertLess(len(response.content), len(plain.content))
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        # the ETag of the compressed response is weak, but still matches
+        self.assertTrue(response['ETag'].startswith('W/'))
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_small_responses_and_pages_are_not_compressed(self):
+        """
+        Small API responses and the html pages are sent as is.
+        """
+        response = self.client.get(reverse('api_v1:usage-list') + '?format=json&page_size=1',
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        response = self.client.get(reverse('utilities:usage_list'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    @skipIf(brotli is None, 'brotli is not installed')
+    def test_brotli_compression(self):
+        """
+        Brotli is preferred when the client accepts it.
+        """
+        url = reverse('api_v1:usage-list') + '?format=json&page_size=50'
+        plain = self.client.get(url)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), plain.content)
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_messagepack(self):
+        """
+        The API can render and parse MessagePack.
+        """
+        response = self.client.get(reverse('api_v1:usage-list') + '?page_size=2',
+                                   HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        data = msgpack.unpackb(response.content, raw=False)
+        self.assertEqual(data['results'][0]['year'], 2000)
+        self.assertEqual(data['results'][0]['usage'], '0.00')
+
+        self.user.user_permissions.add(Permission.objects.get(name='Can add meter'))
+        response = self.client.post(reverse('api_v1:meter-list'),
+                                    msgpack.packb({'meter_name': 'packed', 'meter_unit': 'Y'}),
+                                    content_type='application/msgpack',
+                                    HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Meter.objects.filter(meter_name='packed').exists())
+
+
+class RestEventTests(TestCase):
+    """
+    Test the event stream of the recalculated usages.
+    """
+
+    # pylint: disable=invalid-name
+
+    def setUp(self):
+        """
+        Setup a logged in client and a meter with readings.
+        """
+        self.user = User.objects.create_user('testuser', 'test@user.com', 'q2w3E$R%')
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.meter = Meter.objects.create(meter_name='testmeter', meter_unit='X')
+        Reading.objects.create(meter=self.meter, reading=0,
+                               date=datetime.strptime('2018-01-01', '%Y-%m-%d').date())
+        Reading.objects.create(meter=self.meter, reading=310,
+                               date=datetime.strptime('2018-02-01', '%Y-%m-%d').date())
+
+    def get_stream(self, **extra):
+        """
+        Get the event stream and return the content.
+        """
+        response = self.client.get(reverse('api_v1:events'), **extra)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_events_after_last_event_id(self):
+        """
+        A client with a Last-Event-ID gets the events after it.
+        """
+        content = self.get_stream(HTTP_LAST_EVENT_ID='0')
+        self.assertTrue(content.startswith('retry: '))
+        self.assertIn('event: usage\ndata: {{"meter":{m},"first":"2018-01","last":"2018-02"}}\n\n'.
+                      format(m=self.meter.id), content)
+        self.assertNotIn('event: reset', content)
+
+    def test_no_old_events_for_new_client(self):
+        """
+        A new client only gets the events that are logged after it connected.
+        """
+        content = self.get_stream()
+        self.assertNotIn('event: usage', content)
+        self.assertIn(':\n\n', content)
+
+    def test_reset_after_missed_events(self):
+        """
+        A client that missed events that are no longer in the log gets a reset event.
+        """
+        UsageEvent.objects.filter(id=UsageEvent.objects.order_by('id').first().id).delete()
+        content = self.get_stream(data={'last_event_id': 0})
+        self.assertIn('event: reset', content)
+
+    def test_single_poll_under_wsgi(self):
+        """
+        The WSGI response polls the event log once and ends, the browser reconnects after the retry
+        time, so a client does not hold a worker thread.
+        """
+        with mock.patch('api_v1.events.get_events', wraps=get_events) as get_events_mock:
+            content = self.get_stream(HTTP_LAST_EVENT_ID='0')
+        self.assertEqual(get_events_mock.call_count, 1)
+        self.assertTrue(content.startswith('retry: 1000\n\n'))
+        self.assertIn('event: usage', content)
+
+    def test_events_need_login(self):
+        """
+        The event stream is only available for logged in users.
+        """
+        response = Client().get(reverse('api_v1:events'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_event_stream_is_not_compressed(self):
+        """
+        The event stream is not compressed, the events are sent immediately.
+        """
+        response = self.client.get(reverse('api_v1:events'), HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+
+@override_settings(ROOT_URLCONF='home_dashboard.asgi_urls')
+class AsyncViewTests(TransactionTestCase):
+    """
+    Test the async views of the ASGI application. The views run in other threads, so the data is
+    committed.
+    """
+
+    # pylint: disable=invalid-name
+
+    def setUp(self):
+        """
+        Setup a logged in async client and a meter with readings.
+        """
+        self.user = User.objects.create_user('testuser', 'test@user.com', 'q2w3E$R%')
+        self.async_client = AsyncClient()
+        self.async_client.force_login(self.user)
+        client = Client()
+        client.force_login(self.user)
+        self.session_cookie = '{n}={v}'.format(
+            n=settings.SESSION_COOKIE_NAME,
+            v=client.cookies[settings.SESSION_COOKIE_NAME].value).encode('ascii')
+        self.meter = Meter.objects.create(meter_name='testmeter', meter_unit='X')
+        Reading.objects.create(meter=self.meter, reading=0,
+                               date=datetime.strptime('2018-01-01', '%Y-%m-%d').date())
+        Reading.objects.create(meter=self.meter, reading=310,
+                               date=datetime.strptime('2018-02-01', '%Y-%m-%d').date())
+
+    def test_api_urls_resolve_to_async_views(self):
+        """
+        The read-only API urls use the async views, the others the normal views.
+        """
+        self.assertTrue(asyncio.iscoroutinefunction(resolve('/api/v1/monthly_usage/').func))
+        self.assertTrue(asyncio.iscoroutinefunction(resolve('/api/v1/usage/').func))
+        self.assertTrue(asyncio.iscoroutinefunction(resolve('/api/v1/reading/1/').func))
+        self.assertFalse(asyncio.iscoroutinefunction(resolve('/api/v1/meter/').func))
+        self.assertFalse(asyncio.iscoroutinefunction(resolve('/utilities/graphs').func))
+
+    async def test_async_monthly_usage(self):
+        """
+        The monthly usage is served by the async view.
+        """
+        response = await self.async_client.get(
+            '/api/v1/monthly_usage/?meter={m}&year=2018'.format(m=self.meter.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['data'][0], '10.00')
+
+    async def test_async_lists_in_parallel(self):
+        """
+        Parallel requests of the async lists all get an answer.
+        """
+        responses = await asyncio.gather(*[self.async_client.get(url) for url in
+                                           ('/api/v1/usage/', '/api/v1/reading/',
+                                            '/api/v1/daily_usage/') * 3])
+        self.assertEqual([response.status_code for response in responses], [200] * 9)
+        self.assertEqual(json.loads(responses[0].content)['results'][0]['usage'], '310.00')
+
+    async def test_async_views_need_login(self):
+        """
+        The async views check the permissions like the normal views.
+        """
+        response = await AsyncClient().get('/api/v1/usage/')
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(EVENTS_STREAM_TIMEOUT=0)
+    async def test_async_event_stream(self):
+        """
+        The event stream is read asynchronously by the ASGI application.
+        """
+        parts = [part async for part in EventStreamResponse(0, check_missed=True).astream()]
+        self.assertTrue(parts[0].startswith(b'retry: '))
+        self.assertIn(b'event: usage', parts[1])
+
+    async def _call_application(self, path, query_string=b'', disconnect=False):
+        """
+        Send a GET request through the ASGI application, like an ASGI server does.
+
+        :param disconnect: let the client disconnect after the request
+        :return: list with the messages the application sent
+        """
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        messages = []
+        never = asyncio.Event()
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            if not disconnect:
+                await never.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                 'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+                 'query_string': query_string, 'root_path': '',
+                 'headers': [(b'host', b'testserver'), (b'cookie', self.session_cookie)],
+                 'client': ('127.0.0.1', 5000), 'server': ('testserver', 80)}
+        await asyncio.wait_for(application(scope, receive, send), timeout=10)
+        return messages
+
+    @override_settings(EVENTS_STREAM_TIMEOUT=0)
+    async def test_asgi_event_stream(self):
+        """
+        The ASGI application streams the events with astream and ends the response.
+        """
+        messages = await self._call_application('/api/v1/events/', b'last_event_id=0')
+        self.assertEqual(messages[0]['type'], 'http.response.start')
+        self.assertEqual(messages[0]['status'], 200)
+        headers = dict(messages[0]['headers'])
+        self.assertEqual(headers[b'Content-Type'], b'text/event-stream')
+        self.assertEqual(headers[b'X-Accel-Buffering'], b'no')
+        self.assertTrue(messages[1]['body'].startswith(b'retry: '))
+        self.assertIn(b'event: usage', messages[2]['body'])
+        self.assertEqual(messages[-1], {'type': 'http.response.body'})
+
+    @override_settings(EVENTS_STREAM_TIMEOUT=60, EVENTS_POLL_INTERVAL=30)
+    async def test_asgi_event_stream_stops_on_disconnect(self):
+        """
+        The event stream stops when the client disconnects, instead of polling until the timeout.
+        """
+        messages = await self._call_application('/api/v1/events/', disconnect=True)
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertLessEqual(len(messages), 4)
+
+    async def test_asgi_export(self):
+        """
+        The ASGI application iterates the export in the database threads.
+        """
+        messages = await self._call_application(
+            '/api/v1/reading/export/', 'meter={m}'.format(m=self.meter.id).encode('ascii'))
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(dict(messages[0]['headers'])[b'Content-Type'], b'text/csv')
+        content = b''.join(message.get('body', b'') for message in messages[1:]).decode('utf-8')
+        self.assertEqual(len(content.splitlines()), 3)
+        self.assertEqual(messages[-1], {'type': 'http.response.body'})
+
+    async def test_asgi_streamed_headers_and_cookies(self):
+        """
+        The headers and cookies of a streamed response are encoded like Django does.
+        """
+        response = StreamingHttpResponse(iter([b'a', b'b']), content_type='text/plain')
+        response['X-Test'] = 'caf\xe9'
+        response.set_cookie('name', 'value')
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await application.send_response(response, send)
+        self.assertIn((b'X-Test', 'caf\xe9'.encode('latin1')), messages[0]['headers'])
+        self.assertIn((b'Set-Cookie', b'name=value; Path=/'), messages[0]['headers'])
+        self.assertEqual([message.get('body') for message in messages[1:]], [b'a', b'b', None])
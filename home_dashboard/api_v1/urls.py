@@ -13,8 +13,10 @@ router = DefaultRouter() # pylint: disable=invalid-name
 router.register(r'meter', views.MeterViewSet)
 router.register(r'reading', views.ReadingViewSet)
 router.register(r'usage', views.UsageViewSet)
+router.register(r'daily_usage', views.DailyUsageViewSet)
 
 urlpatterns = [
     path('monthly_usage/', views.monthly_usage, name='monthly_usage'),
+    path('events/', views.events, name='events'),
     url(r'^', include(router.urls)),
 ]
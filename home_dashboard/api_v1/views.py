@@ -1,19 +1,306 @@
 """
 Provides the views for the REST interface.
 """
-from calendar import monthrange
+import csv
+from datetime import timedelta
+import hashlib
+from itertools import groupby
+import json
 
 from rest_framework import permissions, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from django_filters import rest_framework as filters
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 
-from utilities.models import Meter, Reading, Usage
-from utilities.serializers import MeterSerializer, ReadingSerializer, UsageSerializer
+from utilities.logic import calculate_usages_between, get_data_version, get_meter_readings, \
+    get_monthly_usage_series
+from utilities.meter_registry import get_meters
+from utilities.models import DailyUsage, Meter, Reading, Usage
+from utilities.serializers import DailyUsageSerializer, MeterSerializer, ReadingSerializer, \
+    UsageSerializer, compile_values_formatter
+from utilities.usage_cache import cached_usage_query
 
-from .filters import MeterFilter, ReadingFilter, UsageFilter
+from .events import EventStreamResponse, get_last_event_id
+from .filters import DailyUsageFilter, MeterFilter, ReadingFilter, UsageFilter
+from .pagination import KeysetPagination
+from .renderers import ColumnarRenderer
 
-class MeterViewSet(viewsets.ModelViewSet): # pylint: disable=too-many-ancestors
+
+def _usage_version(request):
+    """
+    Get the data version of the meter in the request (?meter=) or of all meters. The version is
+    stored on the request, so it is only queried once per request.
+    """
+    if not hasattr(request, 'usage_version'):
+        try:
+            meter_id = int(request.GET['meter'])
+        except (KeyError, ValueError):
+            meter_id = None
+        request.usage_version = get_data_version(meter_id)
+    return request.usage_version
+
+
+def _usage_etag(request, *args, **kwargs): # pylint: disable=unused-argument
+    """
+    The ETag of the usages: the data version combined with the url and the requested format.
+    """
+    key = '{v}|{p}|{a}'.format(v=_usage_version(request)[0],
+                               p=request.get_full_path(),
+                               a=request.META.get('HTTP_ACCEPT', ''))
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def _usage_last_modified(request, *args, **kwargs): # pylint: disable=unused-argument
+    """
+    The last time the usages were recalculated.
+    """
+    return _usage_version(request)[1]
+
+
+usage_condition = condition(etag_func=_usage_etag, # pylint: disable=invalid-name
+                            last_modified_func=_usage_last_modified)
+
+
+class ConditionalUsageMixin:
+    """
+    Answer conditional requests (If-None-Match / If-Modified-Since) with 304 Not Modified when the
+    usages did not change, without querying the usages.
+    """
+
+    @method_decorator(usage_condition)
+    def list(self, request, *args, **kwargs):
+        """
+        List the objects or return 304 Not Modified.
+        """
+        return super().list(request, *args, **kwargs)
+
+    @method_decorator(usage_condition)
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Get the object or return 304 Not Modified.
+        """
+        return super().retrieve(request, *args, **kwargs)
+
+
+class CachedUsageMixin:
+    """
+    Cache the listed usages per meter (?meter=), year (?year=), url and format. The entries are
+    keyed by the data versions of the meters, see utilities.usage_cache.
+    """
+
+    def list(self, request, *args, **kwargs):
+        """
+        List the objects from the cache.
+        """
+        try:
+            meter_ids = [int(request.query_params['meter'])]
+        except (KeyError, ValueError):
+            meter_ids = None
+        try:
+            years = [int(request.query_params['year'])]
+        except (KeyError, ValueError):
+            years = None
+        query_format = '{m}|{u}|{f}'.format(m=self.get_queryset().model._meta.model_name,
+                                            u=request.build_absolute_uri(),
+                                            f=request.accepted_renderer.format)
+        parent_list = super().list
+        data = cached_usage_query(meter_ids, years, query_format,
+                                  lambda: parent_list(request, *args, **kwargs).data)
+        return Response(data)
+
+
+class SparseFieldsQuerysetMixin:
+    """
+    Only load the model fields that are needed for the fields requested with ?fields= or ?omit=
+    (see utilities.serializers.SparseFieldsMixin).
+    """
+
+    def get_queryset(self):
+        """
+        Narrow the queryset to the requested fields when listing or retrieving.
+        """
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve'):
+            only = self.get_serializer_class().get_only_fields(self.request)
+            if only is not None:
+                # the keyset pagination needs the ordering fields of the last object
+                only.update(getattr(self, 'keyset_ordering', ()))
+                if not any(field.startswith('meter__') for field in only):
+                    queryset = queryset.select_related(None)
+                queryset = queryset.only(*only)
+        return queryset
+
+
+class FastListMixin:
+    """
+    List the objects from a values() queryset, formatted by a function compiled from the
+    serializer (see utilities.serializers.compile_values_formatter). The output is the same as
+    the output of the serializer, without building a model instance per row.
+    """
+    fast_list = True
+
+    def list(self, request, *args, **kwargs):
+        """
+        List the objects, using the fast path when the serializer supports it.
+        """
+        compiled = compile_values_formatter(self.get_serializer()) if self.fast_list else None
+        if compiled is None:
+            return super().list(request, *args, **kwargs)
+        (fields, format_row) = compiled
+
+        # the keyset pagination needs the ordering fields of the last row
+        fields = list(dict.fromkeys(fields + list(getattr(self, 'keyset_ordering', ()))))
+        queryset = self.filter_queryset(self.get_queryset()).\
+                       select_related(None).\
+                       values(*fields)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response([format_row(row) for row in page])
+        return Response([format_row(row) for row in queryset])
+
+
+class _EchoBuffer:
+    """
+    File-like object that returns what is written to it, so the csv writer can stream rows.
+    """
+
+    @staticmethod
+    def write(value):
+        """
+        Return the value instead of storing it.
+        """
+        return value
+
+
+class ExportMixin:
+    """
+    Add an export action that streams the (filtered) objects as CSV or NDJSON.
+
+    Use ?export_format=ndjson for newline delimited JSON, the default is CSV. The rows are read
+    with an iterator over the export_fields values, so the memory use does not depend on the
+    number of objects.
+    """
+    export_fields = ()
+    export_ordering = ()
+    export_chunk_size = 2000
+
+    @action(detail=False)
+    def export(self, request):
+        """
+        Stream all the objects that match the filters.
+        """
+        rows = self.filter_queryset(self.get_queryset()).\
+                   select_related(None).\
+                   order_by(*self.export_ordering).\
+                   values_list(*self.export_fields).\
+                   iterator(chunk_size=self.export_chunk_size)
+        name = self.get_queryset().model._meta.model_name
+        if request.query_params.get('export_format') == 'ndjson':
+            response = StreamingHttpResponse(self._ndjson_lines(rows),
+                                             content_type='application/x-ndjson')
+            response['Content-Disposition'] = 'attachment; filename="{n}.ndjson"'.format(n=name)
+        else:
+            response = StreamingHttpResponse(self._csv_lines(rows), content_type='text/csv')
+            response['Content-Disposition'] = 'attachment; filename="{n}.csv"'.format(n=name)
+        return response
+
+    def _csv_lines(self, rows):
+        """
+        Generate the CSV lines, starting with a header.
+        """
+        writer = csv.writer(_EchoBuffer())
+        yield writer.writerow(self.export_fields)
+        for row in rows:
+            yield writer.writerow(row)
+
+    def _ndjson_lines(self, rows):
+        """
+        Generate a JSON object per line.
+        """
+        for row in rows:
+            yield json.dumps(dict(zip(self.export_fields, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+class ColumnarMixin:
+    """
+    Render the list as one series per meter with ?format=columnar:
+    {meter, unit, dates: [...], values: [...]}.
+
+    The series contain all the objects that match the filters (no paging). With ?delta=1 the dates
+    are replaced by the first date (start) and the steps between the dates (deltas, in days for
+    dates and in months for months).
+    """
+    columnar_fields = ()
+
+    def get_renderers(self):
+        """
+        The default renderers plus the columnar renderer. The default renderers are resolved per
+        request, so they follow the settings (e.g. with or without MessagePack).
+        """
+        return [renderer() for renderer in api_settings.DEFAULT_RENDERER_CLASSES] + \
+            [ColumnarRenderer()]
+
+    def list(self, request, *args, **kwargs):
+        """
+        List the objects, as columns if requested.
+        """
+        if request.accepted_renderer.format != ColumnarRenderer.format:
+            return super().list(request, *args, **kwargs)
+
+        rows = self.filter_queryset(self.get_queryset()).\
+                   select_related(None).\
+                   order_by(*self.columnar_fields[:-1]).\
+                   values_list(*self.columnar_fields)
+        units = {meter.id: meter.meter_unit for meter in get_meters()}
+        delta = request.query_params.get('delta') in ('1', 'true')
+        series = []
+        for (meter_id, meter_rows) in groupby(rows, key=lambda row: row[0]):
+            keys = []
+            values = []
+            for row in meter_rows:
+                keys.append(row[1:-1])
+                values.append(row[-1])
+            data = {'meter': meter_id, 'unit': units.get(meter_id)}
+            if delta:
+                data['start'] = self._format_key(keys[0])
+                data['deltas'] = [0] + [self._steps(keys[i - 1], keys[i])
+                                        for i in range(1, len(keys))]
+            else:
+                data['dates'] = [self._format_key(key) for key in keys]
+            data['values'] = values
+            series.append(data)
+        return Response(series)
+
+    @staticmethod
+    def _format_key(key):
+        """
+        Format a date as YYYY-MM-DD or a (year, month) as YYYY-MM.
+        """
+        if len(key) == 1:
+            return key[0].isoformat()
+        return '{y:04d}-{m:02d}'.format(y=key[0], m=key[1])
+
+    @staticmethod
+    def _steps(key_1, key_2):
+        """
+        The number of days or months between two keys.
+        """
+        if len(key_1) == 1:
+            return (key_2[0] - key_1[0]).days
+        return (key_2[0] - key_1[0]) * 12 + key_2[1] - key_1[1]
+
+
+class MeterViewSet(SparseFieldsQuerysetMixin, viewsets.ModelViewSet):
+    # pylint: disable=too-many-ancestors
     """
     Viewset for the meter model. Provides all the standard functions and checks permissions.
     """
@@ -23,12 +310,53 @@ class MeterViewSet(viewsets.ModelViewSet): # pylint: disable=too-many-ancestors
     filter_backends = (filters.DjangoFilterBackend,)
     filter_class = MeterFilter
 
+    @action(detail=True)
+    def usage_between(self, request, pk=None): # pylint: disable=unused-argument
+        """
+        Get the usage of the meter between two days (both included), e.g.
+        ?start=2018-03-14&end=2018-06-02.
+
+        Several ranges are calculated at once by repeating start and end. The readings on the
+        boundaries are interpolated like the monthly usages, from the readings around the ranges
+        only. The usage is null when a range is not enclosed by readings.
+        """
+        meter = self.get_object()
+        starts = request.query_params.getlist('start')
+        ends = request.query_params.getlist('end')
+        if not starts or len(starts) != len(ends):
+            raise ValidationError('Provide a start and an end for every range.')
+        try:
+            ranges = [(parse_date(start), parse_date(end)) for (start, end) in zip(starts, ends)]
+        except ValueError:
+            ranges = [(None, None)]
+        if any(start is None or end is None for (start, end) in ranges):
+            raise ValidationError('The dates should be formatted as YYYY-MM-DD.')
+        if any(start > end for (start, end) in ranges):
+            raise ValidationError('The start of a range cannot be after the end.')
+
+        dates, values = get_meter_readings(meter.id,
+                                           min(start for (start, end) in ranges),
+                                           max(end for (start, end) in ranges) + timedelta(days=1))
+        usages = calculate_usages_between(dates, values, ranges)
+        return Response({'meter': meter.id,
+                         'unit': meter.meter_unit,
+                         'usages': [{'start': start, 'end': end, 'usage': usage}
+                                    for ((start, end), usage) in zip(ranges, usages)]})
+
 
-class ReadingViewSet(viewsets.ModelViewSet): # pylint: disable=too-many-ancestors
+class ReadingViewSet(SparseFieldsQuerysetMixin, ColumnarMixin, FastListMixin, ExportMixin,
+                     viewsets.ModelViewSet):
+    # pylint: disable=too-many-ancestors
     """
     Viewset for the Reading model. Provides all the standard functions and checks permissions. When
-    a new reading is added (or updated), the new usage is calculated.
+    a new reading is added (or updated), the new usage is calculated. The list is paginated on
+    meter and date.
     """
+    export_fields = ('id', 'date', 'reading', 'meter', 'remark')
+    export_ordering = ('meter', 'date')
+    columnar_fields = ('meter', 'date', 'reading')
+    keyset_ordering = ('meter', 'date')
+    pagination_class = KeysetPagination
     queryset = Reading.objects.all()
     serializer_class = ReadingSerializer
     permission_classes = [permissions.DjangoModelPermissions]
@@ -36,10 +364,18 @@ class ReadingViewSet(viewsets.ModelViewSet): # pylint: disable=too-many-ancestor
     filter_class = ReadingFilter
 
 
-class UsageViewSet(viewsets.ReadOnlyModelViewSet): # pylint: disable=too-many-ancestors
+class UsageViewSet(ConditionalUsageMixin, CachedUsageMixin, SparseFieldsQuerysetMixin,
+                   ColumnarMixin, FastListMixin, ExportMixin, viewsets.ReadOnlyModelViewSet):
+    # pylint: disable=too-many-ancestors
     """
-    Viewset for the usage model. Only readonly actions are provided.
+    Viewset for the usage model. Only readonly actions are provided. The list is paginated on
+    meter, year and month, cached and supports conditional requests.
     """
+    export_fields = ('id', 'year', 'month', 'meter', 'usage')
+    export_ordering = ('meter', 'period')
+    columnar_fields = ('meter', 'year', 'month', 'usage')
+    keyset_ordering = ('meter', 'period')
+    pagination_class = KeysetPagination
     queryset = Usage.objects.all()
     serializer_class = UsageSerializer
     permission_classes = [permissions.DjangoModelPermissions]
@@ -47,25 +383,110 @@ class UsageViewSet(viewsets.ReadOnlyModelViewSet): # pylint: disable=too-many-an
     filter_class = UsageFilter
 
 
+class DailyUsageViewSet(ConditionalUsageMixin, CachedUsageMixin, SparseFieldsQuerysetMixin,
+                        ColumnarMixin, FastListMixin, ExportMixin,
+                        viewsets.ReadOnlyModelViewSet):
+    # pylint: disable=too-many-ancestors
+    """
+    Viewset for the daily usage model. Only readonly actions are provided. Filter on a date range
+    with date__gte and date__lte. The list is cached and supports conditional requests.
+    """
+    export_fields = ('id', 'date', 'meter', 'usage')
+    export_ordering = ('meter', 'date')
+    columnar_fields = ('meter', 'date', 'usage')
+    queryset = DailyUsage.objects.order_by('meter', 'date')
+    serializer_class = DailyUsageSerializer
+    permission_classes = [permissions.DjangoModelPermissions]
+    filter_backends = (filters.DjangoFilterBackend,)
+    filter_class = DailyUsageFilter
+
+
+def _int_list(request, name):
+    """
+    Get a list of integers from a request parameter, given as repeated parameter and/or as comma
+    separated values (?meters=1,2&meters=3).
+
+    :raises ValueError: when a value is not an integer
+    """
+    return [int(value) for values in request.GET.getlist(name) for value in values.split(',')
+            if value]
+
+
+def _monthly_usage_years(request):
+    """
+    Get the years of the monthly usage request: ?years=2017,2018 or ?year_from=2017&year_to=2018.
+
+    :raises ValueError: when a year is not an integer, the range is reversed or it has more than
+        settings.MONTHLY_USAGE_MAX_YEARS years
+    """
+    if 'year_from' in request.GET:
+        year_from = int(request.GET['year_from'])
+        year_to = int(request.GET.get('year_to', year_from))
+        if year_to < year_from:
+            raise ValueError('year_to cannot be before year_from')
+        if year_to - year_from >= settings.MONTHLY_USAGE_MAX_YEARS:
+            raise ValueError('too many years')
+        return list(range(year_from, year_to + 1))
+    years = _int_list(request, 'years')
+    if len(years) > settings.MONTHLY_USAGE_MAX_YEARS:
+        raise ValueError('too many years')
+    return years
+
+
 @login_required
+@usage_condition
 def monthly_usage(request):
     """
-    Get a json with meter usages for the entire year for a specific meter.
+    Get a json with meter usages for the entire year for a specific meter. Supports conditional
+    requests (ETag / Last-Modified).
+
+    Several meters and years are fetched at once with ?meters=1,2&years=2017,2018 (or with
+    year_from and year_to instead of years). The response then contains all the series:
+    {'series': [{'meter': 1, 'label': 2017, 'data': [...]}, ...]}. All the usages are fetched with
+    one query and the series are cached. At most settings.MONTHLY_USAGE_MAX_YEARS years can be
+    requested at once.
 
     :param request: the http request
-    :return: json with the usages
+    :return: json with the usages or a bad request (400) for invalid parameters
     """
-    year = int(request.GET.get('year', -1))
-    meter = int(request.GET.get('meter', -1))
-    usages = Usage.objects.filter(meter__id=meter).filter(year=year)
-    data = []
-    for i in range(1, 12 + 1):
+    if 'meters' in request.GET:
         try:
-            usage = usages.get(month=i)
-        except Usage.DoesNotExist:
-            data.append(None)
-        else:
-            days_in_month = monthrange(year, i)[1]
-            data.append(usage.usage/days_in_month)
-    output = {'label': year, 'data': data}
+            meter_ids = _int_list(request, 'meters')
+            years = _monthly_usage_years(request)
+        except ValueError:
+            return JsonResponse({'error': 'Provide the meters and the years as integers, at most '
+                                          '{n} years.'.format(n=settings.MONTHLY_USAGE_MAX_YEARS)},
+                                status=400)
+        series = cached_usage_query(meter_ids, years, 'monthly_usage',
+                                    lambda: get_monthly_usage_series(meter_ids, years))
+        return JsonResponse({'series': series})
+
+    try:
+        year = int(request.GET.get('year', -1))
+        meter = int(request.GET.get('meter', -1))
+    except ValueError:
+        return JsonResponse({'error': 'Provide the meter and the year as integers.'}, status=400)
+    series = cached_usage_query([meter], [year], 'monthly_usage',
+                                lambda: get_monthly_usage_series([meter], [year]))[0]
+    output = {'label': year, 'data': series['data']}
     return JsonResponse(output)
+
+
+@login_required
+def events(request):
+    """
+    Stream the recalculated usages as Server-Sent Events, e.g. for an EventSource in the browser.
+
+    Every event names the meter and the first and last recalculated month:
+    event: usage, data: {"meter": 1, "first": "2018-01", "last": "2018-02"}. A client that
+    reconnects (with the Last-Event-ID header or ?last_event_id=) gets the events it missed, or a
+    reset event when they are no longer in the log.
+
+    :param request: the http request
+    :return: the event stream
+    """
+    last_event_id = request.META.get('HTTP_LAST_EVENT_ID', request.GET.get('last_event_id'))
+    try:
+        return EventStreamResponse(int(last_event_id), check_missed=True)
+    except (TypeError, ValueError):
+        return EventStreamResponse(get_last_event_id())
@@ -0,0 +1,98 @@
+"""
+ASGI config for home_dashboard project.
+
+It exposes the ASGI callable as a module-level variable named ``application``. The ASGI
+application serves the same urls as the WSGI application, with async versions of the read-only
+API views (see home_dashboard.asgi_urls), e.g. ``uvicorn home_dashboard.asgi:application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+import asyncio
+from contextvars import ContextVar
+import os
+
+from asgiref.sync import sync_to_async
+import django
+from django.core.handlers.asgi import ASGIHandler
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "home_dashboard.settings")
+django.setup(set_prefix=False)
+
+# the receive channel of the current request, to notice that the client disconnects
+_RECEIVE = ContextVar('receive')
+
+
+class AsyncViewsASGIHandler(ASGIHandler):
+    """
+    ASGI handler that resolves the requests with the async url configuration.
+
+    The streamed responses are not iterated in the event loop: responses with an astream method
+    (like the event stream) are streamed asynchronously, the iterators of the other streamed
+    responses (like the exports, that query the database) run in the database thread pool. An
+    asynchronous stream stops when the client disconnects.
+    """
+    urlconf = 'home_dashboard.asgi_urls'
+
+    async def __call__(self, scope, receive, send):
+        _RECEIVE.set(receive)
+        await super().__call__(scope, receive, send)
+
+    def create_request(self, scope, body_file):
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None:
+            request.urlconf = self.urlconf
+        return request, error_response
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            await super().send_response(response, send)
+            return
+
+        response_headers = []
+        for header, value in response.items():
+            response_headers.append((header.encode('ascii'), value.encode('latin1')))
+        for cookie in response.cookies.values():
+            response_headers.append(
+                (b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        await send({'type': 'http.response.start',
+                    'status': response.status_code,
+                    'headers': response_headers})
+        if hasattr(response, 'astream'):
+            disconnected = asyncio.Event()
+            watcher = asyncio.ensure_future(self._watch_disconnect(_RECEIVE.get(None),
+                                                                   disconnected))
+            try:
+                async for part in response.astream(disconnected):
+                    await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+            finally:
+                watcher.cancel()
+        else:
+            # pylint: disable=import-outside-toplevel
+            from api_v1.async_views import db_sync_to_async
+            next_part = db_sync_to_async(next)
+            parts = iter(response)
+            part = await next_part(parts, None)
+            while part is not None:
+                await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+                part = await next_part(parts, None)
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+    @staticmethod
+    async def _watch_disconnect(receive, disconnected):
+        """
+        Set the disconnected event when the client disconnects.
+
+        :param receive: the receive channel of the request (the request body is already read)
+        :param disconnected: the asyncio.Event to set
+        """
+        if receive is None:
+            return
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+
+application = AsyncViewsASGIHandler() # pylint: disable=invalid-name
@@ -0,0 +1,11 @@
+"""
+The URL configuration of the ASGI application: the same as home_dashboard.urls, but with the
+async views of the REST interface (see api_v1.async_urls).
+"""
+from django.urls import URLResolver, include, path
+
+from . import urls
+
+urlpatterns = [path('api/v1/', include('api_v1.async_urls'))] + \
+              [pattern for pattern in urls.urlpatterns
+               if not (isinstance(pattern, URLResolver) and pattern.namespace == 'api_v1')]
@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
+import importlib.util
 import os
+from urllib.request import pathname2url
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -46,6 +48,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'api_v1.middleware.APICompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -67,6 +70,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'utilities.context_processors.fragment_cache',
             ],
         },
     },
@@ -93,6 +97,11 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10
 }
 
+# MessagePack is optional: only offered when the msgpack package is installed
+if importlib.util.find_spec('msgpack') is not None:
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'].append('api_v1.parsers.MessagePackParser')
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].append('api_v1.renderers.MessagePackRenderer')
+
 WSGI_APPLICATION = 'home_dashboard.wsgi.application'
 
 
@@ -103,7 +112,36 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        # keep the connections open between the requests (in seconds)
+        'CONN_MAX_AGE': 600,
+    },
+    # the same file, opened read-only for the reads (see utilities.routers); point it at a replica
+    # to move the reads off the database of the writes
+    'readonly': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'file:{p}?mode=ro'.format(p=pathname2url(os.path.join(BASE_DIR, 'db.sqlite3'))),
+        'CONN_MAX_AGE': 600,
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
+}
+
+DATABASE_ROUTERS = ['utilities.routers.ReadWriteRouter']
+# The database alias the router sends the reads to
+DATABASE_READ_ALIAS = 'readonly'
+
+# The pragmas of every new SQLite connection (see utilities.sqlite), the journal mode is stored in
+# the database and set by ./manage.py db_maintenance. WAL lets the readers and the writer work at
+# the same time; synchronous NORMAL is safe with WAL (only the last transactions can be lost on a
+# power failure). busy_timeout is in ms, mmap_size in bytes and cache_size in KiB when negative.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 64 * 1024 * 1024,
+    'cache_size': -16000,
+    'temp_store': 'MEMORY',
 }
 
 
@@ -152,6 +190,45 @@ LOGIN_REDIRECT_URL = '/dashboard'
 
 ##PROJECT SPECIFIC
 PAGE_SIZE = 10
+# The maximum page size clients can ask for with ?page_size= on the keyset paginated API lists
+API_MAX_PAGE_SIZE = 1000
+# The maximum number of years the monthly usage API returns at once
+MONTHLY_USAGE_MAX_YEARS = 50
+# Recalculate the usages in the background: the reading signals only queue the dirty months and
+# ``manage.py run_usage_worker`` processes the queue.
+USAGE_RECALCULATION_QUEUE = False
+# The cache (alias in CACHES) for the usage queries and the counts of the list pages and how long
+# (in seconds) the results are kept. The entries are keyed by the data versions of the meters in
+# the database, so every process sees the changes; a shared cache (e.g.
+# 'django.core.cache.backends.filebased.FileBasedCache' with a LOCATION directory) lets the
+# processes share the entries as well.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'usage': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'usage',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+}
+USAGE_CACHE = 'usage'
+USAGE_CACHE_TIMEOUT = 60 * 60
+# The processes check every METER_REGISTRY_CHECK_INTERVAL seconds (in the database) if another
+# process changed a meter, see utilities.meter_registry
+METER_REGISTRY_CHECK_INTERVAL = 1
+# How long (in seconds) the meter buttons are kept in the template fragment cache
+FRAGMENT_CACHE_TIMEOUT = 60 * 60
+# The number of threads that run the async API views (and their queries) of the ASGI application
+ASYNC_DB_THREADS = 4
+# The event stream (api/v1/events/) checks for new events every EVENTS_POLL_INTERVAL seconds, under
+# ASGI it closes after EVENTS_STREAM_TIMEOUT seconds (the browser reconnects), under WSGI after one
+# check. The last USAGE_EVENTS_KEPT events are kept.
+EVENTS_POLL_INTERVAL = 1
+EVENTS_STREAM_TIMEOUT = 60
+USAGE_EVENTS_KEPT = 1000
+# The API responses from this size (in bytes) are compressed (gzip, or brotli when installed)
+API_COMPRESSION_MIN_SIZE = 1024
 VERSION = '0.7.1-6-ge79e380'
 LOGGING = {
     'version': 1,
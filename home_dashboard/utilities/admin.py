@@ -3,8 +3,10 @@ Register models for admin pages.
 """
 from django.contrib import admin
 
-from .models import Meter, Reading, Usage
+from .models import DailyUsage, Meter, Reading, Usage, UsageJob
 
 admin.site.register(Meter)
 admin.site.register(Reading)
 admin.site.register(Usage)
+admin.site.register(DailyUsage)
+admin.site.register(UsageJob)
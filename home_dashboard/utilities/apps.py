@@ -13,11 +13,21 @@ class UtilitiesConfig(AppConfig):
         """
         Called when loading the app and performs additional setup to register signals.
 
-        When a reading is saved: calculate the new usage.
+        When a reading is saved: calculate the new usage. When a usage is saved: set its period.
+        When a meter is saved: bump its data version. Also registers the system check of the query
+        plans and configures the new SQLite connections.
         """
+        from django.db.backends.signals import connection_created
         from django.db.models.signals import post_save, post_delete, pre_save
-        from .signals import reading_saved, reading_deleted, reading_changed_meter
-        from .models import Reading
+        from .signals import meter_changed, reading_saved, reading_deleted, reading_about_to_save, \
+            usage_about_to_save
+        from .models import Meter, Reading, Usage
+        from .sqlite import configure_connection
+        from . import checks # pylint: disable=unused-import
         post_save.connect(reading_saved, sender=Reading)
         post_delete.connect(reading_deleted, sender=Reading)
-        pre_save.connect(reading_changed_meter, sender=Reading)
+        pre_save.connect(reading_about_to_save, sender=Reading)
+        pre_save.connect(usage_about_to_save, sender=Usage)
+        post_save.connect(meter_changed, sender=Meter)
+        post_delete.connect(meter_changed, sender=Meter)
+        connection_created.connect(configure_connection)
@@ -0,0 +1,123 @@
+"""
+System check that the hot queries use the indexes: ``./manage.py check --database default``.
+
+The query plans are only checked on SQLite (with EXPLAIN QUERY PLAN). A hot query should search or
+walk an index, not scan the whole table or sort all the rows.
+"""
+from datetime import date
+import re
+
+from django.conf import settings
+from django.core.checks import Tags, Warning, register # pylint: disable=redefined-builtin
+from django.db import connections
+from django.db.models import CharField, DateField
+
+from .list_query import keyset_filter
+from .models import DailyUsage, Meter, Reading, Usage, UsageEvent
+from .views import METER_SORT_KEYS, READING_SORT_KEYS, USAGE_SORT_KEYS
+
+re_full_scan = re.compile(r'\bSCAN (TABLE )?\w+$|USE TEMP B-TREE') # pylint: disable=invalid-name
+
+# The sort keys of the list pages that sort the rows without an index, so they are not checked.
+# The meter name and unit are columns of the joined meter table, which no index of the readings
+# or usages can order on; an index on the reading or usage values (or the unit of the few meters)
+# would slow down every write of the readings and the recalculated usages for a rarely used sort.
+UNINDEXED_SORT_KEYS = {'reading', 'usage', 'meter_unit', 'meter__meter_name', 'meter__meter_unit'}
+
+
+def _get_list_queries(name, queryset, sort_keys, day):
+    """
+    Get the query of a list page for every sort key, except UNINDEXED_SORT_KEYS: the page after a
+    cursor. It needs the same index for the ordering as the first page, which in the order of the
+    id scans the table (in the order of the primary key) up to the size of the page.
+
+    :param name: the name of the list
+    :param queryset: the rows of the list
+    :param sort_keys: dict with the sort keys (?sort_by=) and their ordering fields
+    :param day: the date to use in the cursors
+    :return: dict with the name and the queryset of every query
+    """
+    page_size = settings.PAGE_SIZE + 1
+    queries = {}
+    for (sort_key, fields) in sort_keys.items():
+        if sort_key in UNINDEXED_SORT_KEYS:
+            continue
+        ordering = list(fields)
+        if 'id' not in ordering:
+            ordering.append('id')
+        position = []
+        for field_name in ordering:
+            field = queryset.model._meta.get_field(field_name)
+            position.append(day if isinstance(field, DateField) else
+                            '' if isinstance(field, CharField) else 1)
+        queries['{n} by {k}'.format(n=name, k=sort_key)] = \
+            queryset.filter(keyset_filter(ordering, position)).order_by(*ordering)[:page_size]
+    return queries
+
+
+def get_hot_queries():
+    """
+    Get the hot queries: the usage recalculation, the usage series, the list pages (for every
+    indexed sort key) and the API pages and the event stream.
+
+    :return: dict with the name and the queryset of every hot query
+    """
+    day = date(2018, 1, 1)
+    period = day.year * 12 + day.month
+    page_size = settings.PAGE_SIZE + 1
+    queries = {
+        'meter readings': Reading.objects.filter(meter_id=1, date__gte=day, date__lte=day).
+                          order_by('date'),
+        'reading before a day': Reading.objects.filter(meter_id=1, date__lte=day).
+                                order_by('-date')[:1],
+        'usage months': Usage.objects.filter(meter_id=1, period__gte=period, period__lte=period),
+        'usage series': Usage.objects.filter(meter_id__in=[1, 2], year__in=[2017, 2018]),
+        'daily usages': DailyUsage.objects.filter(meter_id=1, date__gte=day, date__lte=day).
+                        order_by('date'),
+        'reading API page': Reading.objects.filter(keyset_filter(['meter', 'date'], [1, day])).
+                            order_by('meter', 'date')[:page_size],
+        'usage API page': Usage.objects.filter(keyset_filter(['meter', 'period'], [1, period])).
+                          order_by('meter', 'period')[:page_size],
+        'usage events': UsageEvent.objects.filter(id__gt=1).order_by('id'),
+    }
+    for (name, queryset, sort_keys) in (
+            ('meter list', Meter.objects.all(), METER_SORT_KEYS),
+            ('reading list', Reading.objects.all(), READING_SORT_KEYS),
+            ('reading list of a meter', Reading.objects.filter(meter_id=1), READING_SORT_KEYS),
+            ('usage list', Usage.objects.all(), USAGE_SORT_KEYS),
+            ('usage list of a meter', Usage.objects.filter(meter_id=1), USAGE_SORT_KEYS)):
+        queries.update(_get_list_queries(name, queryset, sort_keys, day))
+    return queries
+
+
+def get_full_scans(queryset, using='default'):
+    """
+    Get the steps of the query plan that scan a whole table or sort all the rows.
+
+    :param queryset: the query
+    :param using: the alias of the (SQLite) database
+    :return: list with the steps of the plan
+    """
+    plan = queryset.using(using).explain()
+    return [line for line in plan.splitlines() if re_full_scan.search(line)]
+
+
+@register(Tags.database)
+def check_hot_query_plans(app_configs, databases=None, **kwargs): # pylint: disable=unused-argument
+    """
+    Warn for the hot queries that do a full table scan.
+    """
+    warnings = []
+    for alias in databases or []:
+        if connections[alias].vendor != 'sqlite':
+            continue
+        for (name, queryset) in get_hot_queries().items():
+            scans = get_full_scans(queryset, alias)
+            if scans:
+                warnings.append(Warning(
+                    'The {n} query does a full table scan on database {a}: {s}'.format(
+                        n=name, a=alias, s='; '.join(scans)),
+                    hint='Run ./manage.py migrate to add the indexes.',
+                    obj=queryset.model,
+                    id='utilities.W001'))
+    return warnings
@@ -0,0 +1,11 @@
+"""
+Template context processors of the utilities app.
+"""
+from django.conf import settings
+
+
+def fragment_cache(request): # pylint: disable=unused-argument
+    """
+    Add the timeout of the cached template fragments (the meter buttons) to the context.
+    """
+    return {'fragment_cache_timeout': settings.FRAGMENT_CACHE_TIMEOUT}
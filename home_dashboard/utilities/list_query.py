@@ -0,0 +1,273 @@
+"""
+The sorting and paging of the list pages (meters, readings and usages).
+
+The pages are keyset paginated on the active sort key: the next page starts after the last row of
+the current page, so every page is an index range scan without OFFSET and a deep page costs the
+same as the first page. The total count (for the number of pages) is cached per model and meter
+and keyed by the data versions of the meters, so a change makes it unreachable in every process.
+"""
+from base64 import b64decode, b64encode
+import binascii
+from functools import reduce
+import json
+import logging
+import operator
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+from .usage_cache import get_data_versions
+
+LOGGER = logging.getLogger('home_dashboard_log')
+
+_COUNT_KEY = 'list-count:{label}:{scope}:{versions}'
+
+
+def encode_cursor(values):
+    """
+    Encode the values of the ordering fields of a row as a cursor for the url.
+    """
+    return b64encode(json.dumps([str(value) for value in values]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(encoded, fields):
+    """
+    Decode a cursor made by encode_cursor.
+
+    :param encoded: the cursor
+    :param fields: the ordering fields (model fields)
+    :return: list with the values of the fields
+    :raises ValueError: when the cursor is invalid
+    """
+    try:
+        values = json.loads(b64decode(encoded.encode('ascii')).decode('utf-8'))
+        if len(values) != len(fields):
+            raise ValueError('Cursor does not match the ordering')
+        return [field.to_python(value) for (field, value) in zip(fields, values)]
+    except (TypeError, UnicodeError, binascii.Error, ValidationError) as error:
+        raise ValueError('Invalid cursor') from error
+
+
+def keyset_filter(ordering, position, descending=False):
+    """
+    Filter for the rows after the position in the ordering: (a, b) > (x, y) as
+    (a > x) or (a = x and b > y), or with < when descending.
+
+    :param ordering: list with the names of the ordering fields
+    :param position: list with the values of the ordering fields
+    :param descending: True for the rows after the position in a descending ordering
+    """
+    lookup = '__lt' if descending else '__gt'
+    conditions = []
+    for i, name in enumerate(ordering):
+        equal = {ordering[j]: position[j] for j in range(i)}
+        equal[name + lookup] = position[i]
+        conditions.append(Q(**equal))
+    return reduce(operator.or_, conditions)
+
+
+def _count_key(model, meter_id):
+    """
+    Get the cache key of the count of a model, for a meter or for all rows.
+    """
+    return _COUNT_KEY.format(label=model._meta.label_lower,
+                             scope='all' if meter_id is None else meter_id,
+                             versions=get_data_versions(None if meter_id is None else [meter_id]))
+
+
+def cached_count(queryset, meter_id=None):
+    """
+    Count the rows of a list from the cache (settings.USAGE_CACHE) or the database.
+
+    :param queryset: the queryset of the list, for all rows or filtered on the meter
+    :param meter_id: the meter the queryset is filtered on or None
+    :return: the number of rows
+    """
+    cache = caches[settings.USAGE_CACHE]
+    key = _count_key(queryset.model, meter_id)
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout=settings.USAGE_CACHE_TIMEOUT)
+    return count
+
+
+def _resolve_field(model, path):
+    """
+    Get the model field of a (related) field name, e.g. meter__meter_name.
+    """
+    *relations, name = path.split('__')
+    for relation in relations:
+        model = model._meta.get_field(relation).related_model
+    return model._meta.get_field(name)
+
+
+def _row_value(row, path):
+    """
+    Get the value of a (related) field name of a row, e.g. meter__meter_name.
+    """
+    for name in path.split('__'):
+        row = getattr(row, name)
+    return row
+
+
+class KeysetPage:
+    """
+    A page of a list, with the query strings of the links to the other pages.
+
+    Behaves like a (sliced) list of the rows for the templates.
+    """
+
+    def __init__(self, rows, number, count, has_previous, has_next):
+        self.object_list = rows
+        self.number = number
+        self.count = count
+        self.num_pages = max(1, -(-count // settings.PAGE_SIZE))
+        self.has_previous = has_previous
+        self.has_next = has_next
+        self.first_query = None
+        self.previous_query = None
+        self.next_query = None
+        self.last_query = None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __repr__(self):
+        return '<Page {n} of {p}>'.format(n=self.number, p=self.num_pages)
+
+    @property
+    def has_other_pages(self):
+        """
+        Is there more than one page.
+        """
+        return self.has_previous or self.has_next
+
+
+class ListQuery:
+    """
+    The sorted and keyset paginated list of a list page.
+
+    The sort key is remembered in the session: requesting the same ?sort_by= again reverses the
+    order. The rows with equal sort values are ordered on their id, so the ordering is unique.
+    """
+
+    def __init__(self, queryset, session_key, sort_keys, meter_id=None):
+        """
+        :param queryset: the rows of the list
+        :param session_key: the session key to remember the sort key with
+        :param sort_keys: dict with the sort keys (?sort_by=) and their ordering fields
+        :param meter_id: the meter the queryset is filtered on, for the cached count
+        """
+        self.queryset = queryset
+        self.session_key = session_key
+        self.sort_keys = sort_keys
+        self.meter_id = meter_id
+
+    def get_sort_key(self, request):
+        """
+        Get the sort key from the request or the session and remember it in the session.
+        """
+        sort_key = request.session.get(self.session_key)
+        sort_key_request = request.GET.get('sort_by')
+        if sort_key_request is not None:
+            sort_key = sort_key_request if sort_key != sort_key_request else '-' + sort_key_request
+        if not sort_key or sort_key.lstrip('-') not in self.sort_keys:
+            sort_key = 'id'
+        request.session[self.session_key] = sort_key
+        return sort_key
+
+    def get_page(self, request):
+        """
+        Get the requested page: the first page, the page after (?after=) or before (?before=) a
+        cursor, or the last page (?page= with the number of the last page).
+
+        :param request: the user http request
+        :return: the KeysetPage
+        """
+        sort_key = self.get_sort_key(request)
+        descending = sort_key.startswith('-')
+        ordering = list(self.sort_keys[sort_key.lstrip('-')])
+        if 'id' not in ordering:
+            ordering.append('id')
+        fields = [_resolve_field(self.queryset.model, name) for name in ordering]
+        forward = ['-' + name if descending else name for name in ordering]
+        backward = [name if descending else '-' + name for name in ordering]
+
+        count = cached_count(self.queryset, self.meter_id)
+        page_size = settings.PAGE_SIZE
+        num_pages = max(1, -(-count // page_size))
+        try:
+            number = min(max(int(request.GET.get('page', 1)), 1), num_pages)
+        except ValueError:
+            number = 1
+        try:
+            after = decode_cursor(request.GET['after'], fields) if 'after' in request.GET else None
+            before = decode_cursor(request.GET['before'], fields) \
+                if 'before' in request.GET else None
+        except ValueError:
+            LOGGER.warning('Invalid cursor for the list page, showing the first page.')
+            (after, before, number) = (None, None, 1)
+
+        if after is not None:
+            rows = list(self.queryset.filter(keyset_filter(ordering, after, descending))
+                        .order_by(*forward)[:page_size + 1])
+            (has_previous, has_next) = (True, len(rows) > page_size)
+            rows = rows[:page_size]
+        elif before is not None:
+            rows = list(self.queryset.filter(keyset_filter(ordering, before, not descending))
+                        .order_by(*backward)[:page_size + 1])
+            (has_previous, has_next) = (len(rows) > page_size, True)
+            rows = rows[:page_size][::-1]
+        elif number == num_pages > 1:
+            # the last page holds the rest of the rows, so its previous pages line up with the
+            # pages from the start
+            rows = list(self.queryset.order_by(*backward)[:count - (num_pages - 1) * page_size])
+            rows = rows[::-1]
+            (has_previous, has_next) = (True, False)
+        else:
+            rows = []
+        if not rows:
+            # the first page, also when the rows around the cursor are gone
+            rows = list(self.queryset.order_by(*forward)[:page_size + 1])
+            (has_previous, has_next) = (False, len(rows) > page_size)
+            rows = rows[:page_size]
+
+        if not has_previous:
+            number = 1
+        elif not has_next:
+            number = num_pages
+        page = KeysetPage(rows, number, count, has_previous, has_next)
+        self._add_links(page, request, ordering)
+        return page
+
+    @staticmethod
+    def _add_links(page, request, ordering):
+        """
+        Add the query strings of the links to the first, previous, next and last page.
+
+        The other parameters of the request (like the meter) are kept, the sort key is not: it is
+        remembered in the session.
+        """
+        def query(**params):
+            query_dict = request.GET.copy()
+            for name in ('sort_by', 'after', 'before', 'page'):
+                query_dict.pop(name, None)
+            query_dict.update(params)
+            return query_dict.urlencode()
+
+        if page.has_previous:
+            page.first_query = query()
+            page.previous_query = query(
+                before=encode_cursor([_row_value(page.object_list[0], name) for name in ordering]),
+                page=page.number - 1)
+        if page.has_next:
+            page.next_query = query(
+                after=encode_cursor([_row_value(page.object_list[-1], name) for name in ordering]),
+                page=page.number + 1)
+            page.last_query = query(page=page.num_pages)
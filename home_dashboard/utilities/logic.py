@@ -1,77 +1,540 @@
 """
 Business logic for the utilities app.
 """
-from datetime import date
+from bisect import bisect_left, bisect_right
+from calendar import monthrange
+from contextlib import contextmanager
+from datetime import date, timedelta
+from itertools import groupby
 import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, DateField, F, Max, Min, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # pylint: disable=invalid-name
 
 from utilities.exceptions import MeterError
-from utilities.models import Usage, Reading
+from utilities.models import DailyUsage, Meter, Usage, UsageEvent, UsageJob, Reading
 
 LOGGER = logging.getLogger('home_dashboard_log')
 
+# the readings changed within deferred_usage_recalculation (per thread)
+_DEFERRED = threading.local()
+
 
-def update_usage_after_new_reading(reading): #pylint: disable=too-many-locals
+def update_usage_after_new_reading(reading):
     """
     A new reading is inserted, so try and calculate the new montly usage.
+
+    Also used after a reading is changed or deleted. Only the months that depend on the reading
+    are recalculated (see get_dirty_months). The readings are read within the transaction of the
+    recalculation, so from the default database (see utilities.routers) and never from a replica
+    that lags behind.
     """
-    LOGGER.debug('Going to update the useage with reading: %s.', reading)
-    last_reading_before = get_readings_before_or_after(reading.date, reading.meter, 'before')
-    last_reading_before = last_reading_before if last_reading_before else reading
-    first_reading_after = get_readings_before_or_after(reading.date, reading.meter, 'after')
-    first_reading_after = first_reading_after if first_reading_after else reading
+    LOGGER.debug('Going to update the useage of meter %s with reading on %s.',
+                 reading.meter_id, reading.date)
+    with transaction.atomic():
+        dates, values = get_meter_readings(reading.meter_id)
+        dirty_months = get_dirty_months(dates, reading.date)
+        update_usages(reading.meter_id, dirty_months[0], dirty_months[1], dates, values)
+
 
-    month_before = last_reading_before.date.month
-    year_before = last_reading_before.date.year
-    month_after = first_reading_after.date.month
-    year_after = first_reading_after.date.year
+def update_usages(meter_id, first_period, last_period, dates=None, values=None):
+    """
+    Rewrite the monthly and daily usages of a meter for the months first_period up to and
+    including last_period.
+
+    All the readings of the meter are loaded once and the usages are calculated in memory, so the
+    number of queries does not depend on the number of months.
+
+    :param meter_id: the id of the meter
+    :param first_period: period key (see period_key) of the first month to rewrite
+    :param last_period: period key of the last month to rewrite
+    :param dates: the sorted reading dates of the meter, loaded when not supplied
+    :param values: the reading values matching the dates
+    """
+    if dates is None:
+        dates, values = get_meter_readings(meter_id)
 
     #clean up
-    Usage.objects.filter(year__gte=year_before, month__gte=month_before).\
-        filter(year__lte=year_after, month__lte=month_after).\
-        filter(meter=reading.meter).\
+    Usage.objects.filter(meter_id=meter_id, period__gte=first_period, period__lte=last_period).\
         delete()
 
     #calculate new usages
-    for year in range(year_before, year_after+1):
-        for month in range(1, 12+1):
-            if year == year_before and month < month_before:
-                pass
-            elif year == year_after and month > month_after:
-                pass
-            else:
-                month_date_1 = date(year, month, 1)
-                if month == 12:
-                    month_date_31 = date(year+1, 1, 1)
-                else:
-                    month_date_31 = date(year, month+1, 1)
-
-                try:
-                    r_before1 = Reading.objects.filter(meter=reading.meter).\
-                                    filter(date__lte=month_date_1).\
-                                    order_by('-date')[0]
-                    r_after1 = Reading.objects.filter(meter=reading.meter).\
-                                    filter(date__gt=month_date_1).\
-                                    order_by('date')[0]
-                    r_before31 = Reading.objects.filter(meter=reading.meter).\
-                                    filter(date__lt=month_date_31).\
-                                    order_by('-date')[0]
-                    r_after31 = Reading.objects.filter(meter=reading.meter).\
-                                    filter(date__gte=month_date_31).\
-                                    order_by('date')[0]
-                except IndexError:
-                    LOGGER.warning('Could not calculate the usage for meter %s , '
-                                   '%s-%s', reading.meter, year, month)
-                else:
-                    first_of_month = calculate_reading_on_date(month_date_1, r_before1, r_after1)
-                    last_of_month = calculate_reading_on_date(month_date_31, r_before31, r_after31)
-
-                    use = last_of_month - first_of_month
-                    usage = Usage.objects.create(meter=reading.meter,
-                                                 month=month,
-                                                 year=year,
-                                                 usage=use)
-                    usage.save()
-                    LOGGER.debug('Caculated new useage: %s', usage)
+    usages = [Usage(meter_id=meter_id, month=month, year=year, usage=use)
+              for (year, month, use) in calculate_monthly_usages(dates,
+                                                                 values,
+                                                                 first_period,
+                                                                 last_period)]
+    Usage.objects.bulk_create(usages)
+    LOGGER.debug('Caculated %s new useages for meter %s', len(usages), meter_id)
+
+    (first_year, first_month) = period_to_year_month(first_period)
+    (next_year, next_month) = period_to_year_month(last_period + 1)
+    first_day = date(first_year, first_month, 1)
+    last_day = date(next_year, next_month, 1) - timedelta(days=1)
+    DailyUsage.objects.filter(meter_id=meter_id, date__gte=first_day, date__lte=last_day).delete()
+    daily_usages = [DailyUsage(meter_id=meter_id, date=day, usage=use)
+                    for (day, use) in calculate_daily_usages(dates, values, first_day, last_day)]
+    DailyUsage.objects.bulk_create(daily_usages)
+
+    bump_data_version(meter_id)
+    record_usage_event(meter_id, first_period, last_period)
+
+
+def bump_data_version(meter_id):
+    """
+    Mark the data (readings, usages or the meter itself) of a meter as changed.
+
+    The ETags of the usages, the cached usage queries and the cached list counts are keyed by the
+    data version, so every process sees the change.
+
+    :param meter_id: the id of the meter
+    """
+    Meter.objects.filter(pk=meter_id).update(data_version=F('data_version') + 1,
+                                             data_modified=timezone.now())
+
+
+def record_usage_event(meter_id, first_period, last_period):
+    """
+    Log that the usages of a meter were recalculated, for the event stream (see api_v1.events).
+
+    Only the last settings.USAGE_EVENTS_KEPT events are kept: the older events are removed once
+    every settings.USAGE_EVENTS_KEPT events.
+
+    :param meter_id: the id of the meter
+    :param first_period: period key of the first recalculated month
+    :param last_period: period key of the last recalculated month
+    """
+    event = UsageEvent.objects.create(meter_id=meter_id,
+                                      first_period=first_period,
+                                      last_period=last_period)
+    if event.id % settings.USAGE_EVENTS_KEPT == 0:
+        UsageEvent.objects.filter(id__lte=event.id - settings.USAGE_EVENTS_KEPT).delete()
+
+
+def rebuild_usages(meter_id):
+    """
+    Recalculate all the monthly and daily usages of a meter, in one transaction (which also reads
+    the readings from the default database). The data version of the meter is bumped, so the
+    cached usage queries and list counts of the meter are outdated.
+
+    :param meter_id: the id of the meter
+    """
+    with transaction.atomic():
+        dates, values = get_meter_readings(meter_id)
+        Usage.objects.filter(meter_id=meter_id).delete()
+        DailyUsage.objects.filter(meter_id=meter_id).delete()
+        if dates:
+            update_usages(meter_id,
+                          period_key(dates[0].year, dates[0].month),
+                          period_key(dates[-1].year, dates[-1].month),
+                          dates,
+                          values)
+        else:
+            # the usages are only removed, the cached usage queries and counts are outdated too
+            bump_data_version(meter_id)
+
+
+def schedule_usage_update(reading):
+    """
+    Recalculate the usages that depend on the (inserted, changed or deleted) reading.
+
+    When settings.USAGE_RECALCULATION_QUEUE is on, the dirty months are only stored as a UsageJob
+    and the run_usage_worker command does the recalculation, so the request returns immediately.
+    Within deferred_usage_recalculation the reading is only remembered.
+    """
+    deferred = getattr(_DEFERRED, 'readings', None)
+    if deferred is not None:
+        deferred.setdefault(reading.meter_id, set()).add(reading.date)
+        return
+
+    if not getattr(settings, 'USAGE_RECALCULATION_QUEUE', False):
+        update_usage_after_new_reading(reading)
+        return
+
+    with transaction.atomic():
+        # the neighbouring readings are enough to find the dirty months; read them from the
+        # default database, they include the reading that was just written
+        neighbours = [get_readings_before_or_after(reading.date, reading.meter_id, before_after)
+                      for before_after in ('before', 'after')]
+        dirty_months = get_dirty_months([n.date for n in neighbours if n], reading.date)
+        job = UsageJob.objects.create(meter_id=reading.meter_id,
+                                      first_period=dirty_months[0],
+                                      last_period=dirty_months[1])
+        # the usages follow when the job is processed, the readings changed now
+        bump_data_version(reading.meter_id)
+    LOGGER.debug('Queued %r', job)
+
+
+def process_usage_jobs():
+    """
+    Recalculate the usages for all the queued UsageJobs.
+
+    The jobs are merged per meter: overlapping and adjacent month ranges are recalculated once and
+    the readings of every meter are loaded only once.
+
+    :return: tuple with the number of processed jobs and the number of recalculated ranges
+    """
+    jobs = list(UsageJob.objects.order_by('meter_id', 'first_period'))
+    if not jobs:
+        return (0, 0)
+
+    now = timezone.now()
+    ranges = 0
+    for (meter_id, meter_jobs) in groupby(jobs, key=lambda job: job.meter_id):
+        meter_jobs = list(meter_jobs)
+        merged = _merge_periods((job.first_period, job.last_period) for job in meter_jobs)
+
+        with transaction.atomic():
+            dates, values = get_meter_readings(meter_id)
+            for (first_period, last_period) in merged:
+                update_usages(meter_id, first_period, last_period, dates, values)
+            UsageJob.objects.filter(pk__in=[job.pk for job in meter_jobs]).delete()
+        ranges += len(merged)
+
+    LOGGER.info('Processed %s usage jobs in %s ranges, oldest job waited %s.',
+                len(jobs), ranges, now - min(job.created for job in jobs))
+    return (len(jobs), ranges)
+
+
+@contextmanager
+def deferred_usage_recalculation():
+    """
+    Context manager (or decorator) to recalculate the usages once after many reading changes.
+
+    Within the block the reading signals only remember the changed readings. When the block ends,
+    the usages of every changed meter are recalculated once for the merged dirty months (or queued
+    when settings.USAGE_RECALCULATION_QUEUE is on). Nested blocks recalculate at the end of the
+    outermost block.
+    """
+    if getattr(_DEFERRED, 'readings', None) is not None:
+        yield
+        return
+
+    _DEFERRED.readings = {}
+    try:
+        yield
+    finally:
+        deferred = _DEFERRED.readings
+        _DEFERRED.readings = None
+        if transaction.get_connection().needs_rollback:
+            LOGGER.warning('Not recalculating the usages of meters %s in a failed transaction.',
+                           list(deferred))
+        else:
+            for (meter_id, changed_dates) in deferred.items():
+                _recalculate_changed_dates(meter_id, changed_dates)
+
+
+def _recalculate_changed_dates(meter_id, changed_dates):
+    """
+    Recalculate (or queue) the usages of a meter after the readings on changed_dates changed.
+
+    The dirty months are determined with the current readings (of the default database, within
+    the transaction), which also covers readings that are deleted or changed again in the meantime.
+    """
+    with transaction.atomic():
+        dates, values = get_meter_readings(meter_id)
+        merged = _merge_periods(get_dirty_months(dates, changed_date)
+                                for changed_date in changed_dates)
+        if getattr(settings, 'USAGE_RECALCULATION_QUEUE', False):
+            UsageJob.objects.bulk_create([UsageJob(meter_id=meter_id,
+                                                   first_period=first_period,
+                                                   last_period=last_period)
+                                          for (first_period, last_period) in merged])
+            # the usages follow when the jobs are processed, the readings changed now
+            bump_data_version(meter_id)
+            return
+        for (first_period, last_period) in merged:
+            update_usages(meter_id, first_period, last_period, dates, values)
+
+
+def _merge_periods(periods):
+    """
+    Merge overlapping and adjacent (first_period, last_period) ranges.
+
+    :return: sorted list with the merged [first_period, last_period] ranges
+    """
+    merged = []
+    for (first_period, last_period) in sorted(periods):
+        if merged and first_period <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last_period)
+        else:
+            merged.append([first_period, last_period])
+    return merged
+
+
+def get_usage_queue_status():
+    """
+    Get the status of the usage recalculation queue.
+
+    :return: dictionary with the number of queued jobs, the number of meters with queued jobs and
+             the age (timedelta or None) of the oldest job
+    """
+    status = UsageJob.objects.aggregate(depth=Count('id'),
+                                        meters=Count('meter', distinct=True),
+                                        oldest=Min('created'))
+    oldest = status.pop('oldest')
+    status['oldest_age'] = timezone.now() - oldest if oldest else None
+    return status
+
+
+def get_data_version(meter_id=None):
+    """
+    Get the version of the usage data of a meter (or all meters), e.g. to use as ETag.
+
+    :param meter_id: the id of the meter or None for all the meters
+    :return: tuple with the version and the last time the usages were modified (can be None)
+    """
+    meters = Meter.objects.all() if meter_id is None else Meter.objects.filter(pk=meter_id)
+    version = meters.aggregate(count=Count('id'),
+                               version=Sum('data_version'),
+                               modified=Max('data_modified'))
+    return ('{count}-{version}'.format(**version), version['modified'])
+
+
+def get_monthly_usage_series(meter_ids, years):
+    """
+    Get the average usage per day for every month of the years of the meters, with one query.
+
+    :param meter_ids: list with the ids of the meters
+    :param years: list with the years
+    :return: list with a series per meter and year: {'meter': id, 'label': year, 'data': [...]}
+             where data has 12 values (None for the months without usage)
+    """
+    series = {(meter_id, year): [None] * 12 for meter_id in meter_ids for year in years}
+    usages = Usage.objects.filter(meter_id__in=meter_ids, year__in=years).\
+                 values_list('meter_id', 'year', 'month', 'usage')
+    for (meter_id, year, month, usage) in usages:
+        series[(meter_id, year)][month - 1] = usage / monthrange(year, month)[1]
+    return [{'meter': meter_id, 'label': year, 'data': series[(meter_id, year)]}
+            for meter_id in meter_ids for year in years]
+
+
+def period_key(year, month):
+    """
+    Get the linear key of a month, so months can be compared and counted as integers.
+    """
+    return year * 12 + month
+
+
+def period_to_year_month(period):
+    """
+    Get the (year, month) tuple of a period key.
+    """
+    return ((period - 1) // 12, (period - 1) % 12 + 1)
+
+
+def get_dirty_days(dates, the_date):
+    """
+    Get the days of which the daily usage depends on the (inserted, changed or deleted) reading on
+    the_date.
+
+    The reading on a day is interpolated between the reading before and the reading after it. A
+    reading only changes the interpolated readings that lie between its neighbouring readings, so
+    only the days that start or end on such a day are dirty.
+
+    :param dates: the sorted reading dates of the meter (with or without the_date)
+    :param the_date: the date of the reading that changed
+    :return: tuple with the first and last dirty day
+    """
+    index_before = bisect_left(dates, the_date)
+    index_after = bisect_right(dates, the_date)
+    first_day = dates[index_before - 1] if index_before > 0 else the_date - timedelta(days=1)
+    last_day = dates[index_after] - timedelta(days=1) if index_after < len(dates) else the_date
+    return (first_day, last_day)
+
+
+def get_dirty_months(dates, the_date):
+    """
+    Get the months of which the usages depend on the (inserted, changed or deleted) reading on
+    the_date.
+
+    These are the months that contain a dirty day (see get_dirty_days). The monthly usage itself
+    only changes if the month starts or ends between the neighbouring readings, but the daily
+    usages within the month can change anyway.
+
+    :param dates: the sorted reading dates of the meter (with or without the_date)
+    :param the_date: the date of the reading that changed
+    :return: tuple with the first and last period key of the dirty months
+    """
+    (first_day, last_day) = get_dirty_days(dates, the_date)
+    return (period_key(first_day.year, first_day.month), period_key(last_day.year, last_day.month))
+
+
+def get_meter_readings(meter_id, first_day=None, last_day=None):
+    """
+    Get all the readings of a meter in a single query.
+
+    With first_day and last_day only the readings between them are loaded, including the readings
+    just before first_day and just after last_day, so every day in between can be interpolated.
+
+    :param meter_id: the id of the meter
+    :param first_day: optional, the first day the readings are needed for
+    :param last_day: optional, the last day the readings are needed for
+    :return: tuple with a list of the reading dates (sorted) and a list of the matching values
+    """
+    rows = Reading.objects.filter(meter_id=meter_id)
+    if first_day is not None:
+        before = Reading.objects.filter(meter_id=meter_id, date__lte=first_day).\
+                     order_by('-date').\
+                     values('date')[:1]
+        rows = rows.filter(date__gte=Coalesce(Subquery(before), Value(first_day),
+                                              output_field=DateField()))
+    if last_day is not None:
+        after = Reading.objects.filter(meter_id=meter_id, date__gte=last_day).\
+                    order_by('date').\
+                    values('date')[:1]
+        rows = rows.filter(date__lte=Coalesce(Subquery(after), Value(last_day),
+                                              output_field=DateField()))
+    rows = rows.order_by('date').values_list('date', 'reading')
+    dates = []
+    values = []
+    for (the_date, value) in rows:
+        dates.append(the_date)
+        values.append(value)
+    return dates, values
+
+
+def calculate_usages_between(dates, values, ranges):
+    """
+    Calculate the usage between two days for every range.
+
+    The usage is the interpolated reading at the start of the day after the end minus the
+    interpolated reading at the start of the first day, the same way calculate_reading_on_date
+    does it, so the usage of the first until the last day of a month matches the usage of the month.
+
+    :param dates: the sorted dates of the readings of one meter
+    :param values: the reading values matching the dates
+    :param ranges: list with (start, end) tuples, both days are included
+    :return: list with the usage of every range, None if the range is not enclosed by readings
+    """
+    boundaries = [boundary for (start, end) in ranges
+                  for boundary in (start, end + timedelta(days=1))]
+    boundary_readings = [_reading_on_boundary(boundary, dates, values, index)
+                         for (boundary, index) in zip(boundaries,
+                                                      _find_boundary_indices(dates, boundaries))]
+    usages = []
+    for i in range(0, len(boundary_readings), 2):
+        (start_reading, end_reading) = boundary_readings[i:i + 2]
+        if start_reading is None or end_reading is None:
+            usages.append(None)
+        else:
+            usages.append(end_reading - start_reading)
+    return usages
+
+
+def calculate_monthly_usages(dates, values, first_period, last_period):
+    """
+    Calculate the usage for every month between first_period and last_period (both included).
+
+    The usage of a month is the interpolated reading on the first day of the next month minus the
+    interpolated reading on the first day of the month, the same way calculate_reading_on_date
+    does it. Months that are not enclosed by readings are skipped.
+
+    :param dates: the sorted dates of the readings of one meter
+    :param values: the reading values matching the dates
+    :param first_period: period key (see period_key) of the first month to calculate
+    :param last_period: period key of the last month to calculate
+    :return: list with a (year, month, usage) tuple for every month that could be calculated
+    """
+    months = [period_to_year_month(period) for period in range(first_period, last_period + 2)]
+    if len(months) < 2:
+        return []
+
+    # the boundaries are the first days of the months and the first day of the month after
+    boundaries = [date(year, month, 1) for (year, month) in months]
+    months.pop()
+    boundary_readings = [_reading_on_boundary(boundary, dates, values, index)
+                         for (boundary, index) in zip(boundaries,
+                                                      _find_boundary_indices(dates, boundaries))]
+
+    usages = []
+    for (i, (year, month)) in enumerate(months):
+        first_of_month = boundary_readings[i]
+        last_of_month = boundary_readings[i + 1]
+        if first_of_month is None or last_of_month is None:
+            LOGGER.warning('Could not calculate the usage for %s-%s', year, month)
+        else:
+            usages.append((year, month, last_of_month - first_of_month))
+    return usages
+
+
+def calculate_daily_usages(dates, values, first_day, last_day):
+    """
+    Calculate the usage for every day between first_day and last_day (both included).
+
+    The usage of a day is the interpolated reading on the next day minus the interpolated reading
+    on the day itself, the same way calculate_reading_on_date does it. Days that are not enclosed
+    by readings are skipped.
+
+    :param dates: the sorted dates of the readings of one meter
+    :param values: the reading values matching the dates
+    :param first_day: the first day to calculate
+    :param last_day: the last day to calculate
+    :return: list with a (date, usage) tuple for every day that could be calculated
+    """
+    if dates:
+        # no need to look at the days outside the readings
+        first_day = max(first_day, dates[0])
+        last_day = min(last_day, dates[-1] - timedelta(days=1))
+    if not dates or first_day > last_day:
+        return []
+
+    boundaries = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 2)]
+    boundary_readings = [_reading_on_boundary(boundary, dates, values, index)
+                         for (boundary, index) in zip(boundaries,
+                                                      _find_boundary_indices(dates, boundaries))]
+    return [(boundaries[i], boundary_readings[i + 1] - boundary_readings[i])
+            for i in range(len(boundaries) - 1)]
+
+
+def _find_boundary_indices(dates, boundaries):
+    """
+    For every boundary find the index of the first reading after the boundary.
+
+    Uses a vectorized search when NumPy is available, otherwise falls back to bisect.
+    """
+    if numpy is not None and dates:
+        date_ordinals = numpy.fromiter((d.toordinal() for d in dates),
+                                       dtype=numpy.int64,
+                                       count=len(dates))
+        boundary_ordinals = numpy.fromiter((b.toordinal() for b in boundaries),
+                                           dtype=numpy.int64,
+                                           count=len(boundaries))
+        return numpy.searchsorted(date_ordinals, boundary_ordinals, side='right').tolist()
+    return [bisect_right(dates, boundary) for boundary in boundaries]
+
+
+def _reading_on_boundary(the_date, dates, values, index):
+    """
+    Get the (interpolated) reading on the_date.
+
+    :param index: the index of the first reading after the_date
+    :return: the reading or None if the_date is not enclosed by readings
+    """
+    if index > 0 and dates[index - 1] == the_date:
+        return values[index - 1]
+    if index == 0 or index == len(dates):
+        return None
+    return _interpolate(the_date, dates[index - 1], values[index - 1], dates[index], values[index])
+
+
+def _interpolate(the_date, date_1, value_1, date_2, value_2):
+    """
+    Linear interpolation of the reading on the_date between two readings (date_1 < date_2).
+    """
+    days_between_readings = (date_2 - date_1).days
+    days_since_reading_1 = (the_date - date_1).days
+    usage_between_reading = value_2 - value_1
+    return value_1 + usage_between_reading * days_since_reading_1/days_between_readings
 
 
 def get_readings_before_or_after(the_date, meter, before_after):
@@ -120,10 +583,6 @@ def calculate_reading_on_date(the_date, reading_1, reading_2):
     if the_date < reading_1.date or the_date > reading_2.date:
         raise ValueError('The specified date is not between the dates of the readings.')
 
-    days_between_readings = (reading_2.date - reading_1.date).days
-    days_since_reading_1 = (the_date - reading_1.date).days
-    usage_between_reading = reading_2.reading - reading_1.reading
-    reading_on_date = reading_1.reading \
-                      + usage_between_reading \
-                      * days_since_reading_1/days_between_readings
-    return reading_on_date
+    return _interpolate(the_date,
+                        reading_1.date, reading_1.reading,
+                        reading_2.date, reading_2.reading)
@@ -0,0 +1,120 @@
+"""
+Benchmark the read latency of SQLite while a writer is active.
+"""
+from datetime import date, timedelta
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from utilities.sqlite import get_pragma_statements
+
+
+class Command(BaseCommand):
+    """
+    Compare the read latency of the default SQLite configuration (rollback journal) with the
+    profile of settings.SQLITE_PRAGMAS, while another connection keeps rewriting readings (like
+    the usage recalculation does).
+
+    Every profile gets its own temporary database file, the database of the site is not used.
+    """
+    help = 'Benchmark the SQLite read latency with a concurrent writer, before and after the ' \
+           'SQLITE_PRAGMAS profile.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000,
+                            help='The number of readings in the database (default: 20000).')
+        parser.add_argument('--queries', type=int, default=1000,
+                            help='The number of read queries to time (default: 1000).')
+        parser.add_argument('--batch', type=int, default=2000,
+                            help='The number of readings the writer rewrites per transaction '
+                                 '(default: 2000).')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            for (name, statements) in (('default', []),
+                                       ('SQLITE_PRAGMAS', get_pragma_statements())):
+                path = os.path.join(directory, name + '.sqlite3')
+                self._create_database(path, statements, options['rows'])
+                (latencies, writes) = self._run(path, statements, options)
+                latencies.sort()
+                self.stdout.write(
+                    '{n:>14}: read p50 {p50:.2f} ms, p95 {p95:.2f} ms, max {m:.2f} ms, '
+                    '{w} write transactions'.format(n=name,
+                                                     p50=latencies[len(latencies) // 2] * 1000,
+                                                     p95=latencies[int(len(latencies) * .95)] *
+                                                     1000,
+                                                     m=latencies[-1] * 1000,
+                                                     w=writes))
+
+    @staticmethod
+    def _connect(path, statements):
+        """
+        Open a connection (in autocommit mode) and apply the pragmas.
+        """
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                     check_same_thread=False)
+        for statement in statements:
+            connection.execute(statement)
+        return connection
+
+    def _create_database(self, path, statements, rows):
+        """
+        Create a database with readings of 4 meters.
+        """
+        connection = self._connect(path, statements)
+        connection.execute('CREATE TABLE reading (id INTEGER PRIMARY KEY, meter_id INTEGER, '
+                           'date TEXT, reading REAL)')
+        connection.execute('CREATE UNIQUE INDEX reading_meter_date ON reading (meter_id, date)')
+        start = date(1900, 1, 1)
+        connection.execute('BEGIN')
+        connection.executemany('INSERT INTO reading (meter_id, date, reading) VALUES (?, ?, ?)',
+                               ((i % 4, (start + timedelta(days=i // 4)).isoformat(), i * 1.25)
+                                for i in range(rows)))
+        connection.execute('COMMIT')
+        connection.close()
+
+    def _run(self, path, statements, options):
+        """
+        Time the read queries while a writer rewrites the readings.
+
+        :return: tuple with the list of latencies (in seconds) and the number of write transactions
+        """
+        stop = threading.Event()
+        writes = [0]
+
+        def write():
+            connection = self._connect(path, statements)
+            offset = 0
+            while not stop.is_set():
+                connection.execute('BEGIN IMMEDIATE')
+                connection.execute('UPDATE reading SET reading = reading + 1 '
+                                   'WHERE id > ? AND id <= ?',
+                                   (offset, offset + options['batch']))
+                connection.execute('COMMIT')
+                writes[0] += 1
+                offset = (offset + options['batch']) % options['rows']
+            connection.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        connection = self._connect(path, statements)
+        latencies = []
+        days = options['rows'] // 4
+        try:
+            for i in range(options['queries']):
+                first_day = date(1900, 1, 1) + timedelta(days=(i * 37) % max(days - 60, 1))
+                start = time.perf_counter()
+                connection.execute('SELECT date, reading FROM reading WHERE meter_id = ? AND '
+                                   'date >= ? AND date <= ? ORDER BY date',
+                                   (i % 4, first_day.isoformat(),
+                                    (first_day + timedelta(days=60)).isoformat())).fetchall()
+                latencies.append(time.perf_counter() - start)
+        finally:
+            stop.set()
+            writer.join()
+            connection.close()
+        return (latencies, writes[0])
@@ -0,0 +1,52 @@
+"""
+Maintain the SQLite database.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from utilities.sqlite import run_maintenance
+
+
+class Command(BaseCommand):
+    """
+    Set the journal mode of settings.SQLITE_PRAGMAS (WAL), run ANALYZE and PRAGMA optimize (the
+    statistics of the query planner), checkpoint the WAL and optionally vacuum the free pages
+    incrementally. Run it once after the install and then now and then (e.g. daily with cron).
+
+    The first --vacuum of a database switches it to auto_vacuum = INCREMENTAL, which takes a full
+    VACUUM (and locks the database for a while).
+    """
+    help = 'Analyze, optimize, checkpoint and optionally vacuum the SQLite database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='The database to maintain (default: "default").')
+        parser.add_argument('--vacuum', type=int, nargs='?', const=0, default=None,
+                            metavar='PAGES',
+                            help='Give (at most PAGES) free pages back to the file system.')
+        parser.add_argument('--checkpoint', default='TRUNCATE',
+                            choices=['PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'],
+                            help='The mode of the WAL checkpoint (default: TRUNCATE).')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if connection.vendor != 'sqlite':
+            raise CommandError('Database {d} is not a SQLite database.'.format(
+                d=options['database']))
+
+        results = run_maintenance(connection, options['vacuum'], options['checkpoint'])
+        self.stdout.write('Analyzed and optimized database {d}.'.format(d=options['database']))
+        if 'vacuum' in results:
+            if results['vacuum'] == 'full':
+                self.stdout.write('Switched to incremental vacuum with a full VACUUM.')
+            else:
+                self.stdout.write('Vacuumed {p} free pages.'.format(p=results['vacuum']))
+        checkpoint = results.get('checkpoint')
+        if checkpoint is None:
+            self.stdout.write('No WAL checkpoint: the database is not in WAL mode.')
+        else:
+            self.stdout.write('WAL checkpoint: {c} of {l} frames{b}.'.format(
+                c=checkpoint['checkpointed_frames'], l=checkpoint['log_frames'],
+                b=' (busy, run it again later)' if checkpoint['busy'] else ''))
+        self.stdout.write('Pages: {p}, free: {f}.'.format(p=results['page_count'],
+                                                          f=results['freelist_count']))
@@ -0,0 +1,107 @@
+"""
+Import (historical) readings from a CSV file.
+"""
+import csv
+from datetime import datetime
+import logging
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from utilities.logic import rebuild_usages
+from utilities.models import Meter, Reading
+
+LOGGER = logging.getLogger('home_dashboard_log')
+
+
+class Command(BaseCommand):
+    """
+    Stream a CSV file with readings into the database.
+
+    The CSV file needs a header with the columns date (YYYY-MM-DD), reading and meter (the meter
+    name) and optionally remark. The readings are validated against the model fields and inserted
+    with bulk_create, so the reading signals are not sent. Instead the usages of every meter that
+    got new readings are rebuilt once at the end, also when a chunk fails, which also bumps the
+    data version of the meter (the key of the cached list counts).
+    """
+    help = 'Import readings from a CSV file with the columns date, reading, meter and remark.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='The CSV file to import.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of readings to insert per transaction (default: 1000).')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        meters = dict(Meter.objects.values_list('meter_name', 'id'))
+        existing = set(Reading.objects.values_list('date', 'meter_id'))
+        touched_meters = set()
+        imported = 0
+        skipped = 0
+
+        try:
+            csv_file = open(options['csv_file'], newline='')
+        except OSError as error:
+            raise CommandError('Cannot open {f}: {e}'.format(f=options['csv_file'],
+                                                             e=error)) from error
+
+        try:
+            with csv_file:
+                chunk = []
+                for row in csv.DictReader(csv_file):
+                    new_reading = self._reading_from_row(row, meters)
+                    if new_reading is None or (new_reading.date, new_reading.meter_id) in existing:
+                        LOGGER.warning('Skipping invalid or double row of %s: %s',
+                                       options['csv_file'], row)
+                        skipped += 1
+                        continue
+                    existing.add((new_reading.date, new_reading.meter_id))
+                    chunk.append(new_reading)
+                    if len(chunk) >= options['chunk_size']:
+                        imported += self._insert(chunk, touched_meters)
+                        chunk = []
+                imported += self._insert(chunk, touched_meters)
+        finally:
+            # the committed chunks need their usages, also when a later chunk failed
+            for meter_id in touched_meters:
+                rebuild_usages(meter_id)
+
+        duration = time.monotonic() - start
+        self.stdout.write('Imported {i} readings (skipped {s}) in {d:.1f} s ({r:.0f} rows/s).'
+                          .format(i=imported,
+                                  s=skipped,
+                                  d=duration,
+                                  r=(imported + skipped) / duration if duration else 0))
+
+    @staticmethod
+    def _reading_from_row(row, meters):
+        """
+        Make an (unsaved) reading from a CSV row.
+
+        The reading and the remark are cleaned by their model fields, so a reading that is not a
+        finite number or does not fit the digits and decimal places of the field is not valid.
+
+        :return: the reading or None if the row is not valid
+        """
+        try:
+            return Reading(date=datetime.strptime(row['date'].strip(), '%Y-%m-%d').date(),
+                           reading=Reading._meta.get_field('reading').clean(
+                               row['reading'].strip(), None),
+                           meter_id=meters[row['meter'].strip()],
+                           remark=Reading._meta.get_field('remark').clean(
+                               (row.get('remark') or '').strip(), None))
+        except (KeyError, AttributeError, ValueError, ValidationError):
+            return None
+
+    @staticmethod
+    def _insert(chunk, touched_meters):
+        """
+        Insert a chunk of readings in one transaction and add their meters to touched_meters once
+        the chunk is committed.
+        """
+        with transaction.atomic():
+            Reading.objects.bulk_create(chunk)
+        touched_meters.update(reading.meter_id for reading in chunk)
+        return len(chunk)
@@ -0,0 +1,17 @@
+"""
+Load fixtures with a single usage recalculation per meter.
+"""
+from django.core.management.commands import loaddata
+
+from utilities.logic import deferred_usage_recalculation
+
+
+class Command(loaddata.Command):
+    """
+    The standard loaddata command, but the usages are recalculated once per meter after all the
+    fixtures are loaded instead of after every reading.
+    """
+
+    def handle(self, *fixture_labels, **options):
+        with deferred_usage_recalculation():
+            super().handle(*fixture_labels, **options)
@@ -0,0 +1,39 @@
+"""
+Process the queued usage recalculations.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from utilities.logic import get_usage_queue_status, process_usage_jobs
+
+
+class Command(BaseCommand):
+    """
+    Worker that drains the usage recalculation queue (see settings.USAGE_RECALCULATION_QUEUE).
+    """
+    help = 'Recalculate the usages for the queued readings changes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the queue once and stop.')
+        parser.add_argument('--status', action='store_true',
+                            help='Show the queue depth and the age of the oldest job and stop.')
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help='Seconds to wait between polling the queue (default: 2).')
+
+    def handle(self, *args, **options):
+        if options['status']:
+            status = get_usage_queue_status()
+            self.stdout.write('Queued jobs: {depth}, meters: {meters}, oldest job age: '
+                              '{oldest_age}'.format(**status))
+            return
+
+        while True:
+            (jobs, ranges) = process_usage_jobs()
+            if jobs:
+                self.stdout.write('Processed {j} jobs in {r} ranges.'.format(j=jobs, r=ranges))
+            if options['once']:
+                return
+            if not jobs:
+                time.sleep(options['interval'])
@@ -0,0 +1,36 @@
+"""
+Show the statistics of the usage cache.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from utilities.usage_cache import get_usage_cache_stats, reset_usage_cache_stats
+
+
+class Command(BaseCommand):
+    """
+    Show the hits and misses of the usage cache (see settings.USAGE_CACHE). The counters are kept
+    in the cache itself, so the command needs a cache that is shared with the web processes: a
+    process local cache (LocMemCache) would only show the counters of the command itself.
+    """
+    help = 'Show the hits and misses of the usage cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help='Set the hits and misses to zero after showing them.')
+
+    def handle(self, *args, **options):
+        if isinstance(caches[settings.USAGE_CACHE], (LocMemCache, DummyCache)):
+            raise CommandError('The usage cache ({c}) is not shared with the web processes, so '
+                               'their hits and misses are not known here. Use a shared cache '
+                               'backend, e.g. FileBasedCache.'.format(c=settings.USAGE_CACHE))
+        stats = get_usage_cache_stats()
+        total = stats['hits'] + stats['misses']
+        ratio = stats['hits'] / total if total else 0
+        self.stdout.write('Usage cache hits: {hits}, misses: {misses}, '
+                          'hit ratio: {r:.1%}'.format(r=ratio, **stats))
+        if options['reset']:
+            reset_usage_cache_stats()
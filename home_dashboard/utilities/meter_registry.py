@@ -0,0 +1,127 @@
+"""
+Process-local registry of the meters (id, name and unit).
+
+The meters rarely change, but their names and units are shown on almost every page. The registry
+loads them once and is reloaded when its version changes. The version is read from the database
+(the ids and the data versions of the meters, see utilities.usage_cache.get_data_versions), so
+every process sees a committed change: they check the version at most every
+settings.METER_REGISTRY_CHECK_INTERVAL seconds, or at once after a change in the process itself.
+"""
+from collections import namedtuple
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+LOGGER = logging.getLogger('home_dashboard_log')
+
+MeterInfo = namedtuple('MeterInfo', ['id', 'meter_name', 'meter_unit'])
+
+_LOCK = threading.Lock()
+# the loaded meters by id, their version and when the version was checked
+_REGISTRY = {'meters': None, 'version': None, 'checked': 0}
+
+
+def _get_alias():
+    """
+    Get the database alias to load the registry from: the read alias (also within a transaction),
+    which only sees the committed changes, so an uncommitted change is not shared with the other
+    threads.
+    """
+    alias = settings.DATABASE_READ_ALIAS
+    if alias not in connections.databases or connections[alias].settings_dict['NAME'] == \
+            connections[DEFAULT_DB_ALIAS].settings_dict['NAME']:
+        # the read alias is the default database itself (e.g. as test mirror)
+        return DEFAULT_DB_ALIAS
+    return alias
+
+
+def _load_version():
+    """
+    Get the version of the registry from the database.
+
+    The data version of a meter is bumped in the transaction that changes it and a new or deleted
+    meter changes the ids, so the version changes when the change is committed. It also changes
+    with the readings of a meter, which only reloads the registry.
+    """
+    from .usage_cache import get_data_versions # pylint: disable=import-outside-toplevel
+    return get_data_versions(using=_get_alias())
+
+
+def _get_registry(reload=False):
+    """
+    Get the loaded meters, (re)load them when the registry is invalidated.
+
+    :param reload: load the meters, even when the registry is up to date
+    """
+    now = time.monotonic()
+    if not reload and _REGISTRY['meters'] is not None and now - _REGISTRY['checked'] < \
+            settings.METER_REGISTRY_CHECK_INTERVAL:
+        return _REGISTRY['meters']
+
+    version = _load_version()
+    with _LOCK:
+        if reload or _REGISTRY['meters'] is None or _REGISTRY['version'] != version:
+            from .models import Meter # pylint: disable=import-outside-toplevel
+            _REGISTRY['meters'] = {meter_id: MeterInfo(meter_id, name, unit)
+                                   for (meter_id, name, unit) in
+                                   Meter.objects.using(_get_alias()).order_by('id').
+                                   values_list('id', 'meter_name', 'meter_unit')}
+            _REGISTRY['version'] = version
+            LOGGER.debug('Loaded %s meters in the meter registry.', len(_REGISTRY['meters']))
+        _REGISTRY['checked'] = now
+        return _REGISTRY['meters']
+
+
+def get_meter_registry_version():
+    """
+    Get the version of the loaded registry, e.g. to key the cached template fragments with.
+
+    The version is only read from the database when the registry is checked (at most every
+    settings.METER_REGISTRY_CHECK_INTERVAL seconds), so it costs no query on most requests.
+    """
+    _get_registry()
+    return _REGISTRY['version']
+
+
+def get_meters():
+    """
+    Get all the meters, ordered by id.
+
+    :return: list with a MeterInfo (id, meter_name, meter_unit) per meter
+    """
+    return list(_get_registry().values())
+
+
+def get_meter(meter_id):
+    """
+    Get a meter from the registry.
+
+    An unknown meter reloads the registry, it can be added since the version was checked.
+
+    :param meter_id: the id of the meter
+    :return: the MeterInfo or None when there is no such meter
+    """
+    meter = _get_registry().get(meter_id)
+    if meter is None and meter_id is not None:
+        meter = _get_registry(reload=True).get(meter_id)
+    return meter
+
+
+def _expire_registry():
+    """
+    Check the version of the registry on the next use.
+    """
+    with _LOCK:
+        _REGISTRY['checked'] = 0
+
+
+def invalidate_meter_registry():
+    """
+    Check the version of the registry on the next use, now and when the change is committed (the
+    other processes see the new version in the database).
+    """
+    _expire_registry()
+    transaction.on_commit(_expire_registry)
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.7 on 2026-10-18 04:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utilities', '0005_auto_20180529_2141'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_period', models.IntegerField()),
+                ('last_period', models.IntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('meter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='utilities.meter')),
+            ],
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 3.1.7 on 2026-10-18 04:45
+
+from bisect import bisect_right
+from datetime import timedelta
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def _reading_on_day(the_date, dates, values):
+    """
+    The (interpolated) reading on the_date, or None if the_date is not enclosed by readings.
+
+    A copy of the calculation in utilities.logic at the time of this migration, so later changes
+    to the app code do not change what this migration does.
+    """
+    index = bisect_right(dates, the_date)
+    if index > 0 and dates[index - 1] == the_date:
+        return values[index - 1]
+    if index == 0 or index == len(dates):
+        return None
+    days_between_readings = (dates[index] - dates[index - 1]).days
+    days_since_reading = (the_date - dates[index - 1]).days
+    usage_between_readings = values[index] - values[index - 1]
+    return values[index - 1] + usage_between_readings * days_since_reading/days_between_readings
+
+
+def calculate_daily_usages(apps, schema_editor):
+    """
+    Fill the daily usages from the existing readings.
+    """
+    Meter = apps.get_model('utilities', 'Meter')
+    Reading = apps.get_model('utilities', 'Reading')
+    DailyUsage = apps.get_model('utilities', 'DailyUsage')
+    for meter_id in Meter.objects.values_list('id', flat=True):
+        rows = list(Reading.objects.filter(meter_id=meter_id)
+                    .order_by('date')
+                    .values_list('date', 'reading'))
+        if len(rows) < 2:
+            continue
+        dates = [row[0] for row in rows]
+        values = [row[1] for row in rows]
+        days = [dates[0] + timedelta(days=i) for i in range((dates[-1] - dates[0]).days + 1)]
+        day_readings = [_reading_on_day(day, dates, values) for day in days]
+        DailyUsage.objects.bulk_create(
+            [DailyUsage(meter_id=meter_id, date=days[i],
+                        usage=day_readings[i + 1] - day_readings[i])
+             for i in range(len(days) - 1)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utilities', '0006_usagejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('usage', models.DecimalField(decimal_places=4, max_digits=12)),
+                ('meter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='utilities.meter')),
+            ],
+            options={
+                'unique_together': {('meter', 'date')},
+            },
+        ),
+        migrations.RunPython(calculate_daily_usages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.7 on 2026-10-18 05:01
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utilities', '0007_dailyusage'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='reading',
+            unique_together={('meter', 'date')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='usage',
+            unique_together={('meter', 'year', 'month')},
+        ),
+    ]
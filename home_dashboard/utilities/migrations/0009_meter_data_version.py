@@ -0,0 +1,23 @@
+# Generated by Django 3.1.7 on 2026-10-18 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utilities', '0008_meter_first_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='meter',
+            name='data_modified',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='meter',
+            name='data_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
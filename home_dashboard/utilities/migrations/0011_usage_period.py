@@ -0,0 +1,41 @@
+# Generated by Django 3.1.7 on 2026-10-18 06:12
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_usage_period(apps, schema_editor):
+    """
+    Store the period key (year * 12 + month) of the existing usages.
+    """
+    Usage = apps.get_model('utilities', 'Usage')  # pylint: disable=invalid-name
+    Usage.objects.using(schema_editor.connection.alias).update(period=F('year') * 12 + F('month'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utilities', '0010_usageevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usage',
+            name='period',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_usage_period, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='reading',
+            index=models.Index(fields=['date'], name='reading_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usage',
+            index=models.Index(fields=['meter', 'period'], name='usage_meter_period_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usage',
+            index=models.Index(fields=['period'], name='usage_period_idx'),
+        ),
+    ]
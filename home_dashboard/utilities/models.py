@@ -2,6 +2,17 @@
 Specify the data models for the utilities app.
 """
 from django.db import models
+from django.db.models import F
+
+from .meter_registry import get_meter
+
+
+def _get_meter_info(obj):
+    """
+    Get the meter (name and unit) of a reading or usage from the meter registry, the meter is only
+    queried when it is not saved yet.
+    """
+    return get_meter(obj.meter_id) or obj.meter
 
 
 # Create your models here.
@@ -11,6 +22,9 @@ class Meter(models.Model):
     """
     meter_name = models.CharField(max_length=30, unique=True)
     meter_unit = models.CharField(max_length=10)
+    # bumped every time the readings, the usages or the meter change (see utilities.logic)
+    data_version = models.PositiveIntegerField(default=0, editable=False)
+    data_modified = models.DateTimeField(null=True, editable=False)
 
     def __str__(self):
         return 'Meter ' + self.meter_name + ' with unit: ' + self.meter_unit
@@ -28,44 +42,182 @@ class Reading(models.Model):
     meter = models.ForeignKey(Meter, on_delete=models.CASCADE)
     remark = models.CharField(max_length=255, blank=True)
 
+    # the values of the reading as loaded from the database (see tracked_values)
+    loaded_values = None
+
     class Meta:
-        unique_together = ('date', 'meter')
+        # meter first, so the index also serves the per meter range scans
+        unique_together = ('meter', 'date')
+        indexes = [models.Index(fields=['date'], name='reading_date_idx')]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Remember the loaded values, so changes can be detected without querying the database.
+        """
+        instance = super().from_db(db, field_names, values)
+        if {'date', 'reading', 'meter_id'}.issubset(field_names):
+            instance.loaded_values = instance.tracked_values()
+        return instance
+
+    def tracked_values(self):
+        """
+        Get the values that the usages depend on.
+
+        :return: tuple with the date, the reading and the meter id
+        """
+        return (self._meta.get_field('date').to_python(self.date),
+                self._meta.get_field('reading').to_python(self.reading),
+                self.meter_id)
 
     def __str__(self):
+        meter = _get_meter_info(self)
         return 'Reading: {d} {m} - {r} {u}'.format(r=self.reading,
-                                                   u=self.meter.meter_unit,
+                                                   u=meter.meter_unit,
                                                    d=self.date,
-                                                   m=self.meter.meter_name)
+                                                   m=meter.meter_name)
 
     def __repr__(self):
         return "Reading(date='{d}', reading='{r}', meter='{m}', remark='{rm}')" \
                     .format(d=self.date,
                             r=self.reading,
-                            m=self.meter.id,
+                            m=self.meter_id,
                             rm=self.remark)
 
+class UsageQuerySet(models.QuerySet):
+    """
+    Set the period of the usages on the bulk writes, which do not call save() or send pre_save.
+    """
+
+    def bulk_create(self, objs, *args, **kwargs): # pylint: disable=arguments-differ
+        objs = list(objs)
+        for usage in objs:
+            usage.set_period()
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs): # pylint: disable=arguments-differ
+        objs = list(objs)
+        if {'year', 'month'}.intersection(fields) and 'period' not in fields:
+            for usage in objs:
+                usage.set_period()
+            fields = list(fields) + ['period']
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def update(self, **kwargs):
+        if ('year' in kwargs or 'month' in kwargs) and 'period' not in kwargs:
+            kwargs['period'] = kwargs.get('year', F('year')) * 12 + kwargs.get('month', F('month'))
+        return super().update(**kwargs)
+
+
 class Usage(models.Model):
     """
     The usage tells the meter readings per month.
     """
     month = models.IntegerField()
     year = models.IntegerField()
+    # year * 12 + month (see utilities.logic.period_key), for the month range scans and the
+    # ordering on the month. Set by the pre_save signal (utilities.signals.usage_about_to_save)
+    # and by the bulk writes of UsageQuerySet.
+    period = models.IntegerField(editable=False)
     meter = models.ForeignKey(Meter, on_delete=models.CASCADE)
     usage = models.DecimalField(max_digits=10, decimal_places=2)
 
+    objects = UsageQuerySet.as_manager()
+
     class Meta:
-        unique_together = ('year', 'month', 'meter')
+        # meter first, so the index also serves the per meter range scans
+        unique_together = ('meter', 'year', 'month')
+        indexes = [models.Index(fields=['meter', 'period'], name='usage_meter_period_idx'),
+                   models.Index(fields=['period'], name='usage_period_idx')]
 
+    def set_period(self):
+        """
+        Set the period from the year and the month.
+        """
+        self.period = self.year * 12 + self.month
 
     def __str__(self):
+        meter = _get_meter_info(self)
         return "Usage: {y}-{m}: {u} {unit} for {meter}".format(y=self.year,
                                                                m=self.month,
                                                                u=self.usage,
-                                                               unit=self.meter.meter_unit,
-                                                               meter=self.meter.meter_name)
+                                                               unit=meter.meter_unit,
+                                                               meter=meter.meter_name)
 
     def __repr__(self):
         return "Usage(month={m}, year={y}, meter={meter}, usage={u})".format(m=self.month,
                                                                              y=self.year,
-                                                                             meter=self.meter.id,
+                                                                             meter=self.meter_id,
                                                                              u=self.usage)
+
+
+class DailyUsage(models.Model):
+    """
+    The daily usage tells the usage of a meter per day.
+    """
+    date = models.DateField()
+    meter = models.ForeignKey(Meter, on_delete=models.CASCADE)
+    usage = models.DecimalField(max_digits=12, decimal_places=4)
+
+    class Meta:
+        unique_together = ('meter', 'date')
+
+    def __str__(self):
+        meter = _get_meter_info(self)
+        return "DailyUsage: {d}: {u} {unit} for {meter}".format(d=self.date,
+                                                               u=self.usage,
+                                                               unit=meter.meter_unit,
+                                                               meter=meter.meter_name)
+
+    def __repr__(self):
+        return "DailyUsage(date='{d}', meter={meter}, usage={u})".format(d=self.date,
+                                                                        meter=self.meter_id,
+                                                                        u=self.usage)
+
+
+class UsageJob(models.Model):
+    """
+    A queued recalculation of the usages of a meter for a range of months.
+
+    The months are stored as period keys (year * 12 + month), see utilities.logic.period_key.
+    """
+    meter = models.ForeignKey(Meter, on_delete=models.CASCADE)
+    first_period = models.IntegerField()
+    last_period = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "UsageJob: meter {meter} from {f} to {l}".format(meter=self.meter_id,
+                                                               f=self.first_period,
+                                                               l=self.last_period)
+
+    def __repr__(self):
+        return "UsageJob(meter={meter}, first_period={f}, last_period={l})" \
+                    .format(meter=self.meter_id,
+                            f=self.first_period,
+                            l=self.last_period)
+
+
+class UsageEvent(models.Model):
+    """
+    Log of the recalculated usages, the clients of the event stream are notified of every event
+    (see api_v1.events). Every process can read the log, so no message broker is needed.
+
+    The months are stored as period keys (year * 12 + month), see utilities.logic.period_key. The
+    meter is not a foreign key, so the events of a deleted meter are kept.
+    """
+    meter_id = models.IntegerField()
+    first_period = models.IntegerField()
+    last_period = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "UsageEvent: meter {meter} from {f} to {l}".format(meter=self.meter_id,
+                                                                 f=self.first_period,
+                                                                 l=self.last_period)
+
+    def __repr__(self):
+        return "UsageEvent(meter_id={meter}, first_period={f}, last_period={l})" \
+                    .format(meter=self.meter_id,
+                            f=self.first_period,
+                            l=self.last_period)
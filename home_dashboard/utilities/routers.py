@@ -0,0 +1,61 @@
+"""
+Database router that sends the reads to a read-only connection.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class ReadWriteRouter:
+    """
+    Send the reads to settings.DATABASE_READ_ALIAS and the writes (and migrations) to the default
+    database.
+
+    The read alias opens the same SQLite file read-only, so the reads of the charts and lists do
+    not contend with the write transactions, or it can point at a replica. The reads stay on the
+    default database within a transaction, so a transaction sees its own writes, and when the read
+    alias is the default database itself (e.g. as test mirror).
+    """
+
+    @staticmethod
+    def _read_alias():
+        """
+        Get the database alias for a read.
+        """
+        read_alias = settings.DATABASE_READ_ALIAS
+        if read_alias not in connections.databases:
+            return DEFAULT_DB_ALIAS
+        default = connections[DEFAULT_DB_ALIAS]
+        if default.in_atomic_block or \
+                connections[read_alias].settings_dict['NAME'] == default.settings_dict['NAME']:
+            return DEFAULT_DB_ALIAS
+        return read_alias
+
+    def db_for_read(self, model, **hints): # pylint: disable=unused-argument
+        """
+        Read from the read alias.
+        """
+        return self._read_alias()
+
+    def db_for_write(self, model, **hints): # pylint: disable=unused-argument
+        """
+        Write to the default database.
+        """
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints): # pylint: disable=unused-argument
+        """
+        The objects of the default database and the read alias are the same objects.
+        """
+        databases = {DEFAULT_DB_ALIAS, settings.DATABASE_READ_ALIAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # pylint: disable=unused-argument
+        """
+        Never migrate the read alias, it is the same database (or a replica of it).
+        """
+        if db == settings.DATABASE_READ_ALIAS:
+            return False
+        return None
@@ -1,62 +1,268 @@
 """
 Provide serializers for the utility models.
 """
+from collections import OrderedDict
+from datetime import date
+import decimal
 
-from rest_framework import serializers
-from .models import Meter, Reading, Usage
+from rest_framework import ISO_8601, serializers
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
+from .meter_registry import get_meter
+from .models import DailyUsage, Meter, Reading, Usage
 
-class MeterSerializer(serializers.HyperlinkedModelSerializer):
+
+def _get_field_list(request, name):
+    """
+    Get the comma separated field names from a query parameter.
+    """
+    return [field for field in request.query_params.get(name, '').split(',') if field]
+
+
+class SparseFieldsMixin:
+    """
+    Only serialize the fields the client asks for with ?fields=a,b or leave fields out with
+    ?omit=a,b. Only applies to reading requests (GET, HEAD, OPTIONS).
+
+    The views narrow their queryset to the model fields of the requested fields (see
+    get_only_fields), so the columns and relations that are not needed are not loaded.
+    """
+    # the model fields that a serializer field needs, when it is not a model field itself
+    only_fields = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is not None:
+            for field_name in set(self.fields) - self.get_requested_fields(request):
+                self.fields.pop(field_name)
+
+    @classmethod
+    def get_requested_fields(cls, request):
+        """
+        Get the names of the fields the client asked for.
+
+        :param request: the (rest framework) request
+        :return: set with the field names
+        """
+        all_fields = set(cls.Meta.fields)
+        if request.method not in SAFE_METHODS:
+            return all_fields
+        fields = set(_get_field_list(request, 'fields')) or all_fields
+        omit = set(_get_field_list(request, 'omit'))
+        unknown = (fields | omit) - all_fields
+        if unknown:
+            raise serializers.ValidationError('Unknown fields: {f}.'.format(
+                f=', '.join(sorted(unknown))))
+        return fields - omit
+
+    @classmethod
+    def get_only_fields(cls, request):
+        """
+        Get the model fields that are needed for the requested fields, to use with only().
+
+        :param request: the (rest framework) request
+        :return: set with the model field names or None when all fields are requested
+        """
+        fields = cls.get_requested_fields(request)
+        if fields == set(cls.Meta.fields):
+            return None
+        only = set()
+        for field in fields:
+            only.update(cls.only_fields.get(field, (field,)))
+        return only
+
+
+def _identity(value):
+    """
+    Return the value as is.
+    """
+    return value
+
+
+def _compile_decimal_field(field):
+    """
+    Compile the to_representation of a DecimalField: quantize and format as string.
+    """
+    if field.localize:
+        return None
+    coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+    if field.decimal_places is None:
+        quantize = _identity
+    else:
+        quantum = decimal.Decimal('.1') ** field.decimal_places
+        context = decimal.getcontext().copy()
+        if field.max_digits is not None:
+            context.prec = field.max_digits
+
+        def quantize(value):
+            return value.quantize(quantum, rounding=field.rounding, context=context)
+
+    def to_representation(value):
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value).strip())
+        quantized = quantize(value)
+        return '{:f}'.format(quantized) if coerce_to_string else quantized
+    return to_representation
+
+
+def _compile_field(field):
+    """
+    Get a function that formats a raw value like field.to_representation does.
+
+    :return: the function or None when the field type is not supported
+    """
+    if isinstance(field, serializers.PrimaryKeyRelatedField):
+        return _identity if field.pk_field is None else None
+    if isinstance(field, serializers.DecimalField):
+        return _compile_decimal_field(field)
+    if isinstance(field, serializers.DateField):
+        output_format = getattr(field, 'format', api_settings.DATE_FORMAT)
+        if output_format is None:
+            return _identity
+        return date.isoformat if output_format.lower() == ISO_8601 else None
+    if isinstance(field, serializers.IntegerField):
+        return int
+    if isinstance(field, serializers.CharField):
+        return str
+    return None
+
+
+def compile_values_formatter(serializer):
+    """
+    Compile a function that formats a row of a values() queryset exactly like the serializer
+    formats a model instance, without building the instance and walking the serializer fields for
+    every row.
+
+    The SerializerMethodFields need an entry in values_method_fields of the serializer: the field
+    name mapped to the values() source and the serializer method that formats it (None to use the
+    value as is).
+
+    :param serializer: the serializer (with the fields to output)
+    :return: tuple with the field names for values() and the function that formats a row, or None
+             when the serializer has a field that cannot be compiled
+    """
+    method_fields = getattr(serializer, 'values_method_fields', {})
+    formatters = []
+    for (name, field) in serializer.fields.items():
+        if field.write_only:
+            continue
+        if isinstance(field, serializers.SerializerMethodField):
+            if name not in method_fields:
+                return None
+            (source, method_name) = method_fields[name]
+            convert = getattr(serializer, method_name) if method_name else _identity
+            formatters.append((name, source, convert, False))
+        else:
+            convert = _compile_field(field)
+            if convert is None or '.' in field.source:
+                return None
+            formatters.append((name, field.source, convert, True))
+
+    def format_row(row):
+        """
+        Format a values() row.
+        """
+        ret = OrderedDict()
+        for (name, source, convert, skip_none) in formatters:
+            value = row[source]
+            ret[name] = None if skip_none and value is None else convert(value)
+        return ret
+
+    sources = list(OrderedDict.fromkeys(source for (_, source, _, _) in formatters))
+    return sources, format_row
+
+
+class MeterSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     """
     Provide a serializer for the Meter model.
     """
     url = serializers.HyperlinkedIdentityField(view_name='api_v1:meter-detail')
+    only_fields = {'url': ('id',)}
 
     class Meta:
         model = Meter
         fields = ('id', 'meter_name', 'meter_unit', 'url')
 
-class ReadingSerializer(serializers.ModelSerializer):
+
+class MeterUrlMixin:
+    """
+    Provide the meter_url of an object with a meter without querying the meter.
+
+    The urls are remembered per meter, so a list of objects only reverses every meter url once.
+    """
+
+    values_method_fields = {'meter_url': ('meter', 'get_meter_url_from_id')}
+
+    def get_meter_url(self, obj):
+        """
+        Get the url for the connected meter.
+        """
+        return self.get_meter_url_from_id(obj.meter_id)
+
+    def get_meter_url_from_id(self, meter_id):
+        """
+        Get the url for the meter with the id.
+        """
+        meter_urls = self.__dict__.setdefault('_meter_urls', {})
+        if meter_id not in meter_urls:
+            meter_urls[meter_id] = reverse('api_v1:meter-detail',
+                                           kwargs={'pk': meter_id},
+                                           request=self.context.get('request'))
+        return meter_urls[meter_id]
+
+
+class ReadingSerializer(SparseFieldsMixin, MeterUrlMixin, serializers.ModelSerializer):
     """
     Provide a serializer for the Reading model.
+
+    The meter_unit comes from the meter registry, so the meter is not queried.
     """
     meter_url = serializers.SerializerMethodField()
     meter_unit = serializers.SerializerMethodField()
+    only_fields = {'meter_url': ('meter',), 'meter_unit': ('meter',)}
+    values_method_fields = {'meter_url': ('meter', 'get_meter_url_from_id'),
+                            'meter_unit': ('meter', 'get_meter_unit_from_id')}
 
-    def get_meter_url(self, obj):
+    def get_meter_unit(self, obj):
         """
-        Get the url for the connected meter.
+        Get the appropiate unit of the meter.
         """
-        meter = MeterSerializer(Meter.objects.get(pk=obj.meter_id),
-                                context={'request': self.context.get('request')})
-        return meter.data.get('url')
+        return self.get_meter_unit_from_id(obj.meter_id)
 
     @staticmethod
-    def get_meter_unit(obj):
+    def get_meter_unit_from_id(meter_id):
         """
-        Get the appropiate unit of the meter.
+        Get the unit of the meter with the id.
         """
-        meter = Meter.objects.get(pk=obj.meter_id)
-        return meter.meter_unit
+        meter = get_meter(meter_id)
+        return meter.meter_unit if meter is not None else None
 
     class Meta:
         model = Reading
         fields = ('id', 'date', 'reading', 'meter', 'meter_url', 'meter_unit', 'remark')
 
 
-class UsageSerializer(serializers.ModelSerializer):
+class UsageSerializer(SparseFieldsMixin, MeterUrlMixin, serializers.ModelSerializer):
     """
     Provide a serializer for the Usage model.
     """
     meter_url = serializers.SerializerMethodField()
-
-    def get_meter_url(self, obj):
-        """
-        Get the url for the connected meter.
-        """
-        meter = MeterSerializer(Meter.objects.get(pk=obj.meter_id),
-                                context={'request': self.context.get('request')})
-        return meter.data.get('url')
+    only_fields = {'meter_url': ('meter',)}
 
     class Meta:
         model = Usage
         fields = ('id', 'month', 'year', 'meter', 'meter_url', 'usage')
+
+
+class DailyUsageSerializer(SparseFieldsMixin, MeterUrlMixin, serializers.ModelSerializer):
+    """
+    Provide a serializer for the DailyUsage model.
+    """
+    meter_url = serializers.SerializerMethodField()
+    only_fields = {'meter_url': ('meter',)}
+
+    class Meta:
+        model = DailyUsage
+        fields = ('id', 'date', 'meter', 'meter_url', 'usage')
@@ -1,16 +1,35 @@
 """
 Supplies the signals for the utility app.
 """
-from .logic import update_usage_after_new_reading
-from .models import Reading
+import logging
+
+from .logic import bump_data_version, schedule_usage_update
+from .meter_registry import invalidate_meter_registry
+from .models import Meter, Reading, Usage
+
+LOGGER = logging.getLogger('home_dashboard_log')
 
 
 def reading_saved(sender, instance, **kwargs): # pylint: disable=unused-argument
     """
     Calculate the new usage when a reading is saved.
+
+    Nothing is recalculated when the date, reading and meter did not change. When the date or the
+    meter changed, the usages around the old date (of the old meter) are recalculated as well.
     """
     if sender == Reading:
-        update_usage_after_new_reading(Reading.objects.get(pk=instance.pk))
+        old_values = instance.loaded_values
+        new_values = instance.tracked_values()
+        instance.loaded_values = new_values
+        if old_values == new_values:
+            LOGGER.debug('Reading %s saved without changes to the usage.', instance.pk)
+            return
+
+        (old_date, _, old_meter_id) = old_values if old_values else (None, None, None)
+        (new_date, _, new_meter_id) = new_values
+        if old_values and (old_date, old_meter_id) != (new_date, new_meter_id):
+            schedule_usage_update(Reading(date=old_date, meter_id=old_meter_id))
+        schedule_usage_update(Reading(date=new_date, meter_id=new_meter_id))
 
 
 def reading_deleted(sender, instance, **kwargs): # pylint: disable=unused-argument
@@ -18,32 +37,39 @@ def reading_deleted(sender, instance, **kwargs): # pylint: disable=unused-argume
     Calculate the new usage after a reading was deleted.
     """
     if sender == Reading:
-        update_usage_after_new_reading(instance)
-
-
-def reading_changed_meter(sender, instance, **kwargs): # pylint: disable=unused-argument
-    """
-    Checks if the meter changed. If the meter changed, then recalculate the useages of the old and
-    new meter.
-    """
-    new_reading = instance
-    try:
-        old_reading = Reading.objects.get(pk=instance.pk)
-    except Reading.DoesNotExist:
-        old_reading = None
-
-    try:
-        if new_reading.meter != old_reading.meter:
-            try:
-                reading_before = Reading.objects. \
-                    filter(meter=old_reading.meter). \
-                    filter(date__lt=old_reading.date). \
-                    order_by('-date')[0]
-            except Reading.DoesNotExist:
-                # no previous reading -> no usage -> no problem
-                pass
-            else:
-                old_reading.delete()
-                update_usage_after_new_reading(reading_before)
-    except AttributeError:
-        pass
+        (the_date, _, meter_id) = instance.loaded_values or instance.tracked_values()
+        schedule_usage_update(Reading(date=the_date, meter_id=meter_id))
+
+
+def reading_about_to_save(sender, instance, **kwargs): # pylint: disable=unused-argument
+    """
+    Make sure the stored values of a changed reading are known before it is saved.
+
+    Readings that were loaded from the database remember their values. Only readings that were
+    created with the id of an existing reading need a query.
+    """
+    if sender == Reading and instance.pk is not None and instance.loaded_values is None:
+        old_reading = Reading.objects.filter(pk=instance.pk).first()
+        if old_reading is not None:
+            instance.loaded_values = old_reading.loaded_values
+
+
+def usage_about_to_save(sender, instance, **kwargs): # pylint: disable=unused-argument
+    """
+    Set the period of a usage from its year and month, also when it is loaded from a fixture.
+    """
+    if sender == Usage:
+        instance.set_period()
+
+
+def meter_changed(sender, instance, created=None, **kwargs): # pylint: disable=unused-argument
+    """
+    Bump the data version of a changed meter (its name and unit are part of the cached usage
+    queries) and invalidate the meter registry when a meter is saved or deleted.
+
+    A new or deleted meter changes the data versions of all the meters by itself.
+    """
+    if sender == Meter:
+        if created is False:
+            bump_data_version(instance.pk)
+        invalidate_meter_registry()
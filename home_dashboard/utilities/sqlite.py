@@ -0,0 +1,88 @@
+"""
+The SQLite performance profile: the pragmas of every new connection and the maintenance.
+
+With the write-ahead log (WAL) the readers do not wait for a writer and a writer does not wait for
+the readers, so the dashboard stays responsive while the usages are recalculated. The journal mode
+is stored in the database file, so only the maintenance sets it; a new connection does not change
+the file.
+"""
+import logging
+
+from django.conf import settings
+
+LOGGER = logging.getLogger('home_dashboard_log')
+
+
+def get_pragma_statements(pragmas=None):
+    """
+    Get the PRAGMA statements of the profile.
+
+    :param pragmas: dict with the pragmas and their values, defaults to settings.SQLITE_PRAGMAS
+    :return: list with the statements
+    """
+    pragmas = settings.SQLITE_PRAGMAS if pragmas is None else pragmas
+    return ['PRAGMA {n} = {v}'.format(n=name, v=value) for (name, value) in pragmas.items()]
+
+
+def configure_connection(sender, connection, **kwargs): # pylint: disable=unused-argument
+    """
+    Apply settings.SQLITE_PRAGMAS to a new SQLite connection (connection_created signal).
+
+    The journal mode is left to run_maintenance: it is written to the database file, so setting it
+    here would turn every database a manage.py command opens into a WAL database. The connection of
+    the read alias (settings.DATABASE_READ_ALIAS) is made query only.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    statements = get_pragma_statements({name: value for (name, value)
+                                        in settings.SQLITE_PRAGMAS.items()
+                                        if name != 'journal_mode'})
+    if connection.alias == settings.DATABASE_READ_ALIAS:
+        statements.append('PRAGMA query_only = ON')
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+    LOGGER.debug('Configured SQLite connection %s.', connection.alias)
+
+
+def run_maintenance(connection, vacuum_pages=None, checkpoint='TRUNCATE'):
+    """
+    Set the journal mode of settings.SQLITE_PRAGMAS, update the statistics of the query planner,
+    checkpoint the WAL (in WAL mode) and optionally give the free pages back to the file system.
+
+    :param connection: the (SQLite) database connection
+    :param vacuum_pages: the number of free pages to vacuum (0 for all) or None to skip the vacuum
+    :param checkpoint: the mode of the WAL checkpoint (PASSIVE, FULL, RESTART or TRUNCATE)
+    :return: dict with the results of the steps
+    """
+    results = {}
+    with connection.cursor() as cursor:
+        if 'journal_mode' in settings.SQLITE_PRAGMAS:
+            cursor.execute(get_pragma_statements(
+                {'journal_mode': settings.SQLITE_PRAGMAS['journal_mode']})[0])
+        cursor.execute('ANALYZE')
+        cursor.execute('PRAGMA optimize')
+        if vacuum_pages is not None:
+            cursor.execute('PRAGMA auto_vacuum')
+            if cursor.fetchone()[0] != 2:
+                # incremental vacuum needs auto_vacuum = INCREMENTAL, which takes a full VACUUM
+                cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                cursor.execute('VACUUM')
+                results['vacuum'] = 'full'
+            else:
+                cursor.execute('PRAGMA freelist_count')
+                free_pages = cursor.fetchone()[0]
+                cursor.execute('PRAGMA incremental_vacuum({p:d})'.format(p=vacuum_pages))
+                cursor.fetchall()
+                results['vacuum'] = min(free_pages, vacuum_pages or free_pages)
+        cursor.execute('PRAGMA journal_mode')
+        if cursor.fetchone()[0].lower() == 'wal':
+            cursor.execute('PRAGMA wal_checkpoint({m})'.format(m=checkpoint))
+            (busy, log_frames, checkpointed_frames) = cursor.fetchone()
+            results['checkpoint'] = {'busy': bool(busy), 'log_frames': log_frames,
+                                     'checkpointed_frames': checkpointed_frames}
+        cursor.execute('PRAGMA page_count')
+        results['page_count'] = cursor.fetchone()[0]
+        cursor.execute('PRAGMA freelist_count')
+        results['freelist_count'] = cursor.fetchone()[0]
+    return results
@@ -2,15 +2,40 @@
 Testing of all the classes and endpoints for the utilities app.
 """
 import datetime
+from decimal import Decimal
+from io import StringIO
+import json
+import math
+import os
+import sqlite3
+import tempfile
+from unittest import mock
+
 from django.conf import settings
 from django.contrib.auth.models import User, Permission
-from django.db import IntegrityError
-from django.test import Client, TestCase, TransactionTestCase
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, OperationalError, connection, connections
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.db.models import F
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
+from .checks import UNINDEXED_SORT_KEYS, check_hot_query_plans, get_full_scans, \
+    get_hot_queries
 from .exceptions import MeterError
-from .logic import update_usage_after_new_reading, calculate_reading_on_date
-from .models import Meter, Reading, Usage
+from .logic import calculate_monthly_usages, calculate_reading_on_date, \
+    deferred_usage_recalculation, get_dirty_days, get_dirty_months, get_meter_readings, \
+    get_monthly_usage_series, get_usage_queue_status, period_key, process_usage_jobs, \
+    rebuild_usages, update_usage_after_new_reading
+from .list_query import cached_count
+from .meter_registry import get_meter, get_meter_registry_version, get_meters
+from .models import DailyUsage, Meter, Reading, Usage, UsageJob
+from .routers import ReadWriteRouter
+from .sqlite import get_pragma_statements, run_maintenance
+from .usage_cache import cached_usage_query, get_usage_cache_stats, reset_usage_cache_stats
+from .views import METER_SORT_KEYS, READING_SORT_KEYS, USAGE_SORT_KEYS
 
 
 class MeterViewTests(TransactionTestCase):
@@ -531,6 +556,34 @@ class ReadingViewTests(TestCase):
         self.assertContains(response, 'page-item-2')
 
 
+class UsageViewTests(TestCase):
+    """
+    Test the usage pages.
+    """
+
+    def setUp(self):
+        """
+        Setup a test user for login.
+        """
+        self.client = Client()
+        self.user = User.objects.create_user('testuser', 'test@user.com', 'q2w3E$R%')
+
+    def test_graphs_embed_the_series(self):
+        """
+        The graphs page contains the series of the last three years of every meter.
+        """
+        meter = Meter.objects.create(meter_name='testmeter', meter_unit='m')
+        year = datetime.date.today().year
+        Usage.objects.create(meter=meter, year=year - 1, month=4, usage=30)
+        self.client.login(username='testuser', password='q2w3E$R%')
+        response = self.client.get(reverse('utilities:graphs'))
+        self.assertEqual(response.status_code, 200)
+        series = response.context['series']
+        self.assertEqual([s['label'] for s in series], [year, year - 1, year - 2])
+        self.assertEqual(series[1]['data'][3], 1)
+        self.assertContains(response, 'id="usage-series"')
+
+
 class UsageTests(TestCase):
     """
     Test the usage.
@@ -707,3 +760,989 @@ class UsageTests(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, 'page-item-2')
+
+    def test_monthly_usages_match_calculate_reading_on_date(self):
+        """
+        The in-memory usage calculation should give the same results as calculating every month
+        with calculate_reading_on_date.
+        """
+        meter = Meter(meter_name='testmeter', meter_unit='m')
+        meter.save()
+        readings = []
+        the_date = datetime.date(2016, 3, 17)
+        value = 0
+        for i in range(40):
+            readings.append(Reading(date=the_date, reading=value, meter=meter))
+            the_date += datetime.timedelta(days=11 + (i * 7) % 37)
+            value += 3 + (i * 13) % 29
+        dates = [r.date for r in readings]
+        values = [r.reading for r in readings]
+
+        usages = calculate_monthly_usages(dates, values, 2016 * 12 + 1, 2018 * 12 + 12)
+        expected = []
+        for year in range(2016, 2019):
+            for month in range(1, 13):
+                first = datetime.date(year, month, 1)
+                last = datetime.date(year + month // 12, month % 12 + 1, 1)
+                if first < dates[0] or last > dates[-1]:
+                    continue
+                before_first = [r for r in readings if r.date <= first][-1]
+                after_first = [r for r in readings if r.date > first][0]
+                before_last = [r for r in readings if r.date < last][-1]
+                after_last = [r for r in readings if r.date >= last][0]
+                use = calculate_reading_on_date(last, before_last, after_last) - \
+                      calculate_reading_on_date(first, before_first, after_first)
+                expected.append((year, month, use))
+        self.assertEqual(usages, expected)
+
+    def test_update_usage_uses_constant_number_of_queries(self):
+        """
+        Recalculating the usages should not run queries per month, only the batches of the daily
+        usages grow (slowly) with the number of days.
+        """
+        meter = Meter(meter_name='testmeter', meter_unit='m')
+        meter.save()
+        Reading.objects.bulk_create([Reading(date=datetime.date(2010, 1, 1), reading=0,
+                                             meter=meter),
+                                     Reading(date=datetime.date(2018, 1, 1), reading=960,
+                                             meter=meter)])
+        reading = Reading.objects.select_related('meter').get(date=datetime.date(2018, 1, 1))
+        with CaptureQueriesContext(connection) as queries:
+            update_usage_after_new_reading(reading)
+        self.assertEqual(Usage.objects.filter(meter=meter).count(), 8 * 12)
+        days = DailyUsage.objects.filter(meter=meter).count()
+        self.assertEqual(days, (datetime.date(2018, 1, 1) - datetime.date(2010, 1, 1)).days)
+        fields = [field for field in DailyUsage._meta.concrete_fields if not field.primary_key]
+        batch_size = connection.ops.bulk_batch_size(fields, [])
+        # the savepoint of the transaction (in the test case), load readings, clean up and insert
+        # the monthly usages, bump the version and log the event, plus a query per batch of daily
+        # usages
+        self.assertEqual(len(queries), 8 + math.ceil(days / batch_size))
+
+    def test_dirty_months(self):
+        """
+        Only the months with a boundary between the neighbouring readings are dirty.
+        """
+        dates = [datetime.date(2017, 11, 15), datetime.date(2018, 3, 10)]
+        self.assertEqual(get_dirty_months(dates, datetime.date(2018, 1, 20)),
+                         (period_key(2017, 11), period_key(2018, 3)))
+        # no month boundary between the neighbours: only the daily usages of the month change
+        dates = [datetime.date(2018, 1, 2), datetime.date(2018, 1, 30)]
+        self.assertEqual(get_dirty_months(dates, datetime.date(2018, 1, 10)),
+                         (period_key(2018, 1), period_key(2018, 1)))
+        # a boundary reading itself changes the months on both sides
+        dates = [datetime.date(2018, 1, 1), datetime.date(2018, 2, 1), datetime.date(2018, 3, 1)]
+        self.assertEqual(get_dirty_months(dates, datetime.date(2018, 2, 1)),
+                         (period_key(2018, 1), period_key(2018, 2)))
+        # first and last reading
+        self.assertEqual(get_dirty_months(dates, datetime.date(2018, 1, 1)),
+                         (period_key(2017, 12), period_key(2018, 1)))
+        self.assertEqual(get_dirty_months(dates, datetime.date(2018, 3, 1)),
+                         (period_key(2018, 2), period_key(2018, 3)))
+
+    def test_insert_reading_across_year_boundary(self):
+        """
+        Inserting a reading between readings in different years only rewrites the dirty months.
+        """
+        meter = Meter(meter_name='testmeter', meter_unit='m')
+        meter.save()
+        Reading(date=datetime.date(2017, 6, 1), reading=0, meter=meter).save()
+        Reading(date=datetime.date(2017, 10, 1), reading=120, meter=meter).save()
+        Reading(date=datetime.date(2018, 4, 1), reading=302, meter=meter).save()
+        june = Usage.objects.get(meter=meter, year=2017, month=6)
+
+        Reading(date=datetime.date(2018, 1, 1), reading=212, meter=meter).save()
+        self.assertEqual(Usage.objects.filter(meter=meter).count(), 10)
+        self.assertEqual(Usage.objects.get(meter=meter, year=2017, month=6).id, june.id)
+        self.assertEqual(Usage.objects.get(meter=meter, year=2017, month=12).usage, 31)
+        self.assertEqual(Usage.objects.get(meter=meter, year=2018, month=3).usage, 31)
+
+
+    def test_dirty_days(self):
+        """
+        The daily usages between the neighbouring readings are dirty.
+        """
+        dates = [datetime.date(2018, 1, 2), datetime.date(2018, 1, 30)]
+        self.assertEqual(get_dirty_days(dates, datetime.date(2018, 1, 10)),
+                         (datetime.date(2018, 1, 2), datetime.date(2018, 1, 29)))
+        self.assertEqual(get_dirty_days(dates, datetime.date(2018, 2, 10)),
+                         (datetime.date(2018, 1, 30), datetime.date(2018, 2, 10)))
+
+    def test_daily_usages(self):
+        """
+        The daily usages are kept up to date with the readings.
+        """
+        meter = Meter(meter_name='testmeter', meter_unit='m')
+        meter.save()
+        Reading(date=datetime.date(2018, 1, 30), reading=0, meter=meter).save()
+        Reading(date=datetime.date(2018, 2, 9), reading=100, meter=meter).save()
+        self.assertEqual(DailyUsage.objects.filter(meter=meter).count(), 10)
+        self.assertEqual(DailyUsage.objects.get(meter=meter, date=datetime.date(2018, 2, 1)).usage,
+                         10)
+
+        # a new reading within the same month changes the daily usages
+        Reading(date=datetime.date(2018, 2, 4), reading=20, meter=meter).save()
+        self.assertEqual(DailyUsage.objects.get(meter=meter, date=datetime.date(2018, 2, 1)).usage,
+                         4)
+        self.assertEqual(DailyUsage.objects.get(meter=meter, date=datetime.date(2018, 2, 8)).usage,
+                         16)
+        total = sum(DailyUsage.objects.filter(meter=meter).values_list('usage', flat=True))
+        self.assertEqual(total, 100)
+
+
+    def test_changing_remark_does_not_recalculate(self):
+        """
+        Saving a reading without changes to the date, reading or meter only updates the reading.
+        """
+        meter = Meter(meter_name='testmeter', meter_unit='m')
+        meter.save()
+        Reading(date=datetime.date(2018, 1, 1), reading=0, meter=meter).save()
+        Reading(date=datetime.date(2018, 2, 1), reading=10, meter=meter).save()
+        reading = Reading.objects.get(date=datetime.date(2018, 2, 1))
+        reading.remark = 'only the remark changed'
+        with self.assertNumQueries(1):
+            reading.save()
+
+    def test_changing_date_recalculates_old_and_new_months(self):
+        """
+        Moving a reading to another date recalculates the usages around both dates.
+        """
+        meter = Meter(meter_name='testmeter', meter_unit='m')
+        meter.save()
+        for month in range(1, 7):
+            Reading(date=datetime.date(2018, month, 1), reading=month * 10, meter=meter).save()
+        reading = Reading.objects.get(date=datetime.date(2018, 2, 1))
+        reading.date = datetime.date(2018, 4, 16)
+        reading.reading = 45
+        reading.save()
+        self.assertEqual(Usage.objects.get(meter=meter, month=1).usage, Decimal('10.51'))
+        self.assertEqual(Usage.objects.get(meter=meter, month=2).usage, Decimal('9.49'))
+        self.assertEqual(Usage.objects.get(meter=meter, month=4).usage, 10)
+        self.assertEqual(Usage.objects.get(meter=meter, month=5).usage, 10)
+        self.assertEqual(DailyUsage.objects.get(meter=meter, date=datetime.date(2018, 4, 16)).usage,
+                         Decimal('0.3333'))
+
+    def test_meter_readings_around_a_range(self):
+        """
+        Only the readings needed to interpolate the range are loaded.
+        """
+        meter = Meter.objects.create(meter_name='testmeter', meter_unit='m')
+        for month in range(1, 7):
+            Reading.objects.create(date=datetime.date(2018, month, 1), reading=month, meter=meter)
+        dates, values = get_meter_readings(meter.id,
+                                           datetime.date(2018, 2, 15),
+                                           datetime.date(2018, 4, 1))
+        self.assertEqual(dates, [datetime.date(2018, month, 1) for month in (2, 3, 4)])
+        self.assertEqual(values, [2, 3, 4])
+        dates, values = get_meter_readings(meter.id,
+                                           datetime.date(2017, 1, 1),
+                                           datetime.date(2018, 1, 15))
+        self.assertEqual(dates, [datetime.date(2018, 1, 1), datetime.date(2018, 2, 1)])
+
+
+@override_settings(USAGE_RECALCULATION_QUEUE=True)
+class UsageQueueTests(TestCase):
+    """
+    Test the background recalculation of the usages.
+    """
+    def setUp(self):
+        """
+        Setup a meter with two readings.
+        """
+        self.meter = Meter(meter_name='testmeter', meter_unit='m')
+        self.meter.save()
+        Reading(date=datetime.date(2018, 1, 1), reading=0, meter=self.meter).save()
+        Reading(date=datetime.date(2018, 6, 1), reading=151, meter=self.meter).save()
+
+    def test_saving_reading_queues_job(self):
+        """
+        Saving a reading should only queue the recalculation.
+        """
+        self.assertFalse(Usage.objects.exists())
+        self.assertEqual(get_usage_queue_status()['depth'], 2)
+
+        self.assertEqual(process_usage_jobs(), (2, 1))
+        self.assertEqual(Usage.objects.filter(meter=self.meter).count(), 5)
+        self.assertEqual(Usage.objects.get(meter=self.meter, month=1).usage, 31)
+        self.assertFalse(UsageJob.objects.exists())
+
+    def test_jobs_are_merged_per_meter(self):
+        """
+        Many quick changes of the same meter should cause a single recalculation.
+        """
+        for day in range(2, 12):
+            Reading(date=datetime.date(2018, 3, day), reading=58 + day, meter=self.meter).save()
+        self.assertEqual(get_usage_queue_status()['depth'], 12)
+        self.assertEqual(process_usage_jobs(), (12, 1))
+        self.assertEqual(Usage.objects.get(meter=self.meter, month=3).usage, 31)
+
+    def test_worker_command(self):
+        """
+        The worker command can show the queue and drain it.
+        """
+        out = StringIO()
+        call_command('run_usage_worker', '--status', stdout=out)
+        self.assertIn('Queued jobs: 2', out.getvalue())
+        call_command('run_usage_worker', '--once', stdout=out)
+        self.assertIn('Processed 2 jobs in 1 ranges', out.getvalue())
+        self.assertEqual(Usage.objects.filter(meter=self.meter).count(), 5)
+
+
+class DeferredUsageTests(TestCase):
+    """
+    Test deferring the usage recalculation.
+    """
+    def setUp(self):
+        """
+        Start with an empty usage cache and setup a meter.
+        """
+        caches[settings.USAGE_CACHE].clear()
+        self.meter = Meter(meter_name='testmeter', meter_unit='m')
+        self.meter.save()
+
+    def test_deferred_usage_recalculation(self):
+        """
+        Within the block no usages are calculated, afterwards all of them are.
+        """
+        with deferred_usage_recalculation():
+            for month in range(1, 13):
+                Reading(date=datetime.date(2018, month, 1), reading=month * 10,
+                        meter=self.meter).save()
+            Reading.objects.get(date=datetime.date(2018, 6, 1)).delete()
+            with deferred_usage_recalculation():
+                Reading(date=datetime.date(2019, 1, 1), reading=130, meter=self.meter).save()
+            self.assertFalse(Usage.objects.exists())
+        self.assertEqual(Usage.objects.filter(meter=self.meter).count(), 12)
+        self.assertEqual(Usage.objects.get(meter=self.meter, month=5).usage, Decimal('10.16'))
+        self.assertEqual(Usage.objects.get(meter=self.meter, month=12).usage, 10)
+
+    def test_deferred_usage_recalculation_decorator(self):
+        """
+        The context manager can be used as decorator.
+        """
+        @deferred_usage_recalculation()
+        def add_readings():
+            Reading(date=datetime.date(2018, 1, 1), reading=0, meter=self.meter).save()
+            Reading(date=datetime.date(2018, 2, 1), reading=10, meter=self.meter).save()
+            self.assertFalse(Usage.objects.exists())
+
+        add_readings()
+        self.assertEqual(Usage.objects.get(meter=self.meter).usage, 10)
+
+    @override_settings(USAGE_RECALCULATION_QUEUE=True)
+    def test_deferred_with_the_queue(self):
+        """
+        The queued recalculation bumps the data version, so the cached counts follow the readings.
+        """
+        self.assertEqual(cached_count(Reading.objects.filter(meter=self.meter), self.meter.id), 0)
+        with deferred_usage_recalculation():
+            Reading(date=datetime.date(2018, 1, 1), reading=0, meter=self.meter).save()
+            Reading(date=datetime.date(2018, 2, 1), reading=10, meter=self.meter).save()
+        self.assertEqual(get_usage_queue_status()['depth'], 1)
+        self.assertEqual(cached_count(Reading.objects.filter(meter=self.meter), self.meter.id), 2)
+
+    def test_loaddata(self):
+        """
+        Loading a fixture calculates the usages after loading all the readings.
+        """
+        fixture = [{'model': 'utilities.reading', 'pk': month,
+                    'fields': {'date': '2018-{m:02d}-01'.format(m=month),
+                               'reading': str(month * 10),
+                               'meter': self.meter.id,
+                               'remark': ''}}
+                   for month in range(1, 4)]
+        (handle, fixture_path) = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'w') as fixture_file:
+            json.dump(fixture, fixture_file)
+        try:
+            call_command('loaddata', fixture_path, verbosity=0)
+        finally:
+            os.remove(fixture_path)
+        self.assertEqual(Usage.objects.filter(meter=self.meter).count(), 2)
+
+
+class UsageCacheTests(TestCase):
+    """
+    Test the cache of the usage queries.
+    """
+
+    def setUp(self):
+        """
+        Start with an empty cache and a meter with readings in 2018 and 2019.
+        """
+        caches[settings.USAGE_CACHE].clear()
+        self.meter = Meter.objects.create(meter_name='testmeter', meter_unit='m')
+        for (the_date, value) in ((datetime.date(2018, 1, 1), 0),
+                                  (datetime.date(2018, 2, 1), 31),
+                                  (datetime.date(2019, 1, 1), 365),
+                                  (datetime.date(2019, 2, 1), 396)):
+            Reading.objects.create(date=the_date, reading=value, meter=self.meter)
+
+    def _series(self, year):
+        """
+        Get the (cached) monthly usage series of the meter in a year.
+        """
+        return cached_usage_query([self.meter.id], [year], 'test',
+                                  lambda: get_monthly_usage_series([self.meter.id], [year]))
+
+    def test_hits_and_misses(self):
+        """
+        The second query is a hit and is not calculated again, only the data version is queried.
+        """
+        self._series(2018)
+        with self.assertNumQueries(1):
+            series = self._series(2018)
+        self.assertEqual(series[0]['data'][0], 1)
+        self.assertEqual(get_usage_cache_stats(), {'hits': 1, 'misses': 1})
+        reset_usage_cache_stats()
+        self.assertEqual(get_usage_cache_stats(), {'hits': 0, 'misses': 0})
+
+    def test_stats_command_needs_a_shared_cache(self):
+        """
+        The usage_cache command refuses the process local cache and shows the counters of a
+        shared cache.
+        """
+        with self.assertRaises(CommandError):
+            call_command('usage_cache', stdout=StringIO())
+        with tempfile.TemporaryDirectory() as directory:
+            shared = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                      'LOCATION': directory}
+            with override_settings(CACHES=dict(settings.CACHES, usage=shared)):
+                self._series(2018)
+                self._series(2018)
+                out = StringIO()
+                call_command('usage_cache', '--reset', stdout=out)
+                self.assertIn('hits: 1, misses: 1', out.getvalue())
+                self.assertEqual(get_usage_cache_stats(), {'hits': 0, 'misses': 0})
+
+    def test_recalculation_invalidates_the_meter(self):
+        """
+        A new reading invalidates the queries of the meter, but not of the other meters.
+        """
+        other_meter = Meter.objects.create(meter_name='othermeter', meter_unit='m')
+        self._series(2019)
+        cached_usage_query([other_meter.id], [2019], 'test', lambda: 'other')
+        Reading.objects.create(date=datetime.date(2019, 1, 16), reading=390, meter=self.meter)
+        self.assertEqual(cached_usage_query([other_meter.id], [2019], 'test', lambda: 'new'),
+                         'other')
+        with self.assertNumQueries(2):
+            series = self._series(2019)
+        self.assertEqual(series[0]['data'][0], 1)
+
+    def test_change_in_another_process_invalidates(self):
+        """
+        The entries are keyed by the data version in the database, so a change by another process
+        (without the signals of this process) invalidates them as well.
+        """
+        self._series(2018)
+        Meter.objects.filter(pk=self.meter.pk).update(data_version=F('data_version') + 1)
+        with self.assertNumQueries(2):
+            self._series(2018)
+
+    def test_changing_the_meter_invalidates(self):
+        """
+        Saving the meter invalidates all its queries.
+        """
+        self._series(2018)
+        self.meter.meter_unit = 'm3'
+        self.meter.save()
+        with self.assertNumQueries(2):
+            self._series(2018)
+
+
+class ImportReadingsTests(TestCase):
+    """
+    Test the import_readings command.
+    """
+    def setUp(self):
+        """
+        Start with an empty usage cache.
+        """
+        caches[settings.USAGE_CACHE].clear()
+
+    def test_import_readings(self):
+        """
+        Import a CSV file: the usages are calculated and double readings are skipped.
+        """
+        meter = Meter(meter_name='testmeter', meter_unit='m')
+        meter.save()
+        Reading(date=datetime.date(2018, 1, 1), reading=0, meter=meter).save()
+        lines = ['date,reading,meter,remark']
+        for month in range(1, 13):
+            lines.append('2018-{m:02d}-01,{r},testmeter,imported'.format(m=month, r=10 * month))
+        lines.append('2018-03-01,999,testmeter,double')
+        lines.append('2018-13-01,999,testmeter,invalid date')
+        lines.append('2018-12-31,999,unknown meter,')
+        for reading in ('NaN', 'Infinity', '123456789012', '1.234'):
+            lines.append('2019-01-01,{r},testmeter,not a valid reading'.format(r=reading))
+        (handle, csv_path) = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as csv_file:
+            csv_file.write('\n'.join(lines))
+
+        self.assertEqual(cached_count(Reading.objects.filter(meter=meter), meter.id), 1)
+
+        out = StringIO()
+        try:
+            call_command('import_readings', csv_path, '--chunk-size', '5', stdout=out)
+        finally:
+            os.remove(csv_path)
+        self.assertIn('Imported 11 readings (skipped 8)', out.getvalue())
+        self.assertIn('rows/s', out.getvalue())
+        self.assertEqual(Reading.objects.filter(meter=meter).count(), 12)
+        self.assertEqual(Usage.objects.filter(meter=meter).count(), 11)
+        self.assertEqual(Usage.objects.get(meter=meter, year=2018, month=1).usage, 20)
+        # the imported readings are counted on the list pages
+        self.assertEqual(cached_count(Reading.objects.filter(meter=meter), meter.id), 12)
+        self.assertEqual(cached_count(Reading.objects.all()), 12)
+
+    def test_failed_chunk_rebuilds_the_imported_readings(self):
+        """
+        The usages of the committed chunks are rebuilt when a later chunk fails.
+        """
+        meter = Meter.objects.create(meter_name='testmeter', meter_unit='m')
+        (handle, csv_path) = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as csv_file:
+            csv_file.write('\n'.join(['date,reading,meter'] +
+                                      ['2018-{m:02d}-01,{r},testmeter'.format(m=month, r=month)
+                                       for month in range(1, 5)]))
+        bulk_create = Reading.objects.bulk_create
+        chunks = []
+
+        def fail_second_chunk(chunk):
+            chunks.append(chunk)
+            if len(chunks) > 1:
+                raise OperationalError('database is locked')
+            return bulk_create(chunk)
+
+        try:
+            with mock.patch.object(Reading.objects, 'bulk_create', fail_second_chunk), \
+                    self.assertRaises(OperationalError):
+                call_command('import_readings', csv_path, '--chunk-size', '2', stdout=StringIO())
+        finally:
+            os.remove(csv_path)
+        self.assertEqual(Reading.objects.filter(meter=meter).count(), 2)
+        self.assertEqual(Usage.objects.filter(meter=meter).count(), 1)
+
+    def test_rebuild_without_readings(self):
+        """
+        Rebuilding a meter without readings removes its usages and outdates the cached counts and
+        usage queries.
+        """
+        meter = Meter.objects.create(meter_name='testmeter', meter_unit='m')
+        Usage.objects.create(meter=meter, year=2018, month=1, usage=10)
+        self.assertEqual(cached_count(Usage.objects.filter(meter=meter), meter.id), 1)
+        series = lambda: get_monthly_usage_series([meter.id], [2018])
+        self.assertIsNotNone(cached_usage_query([meter.id], [2018], 'test', series)[0]['data'][0])
+        rebuild_usages(meter.id)
+        self.assertFalse(Usage.objects.filter(meter=meter).exists())
+        self.assertEqual(cached_count(Usage.objects.filter(meter=meter), meter.id), 0)
+        self.assertIsNone(cached_usage_query([meter.id], [2018], 'test', series)[0]['data'][0])
+
+
+class ListPageTests(TestCase):
+    """
+    Test the keyset paging and the cached counts of the list pages.
+    """
+
+    # pylint: disable=invalid-name
+
+    def setUp(self):
+        """
+        Start with an empty cache and two meters with 25 readings.
+        """
+        caches[settings.USAGE_CACHE].clear()
+        self.client = Client()
+        self.user = User.objects.create_user('testuser', 'test@user.com', 'q2w3E$R%')
+        self.client.login(username='testuser', password='q2w3E$R%')
+        self.meter1 = Meter.objects.create(meter_name='b-meter', meter_unit='m')
+        self.meter2 = Meter.objects.create(meter_name='a-meter', meter_unit='m')
+        for i in range(25):
+            Reading.objects.create(date=datetime.date(2018, 1, 1) + datetime.timedelta(days=20 * i),
+                                   reading=(i * 7) % 11,
+                                   meter=self.meter1 if i % 2 else self.meter2)
+
+    def _walk(self, url, query):
+        """
+        Follow the next links from the page and return the ids of all the readings.
+        """
+        ids = []
+        pages = []
+        while query is not None:
+            page = self.client.get(url + '?' + query).context['readings']
+            ids += [r.id for r in page]
+            pages.append(page.number)
+            query = page.next_query
+        return (ids, pages)
+
+    def test_follow_the_pages(self):
+        """
+        Following the next links shows every reading once, in the order of the sort key (or of the
+        id for an unknown sort key).
+        """
+        url = reverse('utilities:reading_list')
+        for (sort_by, ordering) in (('reading', ('reading', 'id')),
+                                    ('reading', ('-reading', '-id')),
+                                    ('meter__meter_name', ('meter__meter_name', 'id')),
+                                    ('date', ('date', 'id')),
+                                    ('nonsense', ('id',))):
+            (ids, pages) = self._walk(url, 'sort_by=' + sort_by)
+            self.assertEqual(ids, list(Reading.objects.order_by(*ordering).
+                                       values_list('id', flat=True)))
+            self.assertEqual(pages, [1, 2, 3])
+
+    def test_previous_and_last_page(self):
+        """
+        The last page holds the rest of the readings and its previous page is the second page.
+        """
+        url = reverse('utilities:reading_list')
+        page1 = self.client.get(url + '?sort_by=reading').context['readings']
+        page2 = self.client.get(url + '?' + page1.next_query).context['readings']
+        last = self.client.get(url + '?' + page1.last_query).context['readings']
+        self.assertEqual((last.number, len(last), last.has_next), (3, 5, False))
+        previous = self.client.get(url + '?' + last.previous_query).context['readings']
+        self.assertEqual([r.id for r in previous], [r.id for r in page2])
+        first = self.client.get(url + '?' + previous.previous_query).context['readings']
+        self.assertEqual([r.id for r in first], [r.id for r in page1])
+        self.assertFalse(first.has_previous)
+
+    def test_meter_filter_is_kept(self):
+        """
+        The links keep the meter filter, but not the sort key (that is in the session).
+        """
+        url = reverse('utilities:reading_list')
+        response = self.client.get(url + '?sort_by=date&m_id={m}'.format(m=self.meter2.id))
+        page = response.context['readings']
+        self.assertIn('m_id={m}'.format(m=self.meter2.id), page.next_query)
+        self.assertNotIn('sort_by', page.next_query)
+        (ids, _) = self._walk(url, page.next_query)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(set(Reading.objects.filter(id__in=ids).values_list('meter', flat=True)),
+                         {self.meter2.id})
+
+    def test_invalid_cursor_shows_the_first_page(self):
+        """
+        An invalid cursor shows the first page.
+        """
+        response = self.client.get(reverse('utilities:reading_list') + '?after=nonsense&page=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['readings'].number, 1)
+
+    def test_cached_count(self):
+        """
+        The count is cached until a reading is added.
+        """
+        url = reverse('utilities:reading_list')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries.captured_queries))
+        self.assertEqual(response.context['readings'].num_pages, 3)
+
+        for i in range(6):
+            Reading.objects.create(date=datetime.date(2019, 1, 1) + datetime.timedelta(days=i),
+                                   reading=100 + i, meter=self.meter1)
+        self.assertEqual(self.client.get(url).context['readings'].num_pages, 4)
+        Reading.objects.filter(date__year=2019).first().delete()
+        self.assertEqual(self.client.get(url).context['readings'].num_pages, 3)
+
+    @override_settings(USAGE_RECALCULATION_QUEUE=True)
+    def test_cached_count_with_the_queue(self):
+        """
+        The count follows the readings when the usages are recalculated in the background.
+        """
+        url = reverse('utilities:reading_list')
+        self.assertEqual(self.client.get(url).context['readings'].num_pages, 3)
+        for i in range(6):
+            Reading.objects.create(date=datetime.date(2019, 1, 1) + datetime.timedelta(days=i),
+                                   reading=100 + i, meter=self.meter1)
+        self.assertEqual(self.client.get(url).context['readings'].num_pages, 4)
+
+    def test_usage_list_sorted_on_date(self):
+        """
+        The usages are paged on year and month.
+        """
+        url = reverse('utilities:usage_list')
+        ids = []
+        pages = []
+        query = 'sort_by=date&m_id={m}'.format(m=self.meter1.id)
+        while query is not None:
+            page = self.client.get(url + '?' + query).context['usages']
+            ids += [u.id for u in page]
+            pages.append(page.number)
+            query = page.next_query
+        self.assertEqual(pages, [1, 2])
+        self.assertEqual(ids, list(Usage.objects.filter(meter=self.meter1).
+                                   order_by('year', 'month', 'id').values_list('id', flat=True)))
+
+
+class QueryPlanTests(TestCase):
+    """
+    Test the indexes of the hot queries and the stored period of the usages.
+    """
+
+    def test_hot_queries_use_indexes(self):
+        """
+        None of the hot queries does a full table scan.
+        """
+        for (name, queryset) in get_hot_queries().items():
+            self.assertEqual(get_full_scans(queryset), [], name)
+        self.assertEqual(check_hot_query_plans(None, databases=['default']), [])
+
+    def test_full_scan_is_detected(self):
+        """
+        A query on a column without index is reported.
+        """
+        self.assertTrue(get_full_scans(Reading.objects.filter(remark='x')))
+        self.assertTrue(get_full_scans(Usage.objects.order_by('usage')[:10]))
+
+    def test_every_sort_key_is_checked(self):
+        """
+        The hot queries hold the list pages for every sort key the list pages accept, except the
+        keys that are sorted without an index on purpose.
+        """
+        hot_queries = get_hot_queries()
+        for (name, sort_keys) in (('meter list', METER_SORT_KEYS),
+                                  ('reading list', READING_SORT_KEYS),
+                                  ('reading list of a meter', READING_SORT_KEYS),
+                                  ('usage list', USAGE_SORT_KEYS),
+                                  ('usage list of a meter', USAGE_SORT_KEYS)):
+            for sort_key in set(sort_keys) - UNINDEXED_SORT_KEYS:
+                self.assertIn('{n} by {k}'.format(n=name, k=sort_key), hot_queries)
+
+    def test_usage_period(self):
+        """
+        The period of the usages is stored when they are calculated and saved.
+        """
+        meter = Meter.objects.create(meter_name='testmeter', meter_unit='m')
+        Reading.objects.create(date=datetime.date(2018, 11, 1), reading=0, meter=meter)
+        Reading.objects.create(date=datetime.date(2019, 2, 1), reading=92, meter=meter)
+        self.assertEqual(list(Usage.objects.order_by('period').values_list('year', 'month',
+                                                                           'period')),
+                         [(2018, 11, 2018 * 12 + 11), (2018, 12, 2018 * 12 + 12),
+                          (2019, 1, 2019 * 12 + 1)])
+        usage = Usage.objects.get(year=2019, month=1)
+        usage.month = 2
+        usage.save()
+        self.assertEqual(Usage.objects.get(pk=usage.pk).period, 2019 * 12 + 2)
+
+    def test_usage_period_of_the_bulk_writes(self):
+        """
+        The period of the usages is stored by bulk_create, bulk_update, update and loaddata.
+        """
+        meter = Meter.objects.create(meter_name='testmeter', meter_unit='m')
+        Usage.objects.bulk_create([Usage(meter=meter, year=2018, month=month, usage=1)
+                                   for month in (1, 2)])
+        periods = lambda: list(Usage.objects.order_by('id').values_list('period', flat=True))
+        self.assertEqual(periods(), [2018 * 12 + 1, 2018 * 12 + 2])
+
+        Usage.objects.filter(month=1).update(year=2017)
+        Usage.objects.filter(month=2).update(month=3)
+        self.assertEqual(periods(), [2017 * 12 + 1, 2018 * 12 + 3])
+
+        usages = list(Usage.objects.order_by('id'))
+        for usage in usages:
+            usage.year = 2016
+        Usage.objects.bulk_update(usages, ['year'])
+        self.assertEqual(periods(), [2016 * 12 + 1, 2016 * 12 + 3])
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as fixture:
+            json.dump([{'model': 'utilities.usage', 'pk': 100,
+                        'fields': {'meter': meter.id, 'year': 2015, 'month': 6, 'usage': '1'}}],
+                      fixture)
+        try:
+            call_command('loaddata', fixture.name, verbosity=0)
+        finally:
+            os.remove(fixture.name)
+        self.assertEqual(Usage.objects.get(pk=100).period, 2015 * 12 + 6)
+
+
+class MeterRegistryTests(TestCase):
+    """
+    Test the meter registry and the cached meter buttons.
+    """
+
+    # pylint: disable=invalid-name
+
+    def setUp(self):
+        """
+        Start with empty caches and two meters.
+        """
+        caches[settings.USAGE_CACHE].clear()
+        caches['default'].clear()
+        self.meter1 = Meter.objects.create(meter_name='testmeter1', meter_unit='m')
+        self.meter2 = Meter.objects.create(meter_name='testmeter2', meter_unit='kWh')
+        self.reading = Reading.objects.create(date=datetime.date(2018, 1, 1), reading=10,
+                                              meter=self.meter2)
+
+    def test_meters_are_loaded_once(self):
+        """
+        The meters are loaded once, the names and units are then known without queries.
+        """
+        self.assertEqual([meter.meter_name for meter in get_meters()],
+                         ['testmeter1', 'testmeter2'])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_meter(self.meter2.id).meter_unit, 'kWh')
+            self.assertEqual(str(self.reading), 'Reading: 2018-01-01 testmeter2 - 10 kWh')
+        self.assertIsNone(get_meter(-1))
+
+    def test_invalidated_by_the_signals(self):
+        """
+        Saving or deleting a meter reloads the registry.
+        """
+        get_meters()
+        self.meter1.meter_unit = 'm3'
+        self.meter1.save()
+        self.assertEqual(get_meter(self.meter1.id).meter_unit, 'm3')
+        self.meter1.delete()
+        self.assertEqual([meter.id for meter in get_meters()], [self.meter2.id])
+
+    @override_settings(METER_REGISTRY_CHECK_INTERVAL=0)
+    def test_invalidated_by_other_process(self):
+        """
+        A meter changed by another process (a new data version in the database) reloads the
+        registry, also when the processes do not share the cache.
+        """
+        get_meters()
+        Meter.objects.filter(pk=self.meter1.id).update(meter_name='renamed')
+        self.assertEqual(get_meter(self.meter1.id).meter_name, 'testmeter1')
+        caches[settings.USAGE_CACHE].clear()
+        self.assertEqual(get_meter(self.meter1.id).meter_name, 'testmeter1')
+        Meter.objects.filter(pk=self.meter1.id).update(data_version=F('data_version') + 1)
+        self.assertEqual(get_meter(self.meter1.id).meter_name, 'renamed')
+
+    def test_version_from_the_database(self):
+        """
+        The version changes when a meter is changed, added or deleted.
+        """
+        versions = [get_meter_registry_version()]
+        self.meter1.meter_name = 'renamed'
+        self.meter1.save()
+        versions.append(get_meter_registry_version())
+        meter3 = Meter.objects.create(meter_name='testmeter3', meter_unit='m')
+        versions.append(get_meter_registry_version())
+        meter3.delete()
+        versions.append(get_meter_registry_version())
+        self.assertEqual(len(set(versions[:3])), 3)
+        # the same meters with the same data as before the new meter
+        self.assertEqual(versions[3], versions[1])
+        caches[settings.USAGE_CACHE].clear()
+        self.assertEqual(get_meter_registry_version(), versions[-1])
+
+    def test_meter_buttons_are_cached(self):
+        """
+        The meter buttons are rendered once and again when a meter changed.
+        """
+        user = User.objects.create_user('testuser', 'test@user.com', 'q2w3E$R%')
+        self.client.force_login(user)
+        url = reverse('utilities:reading_list')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        # only the data versions of the meters (the key of the count) are queried, once
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith('SELECT "utilities_meter"') and
+                          'meter_name' in query['sql']])
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if query['sql'].startswith('SELECT "utilities_meter"."id", '
+                                                         '"utilities_meter"."data_version"')]),
+                         1)
+        self.assertContains(response, 'id="meter_{m}">testmeter1</a>'.format(m=self.meter1.id))
+
+        self.meter1.meter_name = 'renamed'
+        self.meter1.save()
+        response = self.client.get(url)
+        self.assertContains(response, 'id="meter_{m}">renamed</a>'.format(m=self.meter1.id))
+
+    def test_cached_graphs_page(self):
+        """
+        The cached graphs page only queries the session, the user and the data versions.
+        """
+        user = User.objects.create_user('testuser', 'test@user.com', 'q2w3E$R%')
+        self.client.force_login(user)
+        url = reverse('utilities:graphs')
+        self.client.get(url)
+        with self.assertNumQueries(3):
+            self.client.get(url)
+
+
+class SQLiteProfileTests(TestCase):
+    """
+    Test the SQLite pragmas and the maintenance command.
+    """
+
+    def test_pragmas_of_the_connection(self):
+        """
+        The new connections get the pragmas of settings.SQLITE_PRAGMAS.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+            cursor.execute('PRAGMA synchronous')
+            # NORMAL
+            self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertIn('PRAGMA journal_mode = WAL', get_pragma_statements())
+
+    def test_maintenance_sets_the_journal_mode(self):
+        """
+        A new connection leaves the journal mode of the database file alone, the maintenance
+        switches it to WAL.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.sqlite3')
+            writer = DatabaseWrapper(dict(connections[DEFAULT_DB_ALIAS].settings_dict, NAME=path))
+            try:
+                with writer.cursor() as cursor:
+                    cursor.execute('CREATE TABLE reading (reading REAL)')
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone()[0], 'delete')
+                self.assertFalse(os.path.exists(path + '-wal'))
+                results = run_maintenance(writer)
+                self.assertIn('checkpoint', results)
+                with writer.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone()[0], 'wal')
+            finally:
+                writer.close()
+
+    def test_db_maintenance(self):
+        """
+        The maintenance analyzes the database, the in-memory test database has no WAL.
+        """
+        out = StringIO()
+        call_command('db_maintenance', stdout=out)
+        self.assertIn('Analyzed and optimized database default.', out.getvalue())
+        self.assertIn('not in WAL mode', out.getvalue())
+        self.assertNotIn('Vacuumed', out.getvalue())
+
+
+class ReadWriteRouterTests(SimpleTestCase):
+    """
+    Test the routing of the reads to the read-only connection.
+    """
+
+    def test_routing(self):
+        """
+        The reads go to the read alias, the writes and the migrations to the default database.
+        """
+        router = ReadWriteRouter()
+        read_alias = settings.DATABASE_READ_ALIAS
+        replica = {'NAME': 'file:replica?mode=ro'}
+        with mock.patch.dict(connections[read_alias].settings_dict, replica):
+            self.assertEqual(router.db_for_read(Reading), read_alias)
+            self.assertEqual(router.db_for_write(Reading), DEFAULT_DB_ALIAS)
+            # a transaction reads its own writes
+            with mock.patch.object(connections[DEFAULT_DB_ALIAS], 'in_atomic_block', True):
+                self.assertEqual(router.db_for_read(Reading), DEFAULT_DB_ALIAS)
+        self.assertFalse(router.allow_migrate(read_alias, 'utilities'))
+        self.assertIsNone(router.allow_migrate(DEFAULT_DB_ALIAS, 'utilities'))
+
+    def test_test_mirror(self):
+        """
+        In the tests the read alias mirrors the default database, so the reads stay on it.
+        """
+        self.assertEqual(ReadWriteRouter().db_for_read(Reading), DEFAULT_DB_ALIAS)
+
+    def test_read_only_connection(self):
+        """
+        The connection of the read alias can read, but not write.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.sqlite3')
+            writer = DatabaseWrapper(dict(connections[DEFAULT_DB_ALIAS].settings_dict, NAME=path))
+            with writer.cursor() as cursor:
+                cursor.execute('CREATE TABLE reading (reading REAL)')
+                cursor.execute('INSERT INTO reading VALUES (1)')
+            reader = DatabaseWrapper(dict(connections[DEFAULT_DB_ALIAS].settings_dict,
+                                          NAME='file:{p}?mode=ro'.format(p=path)),
+                                     alias=settings.DATABASE_READ_ALIAS)
+            try:
+                with reader.cursor() as cursor:
+                    cursor.execute('PRAGMA query_only')
+                    self.assertEqual(cursor.fetchone()[0], 1)
+                    cursor.execute('SELECT reading FROM reading')
+                    self.assertEqual(cursor.fetchone()[0], 1)
+                    with self.assertRaises(OperationalError):
+                        cursor.execute('INSERT INTO reading VALUES (2)')
+            finally:
+                reader.close()
+                writer.close()
+
+
+class ReplicaTests(TransactionTestCase):
+    """
+    Test the reads of the views and of the usage recalculation with the read alias on a replica
+    (a copy of the database in a file) that lags behind.
+    """
+
+    databases = {DEFAULT_DB_ALIAS, settings.DATABASE_READ_ALIAS}
+
+    # pylint: disable=invalid-name
+
+    def setUp(self):
+        """
+        Copy a meter with two readings and a logged in user to the replica and point the read alias
+        at it.
+        """
+        caches[settings.USAGE_CACHE].clear()
+        self.meter = Meter.objects.create(meter_name='testmeter', meter_unit='m')
+        Reading.objects.create(date=datetime.date(2018, 1, 1), reading=0, meter=self.meter)
+        Reading.objects.create(date=datetime.date(2018, 3, 1), reading=59, meter=self.meter)
+        self.client = Client()
+        self.client.force_login(User.objects.create_user('testuser', 'test@user.com', 'q2w3E$R%'))
+
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'replica.sqlite3')
+        connections[DEFAULT_DB_ALIAS].ensure_connection()
+        replica = sqlite3.connect(path)
+        try:
+            connections[DEFAULT_DB_ALIAS].connection.backup(replica)
+        finally:
+            replica.close()
+        self.read_connection = connections[settings.DATABASE_READ_ALIAS]
+        connections[settings.DATABASE_READ_ALIAS] = DatabaseWrapper(
+            dict(connections[DEFAULT_DB_ALIAS].settings_dict,
+                 NAME='file:{p}?mode=ro'.format(p=path)),
+            alias=settings.DATABASE_READ_ALIAS)
+
+    def tearDown(self):
+        """
+        Point the read alias back at the test database.
+        """
+        connections[settings.DATABASE_READ_ALIAS].close()
+        connections[settings.DATABASE_READ_ALIAS] = self.read_connection
+        self.directory.cleanup()
+
+    def test_view_reads_the_replica(self):
+        """
+        The list page shows the readings of the replica, the recalculation reads the new reading
+        from the default database.
+        """
+        Reading.objects.create(date=datetime.date(2018, 2, 1), reading=100, meter=self.meter)
+        response = self.client.get(reverse('utilities:reading_list'))
+        self.assertEqual(response.context['readings'].count, 2)
+        self.assertEqual(Usage.objects.using(DEFAULT_DB_ALIAS).get(year=2018, month=1).usage, 100)
+        self.assertEqual(Usage.objects.using(DEFAULT_DB_ALIAS).get(year=2018, month=2).usage, -41)
+
+    def test_rebuild_reads_the_default_database(self):
+        """
+        The deferred recalculation and the rebuild of the usages read the readings from the
+        default database.
+        """
+        with deferred_usage_recalculation():
+            Reading.objects.create(date=datetime.date(2018, 2, 1), reading=100, meter=self.meter)
+        Reading.objects.filter(date=datetime.date(2018, 3, 1)).update(reading=200)
+        rebuild_usages(self.meter.id)
+        self.assertEqual(Usage.objects.using(DEFAULT_DB_ALIAS).get(year=2018, month=2).usage, 100)
+
+    @override_settings(USAGE_RECALCULATION_QUEUE=True)
+    def test_queued_reading_reads_the_default_database(self):
+        """
+        The dirty months of a queued reading are found with the neighbours in the default database.
+        """
+        Reading.objects.create(date=datetime.date(2018, 2, 1), reading=100, meter=self.meter)
+        UsageJob.objects.all().delete()
+        Reading.objects.create(date=datetime.date(2018, 2, 15), reading=150, meter=self.meter)
+        job = UsageJob.objects.using(DEFAULT_DB_ALIAS).get()
+        # the stale neighbours (without the reading of February 1st) make January dirty too
+        self.assertEqual((job.first_period, job.last_period),
+                         (period_key(2018, 2), period_key(2018, 2)))
@@ -0,0 +1,104 @@
+"""
+Cache for the usage queries (monthly usage, graphs and the usage API).
+
+The entries are keyed by the meters, the years and the format of the query and by the data
+versions of the meters (Meter.data_version). The data version is bumped in the database when the
+readings, the usages or the meter itself change (see utilities.logic.bump_data_version), so a
+changed meter makes its entries unreachable in every process, whatever the cache backend is.
+"""
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Meter
+
+LOGGER = logging.getLogger('home_dashboard_log')
+
+_KEY_PREFIX = 'usage-cache'
+_HITS_KEY = _KEY_PREFIX + ':hits'
+_MISSES_KEY = _KEY_PREFIX + ':misses'
+_MISSING = object()
+
+
+def _get_cache():
+    """
+    Get the cache backend configured with settings.USAGE_CACHE.
+    """
+    return caches[settings.USAGE_CACHE]
+
+
+def get_data_versions(meter_ids=None, using=None):
+    """
+    Get the data versions of meters from the database, to key cached results with.
+
+    The versions only increase and the ids of deleted meters are not reused, so the key of a set
+    of meters never comes back after a change.
+
+    :param meter_ids: list with meter ids or None for all meters
+    :param using: the database alias or None to let the router choose
+    :return: string with the id and the data version of every (existing) meter
+    """
+    meters = Meter.objects.using(using)
+    if meter_ids is not None:
+        meters = meters.filter(pk__in=meter_ids)
+    return ','.join('{i}:{v}'.format(i=meter_id, v=version)
+                    for (meter_id, version) in meters.order_by('id').
+                    values_list('id', 'data_version'))
+
+
+def _count(cache, key):
+    """
+    Increase a hit/miss counter.
+    """
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # the counter was removed from the cache in the meantime
+        cache.set(key, 1, timeout=None)
+
+
+def cached_usage_query(meter_ids, years, query_format, compute):
+    """
+    Get the result of a usage query from the cache or compute (and cache) it.
+
+    :param meter_ids: list with the ids of the meters of the query or None for all meters
+    :param years: list with the years of the query or None for all years
+    :param query_format: string that identifies the query and output format within the scope
+    :param compute: function without arguments that calculates the result
+    :return: the (cached) result
+    """
+    cache = _get_cache()
+    key = '{p}:entry:{h}'.format(p=_KEY_PREFIX,
+                                 h=hashlib.md5('{v}|{m}|{y}|{f}'.format(
+                                     v=get_data_versions(meter_ids),
+                                     m=meter_ids,
+                                     y=years,
+                                     f=query_format).encode('utf-8')).hexdigest())
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        _count(cache, _MISSES_KEY)
+        value = compute()
+        cache.set(key, value, timeout=settings.USAGE_CACHE_TIMEOUT)
+    else:
+        _count(cache, _HITS_KEY)
+    return value
+
+
+def get_usage_cache_stats():
+    """
+    Get the number of hits and misses of the usage cache.
+
+    :return: dict with the hits and the misses
+    """
+    counters = _get_cache().get_many([_HITS_KEY, _MISSES_KEY])
+    return {'hits': counters.get(_HITS_KEY, 0), 'misses': counters.get(_MISSES_KEY, 0)}
+
+
+def reset_usage_cache_stats():
+    """
+    Set the hits and misses of the usage cache to zero.
+    """
+    _get_cache().set_many({_HITS_KEY: 0, _MISSES_KEY: 0}, timeout=None)
@@ -1,21 +1,51 @@
 """
 Defining the utilities URL links and their respones.
 """
+from datetime import date
 import logging
 
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, permission_required
-from django.conf import settings
-from django.core.paginator import EmptyPage, Paginator
 from django.db import IntegrityError
-from django.utils.datastructures import MultiValueDictKeyError
 from django.shortcuts import render, redirect, reverse
 
 from .forms import NewMeterForm, ReadingForm
+from .list_query import ListQuery
+from .logic import get_monthly_usage_series
+from .meter_registry import get_meter_registry_version, get_meters
 from .models import Meter, Reading, Usage
+from .usage_cache import cached_usage_query
 
 LOGGER = logging.getLogger('home_dashboard_log')
 
+# the sort keys (?sort_by=) of the list pages and the fields they order on, see
+# utilities.checks.UNINDEXED_SORT_KEYS for the keys that are not served by an index
+METER_SORT_KEYS = {'id': ('id',),
+                   'meter_name': ('meter_name',),
+                   'meter_unit': ('meter_unit',)}
+READING_SORT_KEYS = {'id': ('id',),
+                     'date': ('date',),
+                     'reading': ('reading',),
+                     'meter__meter_name': ('meter__meter_name',),
+                     'meter__meter_unit': ('meter__meter_unit',)}
+USAGE_SORT_KEYS = {'id': ('id',),
+                   'date': ('period',),
+                   'usage': ('usage',),
+                   'meter__meter_name': ('meter__meter_name',),
+                   'meter__meter_unit': ('meter__meter_unit',)}
+
+
+def _get_meter_id(request):
+    """
+    Get the meter (?m_id=) to filter a list on.
+
+    :return: the id of the meter or None for all meters
+    """
+    try:
+        return int(request.GET['m_id'])
+    except (KeyError, ValueError):
+        return None
+
 
 # METER
 @login_required()
@@ -23,41 +53,17 @@ def show_meters(request):
     """
     Render the page with the meters.
 
-    Keeping on eye on the sorting list and the paging.
+    Keeping on eye on the sorting list and the paging (see ListQuery).
 
     :param request: the user http request
     :return: the html page with the meters as a http response
     """
     LOGGER.debug('User requests show meter.')
-    # Get the sort_key from the session
-    sort_key = request.session.get('meterlist_sort_by', None)
-    # Override with the sort_key that the user iq requesting.
-    try:
-        sort_key_request = request.GET['sort_by']
-        sort_key = sort_key_request if sort_key != sort_key_request else '-' + sort_key_request
-    except MultiValueDictKeyError:
-        sort_key = sort_key if sort_key else 'id'
-
-    request.session['meterlist_sort_by'] = sort_key
-    queryset = Meter.objects.order_by(sort_key)
-
-    # deal with paging
-    try:
-        page_id = int(request.GET.get('page', 1))
-    except ValueError:
-        # catching if 'page' is not an integer
-        page_id = 1
-    paginator = Paginator(queryset, settings.PAGE_SIZE)
-    page_id = paginator.num_pages if page_id > paginator.num_pages else page_id
-    try:
-        page = paginator.page(page_id)
-    except EmptyPage:
-        page_id = 1
-        page = paginator.page(page_id)
+    page = ListQuery(Meter.objects.all(), 'meterlist_sort_by', METER_SORT_KEYS).get_page(request)
 
     return render(request,
                   'utilities/meter_list.html',
-                  {'object_list': page, 'current_page': page_id})
+                  {'object_list': page, 'current_page': page.number})
 
 
 @login_required()
@@ -248,46 +254,18 @@ def list_readings(request):
     Show all the readings.
     """
     LOGGER.debug('Calling list_readings')
-    try:
-        readings = Reading.objects.all()
-        if request.GET.get('m_id'):
-            readings = readings.filter(meter__pk=request.GET.get('m_id'))
-    except Reading.DoesNotExist:
-        readings = []
-
-    # Get the sort_key from the session
-    sort_key = request.session.get('readinglist_sort_by')
-    # Override with the sort_key that the user iq requesting.
-    try:
-        sort_key_request = request.GET['sort_by']
-        sort_key = sort_key_request if sort_key != sort_key_request else '-'+sort_key_request
-    except MultiValueDictKeyError:
-        sort_key = sort_key if sort_key else 'id'
-
-    request.session['readinglist_sort_by'] = sort_key
-    readings = readings.order_by(sort_key)
-
-    # deal with paging
-    try:
-        page_id = int(request.GET.get('page', 1))
-    except ValueError:
-        # catching if 'page' is not an integer
-        page_id = 1
-    paginator = Paginator(readings, settings.PAGE_SIZE)
-    page_id = paginator.num_pages if page_id > paginator.num_pages else page_id
-    try:
-        page = paginator.page(page_id)
-    except EmptyPage:
-        page_id = 1
-        page = paginator.page(page_id)
-
-    meters = Meter.objects.all()
+    readings = Reading.objects.select_related('meter')
+    meter_id = _get_meter_id(request)
+    if meter_id is not None:
+        readings = readings.filter(meter_id=meter_id)
+    page = ListQuery(readings, 'readinglist_sort_by', READING_SORT_KEYS, meter_id).get_page(request)
 
     return render(request,
                   'utilities/reading_list.html',
                   {'readings': page,
-                   'current_page': page_id,
-                   'meters': meters})
+                   'current_page': page.number,
+                   'meters': get_meters(),
+                   'meters_version': get_meter_registry_version()})
 
 
 @login_required()
@@ -491,58 +469,36 @@ def list_usages(request):
     TODO: make selection of meter, data, ...
     """
     LOGGER.debug('Calling list_usages')
-    # Get the sort_key from the session
-    sort_key = request.session.get('usagelist_sort_by')
-    # Override with the sort_key that the user iq requesting.
-    try:
-        sort_key_request = request.GET['sort_by']
-        sort_key = sort_key_request if sort_key != sort_key_request else '-'+sort_key_request
-    except MultiValueDictKeyError:
-        sort_key = sort_key if sort_key else 'id'
-
-    request.session['usagelist_sort_by'] = sort_key
-
-    try:
-        usages = Usage.objects.all()
-        if request.GET.get('m_id'):
-            usages = usages.filter(meter_id=request.GET.get('m_id'))
-        if sort_key[-4:] == 'date':
-            order = '-' if sort_key[:1] == '-' else ''
-            usages = usages.order_by(order + 'year', order + 'month')
-        else:
-            usages = usages.order_by(sort_key)
-    except Usage.DoesNotExist:
-        usages = []
-
-    # deal with paging
-    try:
-        page_id = int(request.GET.get('page', 1))
-    except ValueError:
-        # catching if 'page' is not an integer
-        page_id = 1
-    paginator = Paginator(usages, settings.PAGE_SIZE)
-    page_id = paginator.num_pages if page_id > paginator.num_pages else page_id
-    try:
-        page = paginator.page(page_id)
-    except EmptyPage:
-        page_id = 1
-        page = paginator.page(page_id)
-
-    meters = Meter.objects.all()
+    usages = Usage.objects.select_related('meter')
+    meter_id = _get_meter_id(request)
+    if meter_id is not None:
+        usages = usages.filter(meter_id=meter_id)
+    page = ListQuery(usages, 'usagelist_sort_by', USAGE_SORT_KEYS, meter_id).get_page(request)
 
     return render(request,
                   'utilities/usage_list.html',
                   {'usages': page,
-                   'current_page': page_id,
-                   'meters': meters})
+                   'current_page': page.number,
+                   'meters': get_meters(),
+                   'meters_version': get_meter_registry_version()})
 
 @login_required
 def graphs(request):
     """
     Generate the graphs page for utilities.
 
+    The series of the last three years of all the meters are embedded in the page, so the graphs
+    can be drawn without extra requests.
+
     :param request: the user http request
     :return: the generate html page to draw graphs
     """
-    meters = Meter.objects.all()
-    return render(request, 'utilities/graphs.html', {'meters': meters})
+    meters = get_meters()
+    year = date.today().year
+    meter_ids = [meter.id for meter in meters]
+    years = [year, year - 1, year - 2]
+    series = cached_usage_query(meter_ids, years, 'monthly_usage',
+                                lambda: get_monthly_usage_series(meter_ids, years))
+    return render(request, 'utilities/graphs.html', {'meters': meters,
+                                                     'meters_version': get_meter_registry_version(),
+                                                     'series': series})